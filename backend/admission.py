@@ -0,0 +1,210 @@
+"""
+アドミッション制御 (同時実行数の上限とクライアントごとのレート制限)
+
+重い処理の種類ごとに同時実行の枠(プール)を分け、チャットのストリームが詰まっても
+ファイル解析やカタログ参照が巻き込まれないようにします。
+
+- プールごとに同時実行数の上限と、空きを待てるリクエスト数(待ち行列)の上限を持つ
+- 待ち行列が満杯、または queue_timeout 秒待っても空かなければ即座に 429 を返す
+- クライアントごとにトークンバケットで頻度を制限する。クライアントは接続元のIPアドレス
+  (trust_forwarded なら X-Forwarded-For の先頭) で見分け、APIキーは api_keys に登録済みのものだけを使う
+  (未確認のキーで見分けると、リクエストごとにキーを変えれば制限をすり抜けられるため)
+- 429 には Retry-After を付ける (待ち行列の長さと直近の処理時間から見積もる)
+
+ASGIミドルウェアとして動くため、枠はストリーミング応答を最後まで送り終えるまで保持されます。
+枠と待ち行列はワーカープロセスごとです。
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Collection, Deque, Dict, List, Optional, Pattern, Tuple
+
+from metrics import ADMISSION_ACTIVE, ADMISSION_QUEUE_WAIT, ADMISSION_REJECTED
+
+
+class Rejected(Exception):
+    """受け付けられなかったリクエスト (reason は rate_limit / queue_full / timeout)"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ConcurrencyPool:
+    """同時実行数の上限と、上限付きの待ち行列"""
+
+    def __init__(self, name: str, limit: int, max_queue: int, queue_timeout: float = 5.0):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # 1件あたりの枠の保持時間(秒)の指数移動平均。Retry-After の見積もりに使う
+        self._avg_hold = 1.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> float:
+        """今並んだ場合に枠が空くまでのおおよその秒数"""
+        return max(1.0, self._avg_hold * (self.waiting + 1) / self.limit)
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            ADMISSION_ACTIVE.inc(pool=self.name)
+            return
+        if self.waiting >= self.max_queue:
+            raise Rejected("queue_full", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 枠を受け取った直後に中断された場合は返す
+                self.release(0.0)
+            else:
+                try:
+                    self._waiters.remove(future)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise Rejected("timeout", self.retry_after()) from None
+            raise
+        finally:
+            ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - start, pool=self.name)
+
+    def release(self, held: float):
+        """枠を返す (held は枠を保持していた秒数)。待っているリクエストがあれば枠をそのまま渡す"""
+        if held > 0:
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+        ADMISSION_ACTIVE.dec(pool=self.name)
+
+
+class RateLimiter:
+    """クライアントごとのトークンバケット (毎分 rate_per_minute 回、最大 burst 回まで連続可)"""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_clients: int = 10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def check(self, client: str) -> float:
+        """1回分消費する。許可なら0、拒否なら次に許可されるまでの秒数を返す"""
+        now = time.monotonic()
+        tokens, last = self._buckets.get(client, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+        wait = 0.0
+        if tokens >= 1.0:
+            tokens -= 1.0
+        else:
+            wait = (1.0 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        self._buckets.move_to_end(client)
+        while len(self._buckets) > self.max_clients:
+            # しばらく来ていないクライアントから忘れる (満杯のバケットに戻るだけ)
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class Rule:
+    """パスとプール・レート制限の対応"""
+
+    def __init__(self, methods: Tuple[str, ...], path: str, pool: ConcurrencyPool,
+                 limiter: Optional[RateLimiter] = None):
+        self.methods = methods
+        self.pattern: Pattern = re.compile(path)
+        self.pool = pool
+        self.limiter = limiter
+
+    def matches(self, method: str, path: str) -> bool:
+        return method in self.methods and self.pattern.fullmatch(path) is not None
+
+
+def client_key(scope: Dict, trust_forwarded: bool = False, api_keys: Collection[str] = ()) -> str:
+    """レート制限の単位 (api_keys に登録済みのAPIキーならそのキー、それ以外はIPアドレス)"""
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    api_key = headers.get("x-api-key")
+    if not api_key and headers.get("authorization", "").lower().startswith("bearer "):
+        api_key = headers["authorization"][7:]
+    if api_key and api_key in api_keys:
+        # キーそのものはメモリに残さない
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    if trust_forwarded and headers.get("x-forwarded-for"):
+        return "ip:" + headers["x-forwarded-for"].split(",")[0].strip()
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+class AdmissionMiddleware:
+    """ルールに一致したリクエストだけを制限するASGIミドルウェア"""
+
+    def __init__(self, app, rules: List[Rule], trust_forwarded: bool = False, api_keys: Collection[str] = ()):
+        self.app = app
+        self.rules = rules
+        self.trust_forwarded = trust_forwarded
+        self.api_keys = frozenset(api_keys)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rule = next((r for r in self.rules if r.matches(scope["method"], scope["path"])), None)
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            if rule.limiter is not None:
+                wait = rule.limiter.check(client_key(scope, self.trust_forwarded, self.api_keys))
+                if wait > 0:
+                    raise Rejected("rate_limit", wait)
+            await rule.pool.acquire()
+        except Rejected as e:
+            ADMISSION_REJECTED.inc(pool=rule.pool.name, reason=e.reason)
+            await _reject(send, e)
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            rule.pool.release(time.perf_counter() - start)
+
+
+async def _reject(send, rejected: Rejected):
+    messages = {
+        "rate_limit": "リクエストが多すぎます。しばらく待ってから再試行してください",
+        "queue_full": "混雑しています。しばらく待ってから再試行してください",
+        "timeout": "混雑しています。しばらく待ってから再試行してください",
+    }
+    body = json.dumps({"detail": messages[rejected.reason], "reason": rejected.reason},
+                      ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(math.ceil(rejected.retry_after)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
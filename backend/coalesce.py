@@ -0,0 +1,165 @@
+"""
+/api/chat のリクエスト集約 (single-flight)
+
+同じ (モデル, メッセージ) の組み合わせで同時に来たリクエストは、上流APIへの
+ストリームを1本だけ開き、受信したイベントを共有のリプレイバッファ経由で全員に配信します。
+途中から参加したリクエストもバッファの先頭から再生されるため、全員が同じ応答を受け取ります。
+cache_ttl を指定すると、完了した応答をその秒数だけ保持して後続のリクエストにも返します。
+
+上流のストリームは別スレッドで読み、イベントループには call_soon_threadsafe で渡すため、
+同期版のOpenAIクライアントを使ってもイベントループをブロックしません。
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# 上流ストリームを開き、SSEで送るイベント ({"content": ...} など) を順に返す関数
+Producer = Callable[[], Iterable[Dict]]
+
+
+def request_key(model: str, messages: List[Dict]) -> str:
+    """集約・キャッシュ用のキー (モデルとメッセージ列のハッシュ)"""
+    payload = json.dumps([model, messages], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """1本の上流ストリームと、その受信済みイベント(リプレイバッファ)"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.events: List[Dict] = []
+        self.done = False
+        self.error: Optional[str] = None
+        self.subscribers = 0
+        self.cancelled = threading.Event()
+        self._loop = loop
+        self._changed = asyncio.Event()
+
+    @classmethod
+    def completed(cls, loop: asyncio.AbstractEventLoop, events: List[Dict]) -> "Flight":
+        flight = cls(loop)
+        flight.events = events
+        flight.done = True
+        return flight
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def push(self, event: Dict):
+        """上流スレッドからイベントを追加する"""
+        self._loop.call_soon_threadsafe(self._append, event)
+
+    def _append(self, event: Dict):
+        self.events.append(event)
+        self._notify()
+
+    def _finish(self, error: Optional[str]):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def replay(self) -> AsyncIterator[Dict]:
+        """バッファの先頭から再生し、以降は届いた順に返す"""
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(self.events):
+                    yield self.events[position]
+                    position += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # 全員が切断したら上流の読み込みを止める
+                self.cancelled.set()
+
+
+class Coalescer:
+    """同一リクエストの集約と、完了した応答の短期キャッシュ"""
+
+    def __init__(self, cache_ttl: float = 0.0, max_cache_entries: int = 256):
+        """
+        cache_ttl: 完了した応答を保持する秒数 (0でキャッシュしない)
+        max_cache_entries: キャッシュする応答の最大件数 (古いものから削除)
+        """
+        self.cache_ttl = cache_ttl
+        self.max_cache_entries = max_cache_entries
+        self._inflight: Dict[str, Flight] = {}
+        self._cache: "OrderedDict[str, Tuple[float, List[Dict]]]" = OrderedDict()
+
+    def _cached(self, key: str) -> Optional[List[Dict]]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, events = entry
+        if expires_at < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return events
+
+    def _store(self, key: str, events: List[Dict]):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, events)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cache_entries:
+            self._cache.popitem(last=False)
+
+    def join(self, key: str, producer: Producer) -> Tuple[Flight, str]:
+        """
+        キーに対応するストリームに参加する
+        戻り値は (Flight, 種別)。種別は "cache" / "follower" / "leader"
+        """
+        loop = asyncio.get_running_loop()
+        if self.cache_ttl > 0:
+            events = self._cached(key)
+            if events is not None:
+                return Flight.completed(loop, events), "cache"
+
+        flight = self._inflight.get(key)
+        if flight is not None and not flight.cancelled.is_set():
+            return flight, "follower"
+
+        flight = self._inflight[key] = Flight(loop)
+        thread = threading.Thread(target=self._run, args=(key, flight, producer), daemon=True)
+        thread.start()
+        return flight, "leader"
+
+    def _run(self, key: str, flight: Flight, producer: Producer):
+        """上流ストリームを読み、イベントをFlightに流す(別スレッド)"""
+        error = None
+        events = iter(())
+        try:
+            events = iter(producer())
+            for event in events:
+                if flight.cancelled.is_set():
+                    error = "cancelled"
+                    break
+                flight.push(event)
+        except Exception as e:
+            error = str(e)
+        finally:
+            close = getattr(events, "close", None)
+            if close:
+                close()
+        flight._loop.call_soon_threadsafe(self._complete, key, flight, error)
+
+    def _complete(self, key: str, flight: Flight, error: Optional[str]):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        flight._finish(error)
+        if error is None and self.cache_ttl > 0:
+            self._store(key, flight.events)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
@@ -0,0 +1,38 @@
+"""
+gunicorn 設定 (複数ワーカー構成)
+
+  cd backend
+  gunicorn -c gunicorn.conf.py main:app
+
+- preload_app: マスタープロセスでアプリ(プロンプトカタログ)を1回だけ読み込んでから fork する。
+  カタログは読み取り専用なので、各ワーカーは copy-on-write で同じメモリページを共有する
+- 会話セッションは SESSION_DB (SQLite, WAL) に保存してワーカー間で共有する
+- チャット履歴はファイルロック、検索索引は SQLite (WAL) で複数ワーカーから安全に書き込める
+- メトリクス・リクエスト集約・応答キャッシュはワーカーごと
+- ロードバランサーのヘルスチェックには /readyz を使う (起動処理が終わるまで 503)
+"""
+
+import gc
+import multiprocessing
+import os
+from pathlib import Path
+
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# SSE のストリームが終わるのを待ってから停止する
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+
+# ワーカー間で会話セッションを共有するため、未指定なら build/ のSQLiteに保存する
+os.environ.setdefault("SESSION_DB", str(Path(__file__).resolve().parent.parent / "build" / "sessions.sqlite3"))
+
+
+def when_ready(server):
+    """アプリ読み込み後・fork前にマスターで呼ばれる"""
+    # 読み込み済みのオブジェクトをGCの走査対象から外し、ワーカーでGCが走っても
+    # 共有ページに書き込まない (copy-on-write による複製を防ぐ)
+    gc.freeze()
+    server.log.info("プリロード完了: %d オブジェクトを固定", gc.get_freeze_count())
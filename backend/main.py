@@ -1,25 +1,79 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
+import hashlib
 import json
 from pathlib import Path
-from datetime import datetime
 import os
-from openai import OpenAI
 from dotenv import load_dotenv
-import pandas as pd
-import io
-import pdfplumber
-from docx import Document as DocxDocument
 import asyncio
+import sys
+import time
+import uuid
+
+from admission import AdmissionMiddleware, ConcurrencyPool, RateLimiter, Rule
+from coalesce import Coalescer, request_key
+from sessions import SessionStore
+from metrics import (
+    CATALOG_CACHE, CATALOG_LOOKUPS, CATALOG_RELOADS, CHAT_COALESCED, CHAT_COMPLETION_TOKENS, CHAT_MODEL_ERROR_RATE,
+    CHAT_MODEL_REQUESTS, CHAT_MODEL_TTFT_EWMA, CHAT_PROMPT_TOKENS, CHAT_STREAMS_IN_FLIGHT,
+    CHAT_TOKENS_PER_SECOND, CHAT_TTFT, CHAT_UPSTREAM_TOTAL, EXTRACT_CACHE, REQUEST_LATENCY, REQUESTS_IN_FLIGHT,
+    registry, stage,
+)
+
+# 共有モジュール (src/) を読み込めるようにする
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from chat_search import ChatSearchIndex
+from chat_store import ChatStore, new_conversation_id
+from chunk_index import ChunkIndexCache, retrieve_attachments
+from doc_chunker import estimate_tokens
+from extraction import ExtractedDocument, ExtractionCache, file_type_for
+from message_layout import build_messages, make_attachment, pin_attachment, usage_summary
+from model_router import get_model_router
+from openai_client import get_openai_client
+from pdf_engine import get_pdf_engine
+from prompt_catalog import CatalogSnapshot, CatalogWatcher, PromptCatalog, prompt_uid
+from prompt_recommender import PromptRecommender
+from prompt_usage import UsageTracker
+from map_reduce import map_reduce_events, reduce_messages  # src/doc_chunker を使うためパス設定の後
 
 # 環境変数を読み込む
 load_dotenv()
 
 app = FastAPI(title="AIGenPrompts4U API", version="1.0.0")
 
+# アドミッション制御 (処理の種類ごとの同時実行数と、クライアントごとの頻度制限)
+# 上限を超えたリクエストは待ち行列に並び、満杯か ADMISSION_QUEUE_TIMEOUT 秒で 429 を返す
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+
+def _pool(name: str, env: str, default: int) -> ConcurrencyPool:
+    limit = int(os.getenv(env, str(default)))
+    return ConcurrencyPool(name, limit, max_queue=int(os.getenv("ADMISSION_QUEUE", str(limit))),
+                           queue_timeout=ADMISSION_QUEUE_TIMEOUT)
+
+def _limiter(env: str, default: float) -> Optional[RateLimiter]:
+    per_minute = float(os.getenv(env, str(default)))
+    if per_minute <= 0:
+        return None
+    return RateLimiter(per_minute, burst=int(os.getenv("CLIENT_BURST", "10")))
+
+chat_pool = _pool("chat", "CHAT_MAX_CONCURRENCY", 64)
+upload_pool = _pool("upload", "UPLOAD_MAX_CONCURRENCY", os.cpu_count() or 4)
+catalog_pool = _pool("catalog", "CATALOG_MAX_CONCURRENCY", 256)
+app.add_middleware(
+    AdmissionMiddleware,
+    rules=[
+        Rule(("POST",), r"/api/chat|/api/sessions/[^/]+/chat", chat_pool,
+             _limiter("CHAT_RATE_LIMIT", 30)),
+        Rule(("POST",), r"/api/upload", upload_pool, _limiter("UPLOAD_RATE_LIMIT", 30)),
+        Rule(("GET", "POST"), r"/api/categories|/api/prompts/[^/]+|/api/recommend", catalog_pool),
+    ],
+    trust_forwarded=os.getenv("TRUST_FORWARDED_FOR", "0") == "1",
+    api_keys=[key.strip() for key in os.getenv("CLIENT_API_KEYS", "").split(",") if key.strip()],
+)
+
 # CORS設定
 app.add_middleware(
     CORSMiddleware,
@@ -29,13 +83,84 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# リクエストごとのレイテンシ計測
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    with REQUESTS_IN_FLIGHT.track():
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # パスパラメータで系列が増えないようルートのテンプレートを使う
+            route = request.scope.get("route")
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - start,
+                method=request.method,
+                route=getattr(route, "path", "unmatched"),
+                status=status,
+            )
+
 # ディレクトリ設定
 PROMPTS_DIR = Path(__file__).parent.parent / "prompts_data"  # 親ディレクトリのprompts_data
+BUILD_DIR = Path(__file__).parent.parent / "build"  # 生成物(インデックスなど)
 CHAT_HISTORY_DIR = Path("chat_history")
 CHAT_HISTORY_DIR.mkdir(exist_ok=True)
+chat_search = ChatSearchIndex(CHAT_HISTORY_DIR / "search_index.sqlite3")
+chat_store = ChatStore(CHAT_HISTORY_DIR, search_index=chat_search)
+
+# OpenAI クライアントはプロセス内で共有し、接続を使い回す (get_openai_client)
+
+# リクエストごとのモデル選択とフォールバック (CHAT_MODEL / CHAT_FALLBACK_MODELS / MODEL_ROUTES_FILE など)
+model_router = get_model_router()
+
+def _record_model_outcome(model: str, outcome: str, ttft: Optional[float]):
+    CHAT_MODEL_REQUESTS.inc(model=model, outcome=outcome)
+    stats = model_router.stats().get(model)
+    if stats:
+        if stats["ttft"] is not None:
+            CHAT_MODEL_TTFT_EWMA.set(stats["ttft"], model=model)
+        CHAT_MODEL_ERROR_RATE.set(stats["error_rate"], model=model)
+
+model_router.listeners.append(_record_model_outcome)
 
-# OpenAI クライアント
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 同一内容の同時チャットリクエストを1本の上流ストリームに集約する (0で無効)
+CHAT_COALESCE = os.getenv("CHAT_COALESCE", "1") != "0"
+# 完了した応答を同一リクエストに再利用する秒数 (0でキャッシュしない)
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "0"))
+chat_coalescer = Coalescer(cache_ttl=CHAT_CACHE_TTL)
+
+# 大きな添付資料は会話ごとに索引し、質問に関係する上位 RAG_TOP_K 件の抜粋だけを送る
+# RAG_MIN_TOKENS 未満の資料は従来どおり全文を固定する (0で常に全文)
+RAG_MIN_TOKENS = int(os.getenv("RAG_MIN_TOKENS", "2000"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "6"))
+chunk_indexes = ChunkIndexCache(
+    max_entries=int(os.getenv("RAG_MAX_INDEXES", "256")),
+    chunk_tokens=int(os.getenv("RAG_CHUNK_TOKENS", "600")),
+)
+
+# 大きな資料のマップリデュース (ChatRequest.map_reduce)
+MAP_REDUCE_CHUNK_TOKENS = int(os.getenv("MAP_REDUCE_CHUNK_TOKENS", "4000"))
+MAP_REDUCE_OVERLAP_TOKENS = int(os.getenv("MAP_REDUCE_OVERLAP_TOKENS", "200"))
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", "4"))
+MAP_REDUCE_REDUCE_TOKENS = int(os.getenv("MAP_REDUCE_REDUCE_TOKENS", "12000"))
+# /api/upload?full=true で返す最大トークン数
+MAP_REDUCE_MAX_TOKENS = int(os.getenv("MAP_REDUCE_MAX_TOKENS", "500000"))
+
+# アップロードしたファイルの抽出結果 (元ファイルの SHA-1・形式・PDFエンジンの設定ごと。EXTRACT_CACHE_MAX_FILES=0 で無効)
+extraction_cache = ExtractionCache(
+    os.getenv("EXTRACT_CACHE_DIR") or BUILD_DIR / "extracted",
+    max_files=int(os.getenv("EXTRACT_CACHE_MAX_FILES", "256")),
+)
+
+# サーバー側の会話セッション (件数上限・アイドル期限。SESSION_DB を指定するとSQLiteにも保存)
+session_store = SessionStore(
+    max_sessions=int(os.getenv("SESSION_MAX", "1000")),
+    idle_ttl=float(os.getenv("SESSION_IDLE_TTL", "3600")),
+    db_path=os.getenv("SESSION_DB") or None,
+)
 
 # Pydantic モデル
 class PromptData(BaseModel):
@@ -52,9 +177,35 @@ class ChatMessage(BaseModel):
     role: str
     content: str
 
+class ChatAttachment(BaseModel):
+    name: str
+    content: str
+    file_type: str = "text"
+    truncated: bool = False
+
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     system_prompt: Optional[str] = None
+    # 会話に固定する添付資料 (メッセージ本文に埋め込まず、システムプロンプトの直後に置く)
+    attachments: List[ChatAttachment] = []
+    # プロンプトのカテゴリ (モデルの振り分けルールで使う)
+    category: Optional[str] = None
+    # 添付資料をコンテキストに収めず、分割して読んでから回答する (/api/upload?full=true で全文を取得)
+    map_reduce: bool = False
+
+class CreateSessionRequest(BaseModel):
+    system_prompt: Optional[str] = None
+    # プロンプトのカテゴリ (モデルの振り分けルールで使う)
+    category: Optional[str] = None
+    attachments: List[ChatAttachment] = []
+    messages: List[ChatMessage] = []
+
+class SessionChatRequest(BaseModel):
+    # 今回のユーザー発言だけを送る (履歴はサーバー側で保持)
+    content: str
+    attachments: List[ChatAttachment] = []
+    # 指定するとセッション作成時のカテゴリの代わりに使う
+    category: Optional[str] = None
 
 class ChatHistoryItem(BaseModel):
     filename: str
@@ -66,99 +217,126 @@ class SaveChatRequest(BaseModel):
     title: str
     messages: List[ChatMessage]
     selected_prompt: Optional[Dict[str, Any]] = None
+    # 既存の会話を更新する場合に指定 (省略時は新しい会話として保存)
+    conversation_id: Optional[str] = None
+
+class RecommendRequest(BaseModel):
+    query: str
+    top_k: int = 5
+    category: Optional[str] = None
+
+
+# プロンプトカタログ (build/catalog.json があれば検証済みの成果物を読み込む)
+catalog = PromptCatalog(str(PROMPTS_DIR))
+
+# prompts_data の変更監視間隔(秒)。0で無効
+CATALOG_WATCH_INTERVAL = float(os.getenv("CATALOG_WATCH_INTERVAL", "2"))
+catalog_watcher = CatalogWatcher(catalog, interval=CATALOG_WATCH_INTERVAL or 2.0)
+
+# プロンプト推薦インデックス (初回リクエスト時に読み込み)
+_recommender: Optional[PromptRecommender] = None
+
+def get_recommender() -> PromptRecommender:
+    """推薦インデックスを取得（プロセス内で共有）"""
+    global _recommender
+    if _recommender is None:
+        _recommender = PromptRecommender(str(PROMPTS_DIR), BUILD_DIR, catalog=catalog)
+    return _recommender
+
+def _rebuild_recommender(changed: List[str]):
+    """カタログ更新後、読み込み済みの推薦インデックスを監視スレッド上で作り直す"""
+    global _recommender
+    if _recommender is not None:
+        _recommender = PromptRecommender(str(PROMPTS_DIR), BUILD_DIR, catalog=catalog)
+
+catalog_watcher.add_listener(_rebuild_recommender)
+catalog_watcher.add_listener(lambda changed: CATALOG_RELOADS.inc(len(changed)))
+
+# プロンプトの利用状況 (メモリ上で数え、PROMPT_USAGE_FLUSH_INTERVAL 秒ごとにまとめて SQLite に書き出す)
+usage_tracker = UsageTracker(
+    os.getenv("PROMPT_USAGE_DB", str(BUILD_DIR / "usage.sqlite3")) or None,
+    flush_interval=float(os.getenv("PROMPT_USAGE_FLUSH_INTERVAL", "10")),
+    half_life_days=float(os.getenv("PROMPT_POPULARITY_HALF_LIFE", "30")),
+)
+
+def track_chat(system_prompt: Optional[str], first_turn: bool):
+    """カタログのプロンプトを使った発言を数える (カウンタを増やすだけで I/O はしない)"""
+    uid = catalog.find_by_system_prompt(system_prompt)
+    if uid:
+        if first_turn:
+            usage_tracker.record(uid, "chat_start")
+        usage_tracker.record(uid, "turn")
+
+
+@app.on_event("startup")
+async def start_catalog_watcher():
+    if CATALOG_WATCH_INTERVAL > 0:
+        catalog_watcher.start()
+
+@app.on_event("startup")
+async def sync_chat_search():
+    # 索引導入前の履歴や、別プロセスで保存された履歴を取り込む
+    await asyncio.to_thread(chat_search.sync, chat_store)
+
+@app.on_event("startup")
+async def start_usage_tracker():
+    usage_tracker.start()
+
+@app.on_event("startup")
+async def mark_ready():
+    # 起動処理がすべて終わったワーカーだけが /readyz で 200 を返す
+    app.state.ready = True
+
+@app.on_event("shutdown")
+async def stop_catalog_watcher():
+    app.state.ready = False
+    catalog_watcher.stop()
+
+@app.on_event("shutdown")
+async def stop_usage_tracker():
+    # 書き出していない分を残さない
+    await asyncio.to_thread(usage_tracker.stop)
+
+@app.on_event("shutdown")
+async def stop_pdf_workers():
+    await asyncio.to_thread(get_pdf_engine().close)
+
+
+def readiness_checks() -> Dict[str, bool]:
+    """ワーカーがリクエストを受けられる状態かを確認する"""
+    checks = {
+        "startup": getattr(app.state, "ready", False),
+        "catalog": len(catalog.categories()) > 0,
+        "chat_history": os.access(CHAT_HISTORY_DIR, os.W_OK),
+        "search_index": chat_search.ping(),
+    }
+    if session_store.db_path:
+        checks["session_db"] = session_store.ping()
+    return checks
 
 
 # ユーティリティ関数
-def estimate_tokens(text: str) -> int:
-    """テキストのトークン数を概算"""
-    return len(text) // 4
-
-def truncate_content(content: str, max_tokens: int = 15000) -> tuple[str, bool]:
-    """コンテンツが大きすぎる場合に切り詰める"""
-    current_tokens = estimate_tokens(content)
-    if current_tokens <= max_tokens:
-        return content, False
-    
-    # 切り詰める
-    max_chars = max_tokens * 4
-    truncated = content[:max_chars]
-    return truncated, True
+async def read_document(file: UploadFile, max_tokens: Optional[int] = None) -> ExtractedDocument:
+    """
+    アップロードされたファイルをページ・シート・段落単位で読み取る
+    max_tokens を渡すとそこまでで読むのをやめる。結果は EXTRACT_CACHE_DIR に保存して再利用する
+    """
+    file_type = file_type_for(file.filename)
+    with stage("read_file.read"):
+        file_bytes = await file.read()
+    with stage("read_file.parse", file_type):
+        document, result = await asyncio.to_thread(extraction_cache.extract, file_bytes, file.filename, max_tokens)
+    EXTRACT_CACHE.inc(result=result)
+    return document
 
 async def read_file_content(file: UploadFile) -> tuple[str, str]:
     """アップロードされたファイルの内容を読み取る"""
-    file_extension = Path(file.filename).suffix.lower()
-    content = ""
-    file_type = "text"
-    
     try:
-        # PDFファイル
-        if file_extension == ".pdf":
-            file_type = "pdf"
-            file_bytes = await file.read()
-            with io.BytesIO(file_bytes) as pdf_buffer:
-                with pdfplumber.open(pdf_buffer) as pdf:
-                    pages_text = []
-                    for i, page in enumerate(pdf.pages, 1):
-                        page_text = page.extract_text()
-                        if page_text:
-                            pages_text.append(f"--- ページ {i} ---\n{page_text}")
-                    content = "\n\n".join(pages_text)
-        
-        # Wordファイル
-        elif file_extension == ".docx":
-            file_type = "word"
-            file_bytes = await file.read()
-            with io.BytesIO(file_bytes) as docx_buffer:
-                doc = DocxDocument(docx_buffer)
-                paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
-                content = "\n\n".join(paragraphs)
-        
-        # Excelファイル
-        elif file_extension in [".xlsx", ".xls"]:
-            file_type = "excel"
-            file_bytes = await file.read()
-            excel_file = pd.ExcelFile(io.BytesIO(file_bytes))
-            sheets_content = []
-            
-            for sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(excel_file, sheet_name=sheet_name)
-                sheet_text = f"=== シート: {sheet_name} ===\n"
-                sheet_text += f"行数: {len(df)}, 列数: {len(df.columns)}\n\n"
-                sheet_text += df.to_string(index=False)
-                sheets_content.append(sheet_text)
-            
-            content = "\n\n".join(sheets_content)
-        
-        # CSVファイル
-        elif file_extension == ".csv":
-            file_type = "csv"
-            file_bytes = await file.read()
-            
-            # エンコーディングを試す
-            for encoding in ['utf-8', 'shift_jis', 'cp932']:
-                try:
-                    text = file_bytes.decode(encoding)
-                    df = pd.read_csv(io.StringIO(text))
-                    content = f"行数: {len(df)}, 列数: {len(df.columns)}\n\n"
-                    content += df.to_string(index=False)
-                    break
-                except (UnicodeDecodeError, pd.errors.ParserError):
-                    continue
-        
-        # テキストファイル
-        else:
-            file_bytes = await file.read()
-            for encoding in ['utf-8', 'shift_jis', 'cp932', 'latin-1']:
-                try:
-                    content = file_bytes.decode(encoding)
-                    break
-                except UnicodeDecodeError:
-                    continue
-    
+        document = await read_document(file)
     except Exception as e:
         return f"error: {str(e)}", "error"
-    
-    return content, file_type
+    with stage("read_file.to_string", document.file_type):
+        return document.text, document.file_type
 
 
 # API エンドポイント
@@ -167,209 +345,421 @@ async def read_file_content(file: UploadFile) -> tuple[str, str]:
 async def root():
     return {"message": "AIGenPrompts4U API", "version": "1.0.0"}
 
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """起動完了・依存先の確認 (ロードバランサーのヘルスチェック用。準備中は503)"""
+    checks = await asyncio.to_thread(readiness_checks)
+    ready = all(checks.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "starting", "pid": os.getpid(), "checks": checks},
+        status_code=200 if ready else 503,
+    )
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus形式のメトリクス"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+# /api/categories の応答 (カタログのスナップショットが変わったときだけ作り直す)
+_categories_response: Optional[Tuple[CatalogSnapshot, Dict]] = None
+
 @app.get("/api/categories")
 async def get_categories():
-    """利用可能なカテゴリ一覧を取得"""
-    file_map = {
-        "industry": "industry.json",
-        "idea": "idea.json",
-        "engineer": "engineer.json",
-        "management": "management.json",
-        "sales": "sales.json",
-        "summary": "summary.json",
-        "email": "email.json",
-        "negotiation": "negotiation.json",
-        "meeting": "meeting.json",
-        "consultant": "consultant.json",
-        "medical": "medical.json",
-        "investment": "investment.json",
-        "dating": "dating.json",
-        "job_interview": "job_interview.json",
-        "education": "education.json",
-        "legal": "legal.json",
-        "sns_content": "sns_content.json",
-        "startup": "startup.json",
-        "programmer": "programmer.json",
-        "python_engineer": "python_engineer.json",
-        "ai_engineer": "ai_engineer.json",
-        "chatgpt_api": "chatgpt_api.json",
-        "lawyer": "lawyer.json",
-        "it_lawyer": "it_lawyer.json",
-        "ceo": "ceo.json",
-        "stock_trader": "stock_trader.json",
-        "finance": "finance.json",
-        "qol": "qol.json"
-    }
-    
-    category_names = {
-        "industry": "業界分析・市場調査用",
-        "idea": "アイデア創出用",
-        "management": "マネジメント用",
-        "sales": "営業・セールス用",
-        "summary": "要約・まとめ用",
-        "engineer": "エンジニア用",
-        "email": "メール返信用",
-        "negotiation": "価格交渉用",
-        "meeting": "会議準備用",
-        "consultant": "コンサルティング用",
-        "medical": "医療・健康相談用",
-        "investment": "投資・資産運用用",
-        "dating": "恋愛・デート用",
-        "job_interview": "面接・転職対策用",
-        "education": "教育・学習支援用",
-        "legal": "法律・契約書用",
-        "sns_content": "SNS・コンテンツ作成用",
-        "startup": "起業・スタートアップ用",
-        "programmer": "プログラマー実践用",
-        "python_engineer": "Pythonエンジニア専門用",
-        "ai_engineer": "AIエンジニア専門用",
-        "chatgpt_api": "ChatGPT API活用専門用",
-        "lawyer": "法律家・弁護士実践用",
-        "it_lawyer": "IT法務・テック法律家専門用",
-        "ceo": "経営者サポート・エグゼクティブ用",
-        "stock_trader": "日本株トレーダー・投資家用",
-        "finance": "金融業界・銀行実践用",
-        "qol": "QOL向上・ライフスタイル改善用"
-    }
-    
+    """利用可能なカテゴリ一覧と統計 (件数・文字数/トークン数の分布・推奨添付資料の種類数) を取得"""
+    global _categories_response
+    snapshot = catalog.snapshot
+    if _categories_response is None or _categories_response[0] is not snapshot:
+        CATALOG_CACHE.inc(cache="categories", result="miss")
+        _categories_response = (snapshot, build_categories_response(snapshot))
+    else:
+        CATALOG_CACHE.inc(cache="categories", result="hit")
+    return _categories_response[1]
+
+def build_categories_response(snapshot: CatalogSnapshot) -> Dict:
+    """カテゴリ一覧 (キー・ファイル名はカテゴリファイルのパス、表示名はファイルの category から作る)"""
+    stats = catalog.stats()
     return {
         "categories": [
-            {"key": key, "name": category_names.get(key, key), "file": file}
-            for key, file in file_map.items()
-        ]
+            {
+                "key": key,
+                "name": entry.data.get("category") or key,
+                "file": f"{key}.json",
+                "count": entry.count,
+                "stats": entry.stats,
+            }
+            for key, entry in snapshot.entries.items()
+        ],
+        "stats": {name: value for name, value in stats.items() if name != "categories"},
     }
 
 @app.get("/api/prompts/{category}")
 async def get_prompts(category: str):
     """指定カテゴリのプロンプト一覧を取得"""
-    file_path = PROMPTS_DIR / f"{category}.json"
+    data = catalog.get(category)
     
-    if not file_path.exists():
+    if data is None:
+        CATALOG_LOOKUPS.inc(result="not_found")
         raise HTTPException(status_code=404, detail="Category not found")
     
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    CATALOG_LOOKUPS.inc(result="found")
     
     return data
 
-@app.post("/api/chat")
-async def chat(request: ChatRequest):
-    """チャット応答を生成（ストリーミング）"""
-    if not openai_client.api_key:
-        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-    
-    messages = []
+@app.get("/api/stats")
+async def get_stats(days: Optional[int] = None, top: int = 20):
+    """プロンプトの利用状況 (表示・会話開始・発言の回数と人気度。days で直近の日数に絞る)"""
+    stats = await asyncio.to_thread(usage_tracker.stats, days, max(1, min(top, 200)))
+    for item in stats["top"]:
+        found = catalog.find(item["uid"])
+        if found:
+            item["category"], prompt = found
+            item["title"] = prompt.get("title")
+    return stats
+
+@app.post("/api/recommend")
+async def recommend_prompts(request: RecommendRequest):
+    """タスクの説明から近いプロンプトを推薦"""
+    top_k = max(1, min(request.top_k, 50))
+    recommender = await asyncio.to_thread(get_recommender)
+    results = await asyncio.to_thread(recommender.recommend, request.query, top_k, request.category)
+    # 一覧ではなく個別に提示したプロンプトだけを「表示」として数える
+    usage_tracker.record_many((prompt_uid(item["category"], item["prompt"].get("id")) for item in results), "view")
+    return {"query": request.query, "results": results}
+
+def route_chat(messages: List[Dict[str, str]], has_attachments: bool, category: Optional[str] = None) -> List[str]:
+    """リクエストの大きさ・添付資料の有無・カテゴリから、試す順のモデル一覧を決める"""
+    input_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    return model_router.candidates("chat", input_tokens, has_attachments, category)
+
+def stream_upstream(messages: List[Dict[str, str]], models: List[str]):
+    """
+    上流APIのストリームからSSEのイベントを順に返す（集約用のスレッド上で実行）
+    models を順に試し、最初に応答したモデル名を {"model": ...} として本文より先に返す
+    """
+    start = time.perf_counter()
+    first_token_at = None
+    chunk_count = 0
+    outcome = "ok"
+    CHAT_STREAMS_IN_FLIGHT.inc()
+    stream = None
+    try:
+        client = get_openai_client()
+        if client is None:
+            raise RuntimeError("OpenAI API key not configured")
+        stream = model_router.stream(
+            lambda model: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            models,
+            is_token=lambda chunk: bool(chunk.choices and chunk.choices[0].delta.content),
+        )
+        
+        model_sent = False
+        for chunk in stream:
+            if not model_sent:
+                model_sent = True
+                yield {"model": stream.model}
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    CHAT_TTFT.observe(first_token_at - start)
+                chunk_count += 1
+                yield {"content": chunk.choices[0].delta.content}
+            
+            # 最後のチャンクに付く usage (キャッシュ済みトークン数を含む)
+            usage = usage_summary(getattr(chunk, "usage", None))
+            if usage:
+                CHAT_PROMPT_TOKENS.inc(usage["cached_tokens"], kind="cached")
+                CHAT_PROMPT_TOKENS.inc(usage["prompt_tokens"] - usage["cached_tokens"], kind="uncached")
+                CHAT_COMPLETION_TOKENS.inc(usage["completion_tokens"])
+                yield {"usage": usage}
     
-    # システムプロンプトを追加
-    if request.system_prompt:
-        messages.append({"role": "system", "content": request.system_prompt})
+    except GeneratorExit:
+        outcome = "cancelled"
+        raise
     
-    # ユーザーメッセージを追加
-    for msg in request.messages:
-        messages.append({"role": msg.role, "content": msg.content})
+    except Exception:
+        outcome = "error"
+        raise
     
+    finally:
+        if stream is not None:
+            stream.close()
+        end = time.perf_counter()
+        CHAT_STREAMS_IN_FLIGHT.dec()
+        CHAT_UPSTREAM_TOTAL.observe(end - start, outcome=outcome)
+        if first_token_at is not None and end > first_token_at:
+            CHAT_TOKENS_PER_SECOND.observe(chunk_count / (end - first_token_at))
+
+async def chat_events(messages: List[Dict[str, str]], models: List[str], on_complete=None,
+                      coalesce: bool = CHAT_COALESCE):
+    """
+    上流の応答をSSEの行として返す（同一内容の同時リクエストは1本の上流ストリームに集約）
+    models は試す順のモデル一覧 (route_chat)
+    on_complete は応答が最後まで届いた場合に本文全体を引数として呼ばれる
+    """
+    key = request_key(models[0], messages) if coalesce else uuid.uuid4().hex
+    flight, role = chat_coalescer.join(key, lambda: stream_upstream(messages, models))
+    CHAT_COALESCED.inc(result=role)
+    parts = []
+    async for event in flight.replay():
+        if "content" in event:
+            parts.append(event["content"])
+        yield f"data: {json.dumps(event)}\n\n"
+    if flight.error:
+        yield f"data: {json.dumps({'error': flight.error})}\n\n"
+    else:
+        if on_complete is not None:
+            on_complete("".join(parts))
+        yield "data: [DONE]\n\n"
+
+def stream_chat(messages: List[Dict[str, str]], models: List[str], on_complete=None) -> StreamingResponse:
+    return StreamingResponse(chat_events(messages, models, on_complete), media_type="text/event-stream")
+
+def complete_upstream(messages: List[Dict[str, str]], task: str = "chat") -> str:
+    """ストリーミングなしで1回呼び出し、応答の本文を返す (マップリデュースの各チャンク用)"""
+    client = get_openai_client()
+    if client is None:
+        raise RuntimeError("OpenAI API key not configured")
+    input_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    response = model_router.call(
+        lambda model: client.chat.completions.create(model=model, messages=messages),
+        model_router.candidates(task, input_tokens, True),
+    )
+    usage = usage_summary(response.usage)
+    if usage:
+        CHAT_PROMPT_TOKENS.inc(usage["cached_tokens"], kind="cached")
+        CHAT_PROMPT_TOKENS.inc(usage["prompt_tokens"] - usage["cached_tokens"], kind="uncached")
+        CHAT_COMPLETION_TOKENS.inc(usage["completion_tokens"])
+    return response.choices[0].message.content or ""
+
+def stream_map_reduce(system_prompt: Optional[str], history: List[Dict[str, str]], question: str,
+                      documents: List[Dict]) -> StreamingResponse:
+    """
+    資料を分割して並列に読み (map)、抜き出した内容から回答する (reduce)
+    進捗は {"progress": {"stage", "done", "total"}} として、回答は通常のチャットと同じ形式で返す
+    """
     async def generate():
+        notes: List[Dict] = []
         try:
-            stream = openai_client.chat.completions.create(
-                model="gpt-5",
-                messages=messages,
-                stream=True
-            )
-            
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield f"data: {json.dumps({'content': chunk.choices[0].delta.content})}\n\n"
-            
-            yield "data: [DONE]\n\n"
-        
+            with stage("chat.map_reduce"):
+                async for event in map_reduce_events(
+                    lambda messages: complete_upstream(messages, task="map"),
+                    system_prompt, question, documents,
+                    chunk_tokens=MAP_REDUCE_CHUNK_TOKENS,
+                    overlap_tokens=MAP_REDUCE_OVERLAP_TOKENS,
+                    concurrency=MAP_REDUCE_CONCURRENCY,
+                    reduce_tokens=MAP_REDUCE_REDUCE_TOKENS,
+                ):
+                    if "notes" in event:
+                        notes = event["notes"]
+                    else:
+                        yield f"data: {json.dumps(event)}\n\n"
         except Exception as e:
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            return
+        
+        yield f"data: {json.dumps({'progress': {'stage': 'reduce', 'done': 0, 'total': 1}})}\n\n"
+        messages = reduce_messages(system_prompt, history, question, notes)
+        async for line in chat_events(messages, route_chat(messages, False), coalesce=False):
+            yield line
     
     return StreamingResponse(generate(), media_type="text/event-stream")
 
-@app.post("/api/upload")
-async def upload_file(file: UploadFile = File(...)):
-    """ファイルをアップロードして内容を取得"""
-    content, file_type = await read_file_content(file)
+def retrieve_for(key: str, attachments: List[Dict], query: str):
+    """(会話に固定する資料, 今回の発言に添える抜粋) を返す"""
+    with stage("chat.retrieve"):
+        return retrieve_attachments(chunk_indexes, key, attachments, query, RAG_TOP_K, RAG_MIN_TOKENS)
+
+def _to_attachments(attachments: List[ChatAttachment]) -> List[Dict]:
+    return [make_attachment(a.name, a.file_type, a.content, a.truncated) for a in attachments]
+
+@app.post("/api/chat")
+async def chat(request: ChatRequest):
+    """チャット応答を生成（ストリーミング）"""
+    if get_openai_client() is None:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    track_chat(request.system_prompt, first_turn=not any(m.role == "assistant" for m in request.messages))
+    
+    if request.map_reduce and request.attachments and request.messages:
+        # 添付資料を切り詰めず、分割して読んでから回答する
+        history = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        return stream_map_reduce(
+            request.system_prompt,
+            history[:-1],
+            history[-1]["content"],
+            [{"name": a.name, "content": a.content} for a in request.attachments],
+        )
+    
+    history = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    attachments = _to_attachments(request.attachments)
+    # 大きな資料は同じ資料の組み合わせごとに索引し、最後の発言に関係する抜粋だけを送る
+    key = "chat:" + hashlib.sha1("".join(a["digest"] for a in attachments).encode()).hexdigest()
+    pinned, context = await asyncio.to_thread(
+        retrieve_for, key, attachments, history[-1]["content"] if history else ""
+    )
+    
+    with stage("chat.build_messages"):
+        # システムプロンプト → 固定添付資料 → 会話履歴 (+ 抜粋) の順 (先頭ほど変わらない)
+        messages = build_messages(request.system_prompt, pinned, history, context=context)
+    
+    return stream_chat(messages, route_chat(messages, bool(request.attachments), request.category))
+
+@app.post("/api/sessions")
+async def create_session(request: CreateSessionRequest):
+    """会話セッションを作成（以降は /api/sessions/{id}/chat に新しい発言だけを送る）"""
+    session = session_store.create(
+        request.system_prompt,
+        _to_attachments(request.attachments),
+        [{"role": m.role, "content": m.content} for m in request.messages],
+        request.category,
+    )
+    return {"session_id": session.id, "idle_ttl": session_store.idle_ttl}
+
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: str):
+    """セッションの内容を取得"""
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return session.to_dict()
+
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """セッションを削除"""
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    chunk_indexes.discard("session:" + session_id)
+    return {"message": "Session deleted successfully"}
+
+@app.post("/api/sessions/{session_id}/chat")
+async def session_chat(session_id: str, request: SessionChatRequest):
+    """セッションの履歴に続けてチャット応答を生成（ストリーミング）"""
+    if get_openai_client() is None:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    
+    track_chat(session.system_prompt, first_turn=not session.messages)
+    
+    # 新しい添付資料は既存の後ろに固定する (先頭側のバイト列は変えない)
+    new_attachments = []
+    for attachment in _to_attachments(request.attachments):
+        if pin_attachment(session.attachments + new_attachments, attachment):
+            new_attachments.append(attachment)
+    pinned, context = await asyncio.to_thread(
+        retrieve_for, "session:" + session.id, session.attachments + new_attachments, request.content
+    )
     
-    if file_type == "error":
-        raise HTTPException(status_code=400, detail=content)
+    with stage("chat.build_messages"):
+        user_message = {"role": "user", "content": request.content}
+        messages = build_messages(session.system_prompt, pinned, session.messages, user_message, context=context)
     
-    # コンテンツを切り詰める
-    truncated_content, was_truncated = truncate_content(content, max_tokens=15000)
+    def append_turn(reply: str):
+        # 応答が最後まで届いた場合のみ、発言と応答をまとめて履歴に追加する
+        session_store.update(
+            session,
+            [user_message, {"role": "assistant", "content": reply}],
+            new_attachments,
+        )
+    
+    models = route_chat(messages, bool(session.attachments or new_attachments), request.category or session.category)
+    return stream_chat(messages, models, on_complete=append_turn)
+
+@app.post("/api/upload")
+async def upload_file(file: UploadFile = File(...), full: bool = False):
+    """
+    ファイルをアップロードして内容を取得
+    full=true ならマップリデュース用に MAP_REDUCE_MAX_TOKENS まで切り詰めずに返す
+    """
+    max_tokens = MAP_REDUCE_MAX_TOKENS if full else 15000
+    try:
+        document = await read_document(file, max_tokens=max_tokens)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"error: {str(e)}")
+    
+    # ページ・シートなどの単位の境界で切り詰める
+    with stage("truncate_content", document.file_type):
+        truncated_content, was_truncated = document.truncate(max_tokens)
     
     return {
         "filename": file.filename,
-        "file_type": file_type,
+        "file_type": document.file_type,
         "content": truncated_content,
         "truncated": was_truncated,
-        "size": len(content)
+        "size": document.chars
     }
 
 @app.get("/api/chat-history")
 async def get_chat_history():
     """チャット履歴一覧を取得"""
-    histories = []
-    
-    for filepath in sorted(CHAT_HISTORY_DIR.glob("*.json"), reverse=True):
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                histories.append({
-                    "filename": filepath.name,
-                    "title": data.get("title", "無題"),
-                    "timestamp": data.get("timestamp", ""),
-                    "message_count": len(data.get("messages", []))
-                })
-        except Exception:
-            continue
-    
+    histories = [
+        {key: value for key, value in item.items() if key != "filepath"}
+        for item in chat_store.list()
+    ]
     return {"histories": histories}
 
+@app.get("/api/chat-history/search")
+async def search_chat_history(q: str, limit: int = 20):
+    """保存済みの会話を全文検索（会話ごとに最も関連するスニペットを1件）"""
+    limit = max(1, min(limit, 100))
+    with stage("chat_history.search"):
+        results = await asyncio.to_thread(chat_search.search, q, limit)
+    return {"query": q, "results": results}
+
 @app.get("/api/chat-history/{filename}")
 async def get_chat_history_detail(filename: str):
     """特定のチャット履歴を取得"""
-    filepath = CHAT_HISTORY_DIR / filename
+    data = chat_store.load(filename)
     
-    if not filepath.exists():
+    if data is None:
         raise HTTPException(status_code=404, detail="History not found")
     
-    with open(filepath, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
     return data
 
 @app.post("/api/chat-history")
 async def save_chat_history(request: SaveChatRequest):
-    """チャット履歴を保存"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{request.title}_{timestamp}.json"
-    filepath = CHAT_HISTORY_DIR / filename
+    """チャット履歴を保存（conversation_id を指定すると同じ会話に差分だけ追記）"""
+    conversation_id = request.conversation_id or new_conversation_id()
+    try:
+        filepath = chat_store.save(
+            conversation_id,
+            [{"role": m.role, "content": m.content} for m in request.messages],
+            request.title,
+            request.selected_prompt,
+            rename=True,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    history_data = {
-        "title": request.title,
-        "timestamp": timestamp,
-        "messages": [{"role": m.role, "content": m.content} for m in request.messages],
-        "selected_prompt": request.selected_prompt
+    return {
+        "filename": filepath.name,
+        "conversation_id": conversation_id,
+        "message": "Chat history saved successfully"
     }
-    
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(history_data, f, ensure_ascii=False, indent=2)
-    
-    return {"filename": filename, "message": "Chat history saved successfully"}
 
 @app.delete("/api/chat-history/{filename}")
 async def delete_chat_history(filename: str):
     """チャット履歴を削除"""
-    filepath = CHAT_HISTORY_DIR / filename
-    
-    if not filepath.exists():
+    if not chat_store.delete(filename):
         raise HTTPException(status_code=404, detail="History not found")
     
-    filepath.unlink()
     return {"message": "Chat history deleted successfully"}
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # WEB_CONCURRENCY>1 ならワーカープロセスを複数起動する (本番は gunicorn.conf.py を推奨)
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        # ワーカー間で会話セッションを共有するためSQLiteに保存する
+        os.environ.setdefault("SESSION_DB", str(BUILD_DIR / "sessions.sqlite3"))
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
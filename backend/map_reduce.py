@@ -0,0 +1,163 @@
+"""
+コンテキストに収まらない資料のマップリデュース処理
+
+資料全体をチャンクに分け (doc_chunker)、各チャンクに選択中のシステムプロンプトと質問を当てて
+関係する内容を抜き出し (map)、抜き出した内容を1回の呼び出しで統合して回答します (reduce)。
+
+- map は上限つきの並列数で同時に呼び出し、1件終わるごとに進捗を返す
+- 抜き出した内容が reduce の上限を超える場合は、上限に収まるまで抜き出し同士をまとめ直す
+- 上流の呼び出しは complete(messages) として受け取る (モデル選択・リトライは呼び出し側)
+"""
+
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from doc_chunker import chunk_text, estimate_tokens
+
+
+MAP_INSTRUCTION = (
+    "あなたは長い資料を分割して読んでいます。次に示すのは資料の一部だけです。"
+    "ユーザーの依頼に関係する内容を、根拠となるページ・条項・シート名を添えて箇条書きで抜き出してください。"
+    "この部分に関係する内容がなければ「該当なし」とだけ答えてください。"
+)
+COMBINE_INSTRUCTION = (
+    "次に示すのは長い資料の各部分から抜き出した内容です。"
+    "ユーザーの依頼に関係する内容を、根拠となるページ・条項を残したまま重複をまとめて箇条書きにしてください。"
+)
+REDUCE_INSTRUCTION = (
+    "次に示すのは長い資料を分割して読み、各部分から抜き出した内容です (資料の先頭から順)。"
+    "これらだけを根拠にユーザーの依頼に答えてください。重複はまとめ、部分間で矛盾があれば指摘してください。"
+)
+NOT_FOUND = "該当なし"
+
+# 同期の呼び出し: messages を受け取り、応答の本文を返す
+Complete = Callable[[List[Dict[str, str]]], str]
+
+
+def _system(system_prompt: Optional[str], instruction: str) -> List[Dict[str, str]]:
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "system", "content": instruction})
+    return messages
+
+
+def document_chunks(documents: List[Dict], max_tokens: int, overlap_tokens: int) -> List[Dict]:
+    """添付資料 ({"name", "content"}) ごとに分割し、資料名を付けたチャンクの一覧を返す"""
+    chunks = []
+    for document in documents:
+        for chunk in chunk_text(document["content"], max_tokens, overlap_tokens):
+            chunk["name"] = document["name"]
+            chunks.append(chunk)
+    return chunks
+
+
+def map_messages(system_prompt: Optional[str], question: str, chunk: Dict, total: int) -> List[Dict[str, str]]:
+    return _system(system_prompt, MAP_INSTRUCTION) + [{
+        "role": "user",
+        "content": (
+            f"資料「{chunk['name']}」の一部 ({chunk['position']}/{total})\n\n{chunk['text']}\n\n"
+            f"---\nユーザーの依頼: {question}"
+        ),
+    }]
+
+
+def _source(note: Dict) -> str:
+    if note["first"] == note["last"]:
+        return note["first"]
+    return f"{note['first']} 〜 {note['last']}"
+
+
+def _format_notes(notes: List[Dict]) -> str:
+    return "\n\n".join(f"### {_source(note)}\n{note['text']}" for note in notes)
+
+
+def reduce_messages(system_prompt: Optional[str], history: List[Dict[str, str]], question: str,
+                    notes: List[Dict]) -> List[Dict[str, str]]:
+    return _system(system_prompt, REDUCE_INSTRUCTION) + [
+        {"role": m["role"], "content": m["content"]} for m in history
+    ] + [{
+        "role": "user",
+        "content": f"{_format_notes(notes)}\n\n---\nユーザーの依頼: {question}",
+    }]
+
+
+async def map_reduce_events(
+    complete: Complete,
+    system_prompt: Optional[str],
+    question: str,
+    documents: List[Dict],
+    chunk_tokens: int = 4000,
+    overlap_tokens: int = 200,
+    concurrency: int = 4,
+    reduce_tokens: int = 12000,
+) -> AsyncIterator[Dict]:
+    """
+    map と、reduce に収まるまでのまとめ直しを行い、進捗イベントを順に返す
+      {"progress": {"stage": "map", "done": 3, "total": 12}}
+      {"notes": [...]}  最後に1回。reduce_messages に渡す抜き出し内容
+    """
+    chunks = document_chunks(documents, chunk_tokens, overlap_tokens)
+    total = len(chunks)
+    for position, chunk in enumerate(chunks, 1):
+        chunk["position"] = position
+    yield {"progress": {"stage": "map", "done": 0, "total": total}}
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(messages: List[Dict[str, str]]) -> str:
+        async with semaphore:
+            return await asyncio.to_thread(complete, messages)
+
+    async def map_one(chunk: Dict) -> Dict:
+        text = await run(map_messages(system_prompt, question, chunk, total))
+        # 「--- ページ 3 ---」などの見出しから記号を除いて出典に使う
+        label = f" {chunk['label'].strip('-= ')}" if chunk["label"] else ""
+        source = f"{chunk['name']}{label} ({chunk['position']}/{total})"
+        return {"position": chunk["position"], "first": source, "last": source, "text": text.strip()}
+
+    notes: List[Dict] = []
+    tasks = [asyncio.ensure_future(map_one(chunk)) for chunk in chunks]
+    try:
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            notes.append(await task)
+            yield {"progress": {"stage": "map", "done": done, "total": total}}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    notes.sort(key=lambda note: note["position"])
+    notes = [note for note in notes if note["text"] and not note["text"].startswith(NOT_FOUND)]
+
+    # 抜き出しが多すぎる場合は、上限に収まるまで隣り合うもの同士をまとめる
+    while len(notes) > 1 and estimate_tokens(_format_notes(notes)) > reduce_tokens:
+        groups: List[List[Dict]] = [[]]
+        for note in notes:
+            if groups[-1] and estimate_tokens(_format_notes(groups[-1] + [note])) > reduce_tokens // 2:
+                groups.append([])
+            groups[-1].append(note)
+        if len(groups) == len(notes):
+            # 1件ずつでも大きい場合はそれ以上まとめられない
+            break
+        yield {"progress": {"stage": "combine", "done": 0, "total": len(groups)}}
+
+        async def combine(group: List[Dict]) -> Dict:
+            messages = _system(system_prompt, COMBINE_INSTRUCTION) + [{
+                "role": "user", "content": f"{_format_notes(group)}\n\n---\nユーザーの依頼: {question}",
+            }]
+            text = await run(messages)
+            return {"position": group[0]["position"], "first": group[0]["first"], "last": group[-1]["last"],
+                    "text": text.strip()}
+
+        tasks = [asyncio.ensure_future(combine(group)) for group in groups]
+        try:
+            combined = []
+            for done, task in enumerate(asyncio.as_completed(tasks), 1):
+                combined.append(await task)
+                yield {"progress": {"stage": "combine", "done": done, "total": len(groups)}}
+        finally:
+            for task in tasks:
+                task.cancel()
+        notes = sorted(combined, key=lambda note: note["position"])
+
+    yield {"notes": notes}
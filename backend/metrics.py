@@ -0,0 +1,235 @@
+"""
+軽量なPrometheus形式メトリクス
+
+外部ライブラリに依存せず、カウンタ・ゲージ・ヒストグラムをプロセス内に保持し、
+/metrics でテキスト形式(Prometheus exposition format 0.0.4)として出力します。
+1回の記録はロック取得とリスト更新のみなので、本番で常時有効にしても負荷は小さいです。
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# 秒単位のレイテンシ用デフォルトバケット
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track(self, **labels) -> Iterator[None]:
+        """with ブロックの間だけ +1 する(処理中の件数など)"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [バケットごとの件数..., 合計, 件数]
+        self._series: Dict[LabelKey, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """with ブロックの経過時間を記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', repr(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', '+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    """メトリクスの登録とテキスト出力"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# HTTP
+REQUEST_LATENCY = registry.histogram(
+    "http_request_duration_seconds", "HTTPリクエストの処理時間(レスポンスヘッダ送出まで)", ("method", "route", "status"))
+REQUESTS_IN_FLIGHT = registry.gauge(
+    "http_requests_in_flight", "処理中のHTTPリクエスト数")
+
+# 処理ステージ
+STAGE_LATENCY = registry.histogram(
+    "stage_duration_seconds", "処理ステージごとの所要時間", ("stage", "format"))
+
+# チャット
+CHAT_TTFT = registry.histogram(
+    "chat_time_to_first_token_seconds", "上流APIへのリクエストから最初のトークンまでの時間")
+CHAT_UPSTREAM_TOTAL = registry.histogram(
+    "chat_upstream_duration_seconds", "上流APIのストリーム全体の所要時間", ("outcome",),
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0))
+CHAT_TOKENS_PER_SECOND = registry.histogram(
+    "chat_tokens_per_second", "最初のトークン以降の生成速度(チャンク数/秒)",
+    buckets=(1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400))
+CHAT_STREAMS_IN_FLIGHT = registry.gauge(
+    "chat_streams_in_flight", "配信中のチャットストリーム数")
+CHAT_PROMPT_TOKENS = registry.counter(
+    "chat_prompt_tokens_total", "上流APIの入力トークン数(cached: プロンプトキャッシュに載った分 / uncached: それ以外)", ("kind",))
+CHAT_COMPLETION_TOKENS = registry.counter(
+    "chat_completion_tokens_total", "上流APIの出力トークン数")
+CHAT_MODEL_REQUESTS = registry.counter(
+    "chat_model_requests_total",
+    "モデルごとの上流呼び出し結果(ok / error / hedge_lost: ヘッジで並行して送り、もう一方が先に応答した)",
+    ("model", "outcome"))
+CHAT_MODEL_TTFT_EWMA = registry.gauge(
+    "chat_model_ttft_ewma_seconds", "モデルごとの最初のトークンまでの時間の指数移動平均", ("model",))
+CHAT_MODEL_ERROR_RATE = registry.gauge(
+    "chat_model_error_rate", "モデルごとのエラー率の指数移動平均", ("model",))
+CHAT_COALESCED = registry.counter(
+    "chat_coalesced_requests_total",
+    "チャットリクエストの集約結果(leader: 上流を呼んだ / follower: 進行中のストリームに相乗り / cache: 完了済みの応答を再利用)",
+    ("result",))
+
+# アドミッション制御
+ADMISSION_ACTIVE = registry.gauge(
+    "admission_active", "プールごとの実行中リクエスト数", ("pool",))
+ADMISSION_QUEUE_WAIT = registry.histogram(
+    "admission_queue_wait_seconds", "プールの空きを待った時間", ("pool",))
+ADMISSION_REJECTED = registry.counter(
+    "admission_rejected_total",
+    "429で断ったリクエスト数(rate_limit: クライアントごとの頻度超過 / queue_full: 待ち行列が満杯 / timeout: 待ち時間切れ)",
+    ("pool", "reason"))
+
+# ファイル抽出
+EXTRACT_CACHE = registry.counter(
+    "extract_cache_total",
+    "抽出結果キャッシュの利用結果(hit: 保存済みの結果を使った / resume: 続きだけ読み足した / miss: 解析した)",
+    ("result",))
+
+# カタログ
+CATALOG_LOOKUPS = registry.counter(
+    "catalog_lookups_total", "カテゴリ参照の結果(found: 該当あり / not_found: 該当なし)", ("result",))
+CATALOG_CACHE = registry.counter(
+    "catalog_cache_total",
+    "スナップショットから作った応答の再利用(hit: 作成済みの応答を返した / miss: スナップショットが変わって作り直した)",
+    ("cache", "result"))
+CATALOG_RELOADS = registry.counter(
+    "catalog_reloads_total", "監視スレッドによるカテゴリの差し替え回数")
+
+
+def stage(name: str, fmt: str = ""):
+    """処理ステージの所要時間を記録するコンテキストマネージャ"""
+    return STAGE_LATENCY.time(stage=name, format=fmt)
@@ -0,0 +1,226 @@
+"""
+サーバー側で保持する会話セッション
+
+クライアントが毎ターン全履歴を送り直さなくて済むよう、システムプロンプト・固定添付資料・
+会話履歴をセッションIDに紐づけて保持します。
+
+- メモリ上は件数上限付きのLRU (上限を超えたら最後に使われたのが古いものから追い出す)
+- 最終利用から idle_ttl 秒経過したセッションは期限切れとして削除
+- db_path を指定するとSQLiteにも保存し、LRUから追い出された後やプロセス再起動後も読み戻せる
+- 複数ワーカーで動かす場合は db_path が必須。SQLite(WALモード)を正として毎回読み直すので、
+  どのワーカーにリクエストが振り分けられても同じ会話を続けられる
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+class Session:
+    """1つの会話"""
+
+    def __init__(self, session_id: str, system_prompt: Optional[str] = None,
+                 attachments: Optional[List[Dict]] = None, messages: Optional[List[Dict]] = None,
+                 created_at: Optional[float] = None, last_active: Optional[float] = None,
+                 category: Optional[str] = None):
+        now = time.time()
+        self.id = session_id
+        self.system_prompt = system_prompt
+        self.category = category  # プロンプトのカテゴリキー (モデルの振り分けに使う)
+        self.attachments: List[Dict] = attachments or []
+        self.messages: List[Dict] = messages or []
+        self.created_at = created_at or now
+        self.last_active = last_active or now
+
+    def to_dict(self) -> Dict:
+        return {
+            "session_id": self.id,
+            "system_prompt": self.system_prompt,
+            "category": self.category,
+            "attachments": self.attachments,
+            "messages": self.messages,
+            "created_at": self.created_at,
+            "last_active": self.last_active,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Session":
+        return cls(
+            data["session_id"], data.get("system_prompt"), data.get("attachments"),
+            data.get("messages"), data.get("created_at"), data.get("last_active"), data.get("category"),
+        )
+
+
+class SessionStore:
+    """件数上限・アイドル期限付きのセッション置き場 (SQLite永続化は任意)"""
+
+    def __init__(self, max_sessions: int = 1000, idle_ttl: float = 3600.0, db_path: Optional[str] = None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = 0
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, last_active REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions(last_active)")
+            self._db.commit()
+
+    @property
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """プロセスごとのSQLite接続 (fork後の子プロセスでは親の接続を使わず開き直す)"""
+        if not self.db_path:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return self.idle_ttl > 0 and now - session.last_active > self.idle_ttl
+
+    def _save(self, session: Session):
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, last_active) VALUES (?, ?, ?)",
+                (session.id, json.dumps(session.to_dict(), ensure_ascii=False), session.last_active),
+            )
+            self._db.commit()
+
+    def _remember(self, session: Session):
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_sessions:
+            # SQLiteがあればディスク上には残る
+            self._sessions.popitem(last=False)
+
+    def create(self, system_prompt: Optional[str] = None, attachments: Optional[List[Dict]] = None,
+               messages: Optional[List[Dict]] = None, category: Optional[str] = None) -> Session:
+        session = Session(uuid.uuid4().hex, system_prompt, attachments, messages, category=category)
+        with self._lock:
+            self._expire_locked(time.time())
+            self._remember(session)
+            self._save(session)
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """セッションを取得し、最終利用時刻を更新する (期限切れ・存在しない場合は None)"""
+        now = time.time()
+        with self._lock:
+            if self._db is not None:
+                # 他のワーカーが更新している可能性があるため、SQLiteを正として読み直す
+                session = self._load_locked(session_id)
+            else:
+                session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self._expired(session, now):
+                self._delete_locked(session_id)
+                return None
+            session.last_active = now
+            self._remember(session)
+            if self._db is not None:
+                # 使われている間に期限切れの掃除で消されないよう、最終利用時刻も書き戻す
+                self._db.execute("UPDATE sessions SET last_active = ? WHERE id = ?", (now, session_id))
+                self._db.commit()
+        return session
+
+    def _load_locked(self, session_id: str) -> Optional[Session]:
+        row = self._db.execute("SELECT data, last_active FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        session = Session.from_dict(json.loads(row[0]))
+        # get() は last_active 列だけを更新するので、新しいほうを使う
+        session.last_active = max(session.last_active, row[1])
+        return session
+
+    def update(self, session: Session, messages: Optional[List[Dict]] = None,
+               attachments: Optional[List[Dict]] = None):
+        """
+        メッセージ・添付資料を末尾に追加して保存する
+        SQLiteを使う場合は書き込みトランザクションの中で最新の行を読み直してから追加するので、
+        別のワーカーが同じセッションに並行して追加したターンを上書きしない
+        """
+        with self._lock:
+            if self._db is None:
+                self._extend(session, messages, attachments)
+                self._remember(session)
+                return
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                latest = self._load_locked(session.id) or session
+                self._extend(latest, messages, attachments)
+                self._save(latest)
+            except BaseException:
+                self._db.rollback()
+                raise
+            # 呼び出し側が持っているオブジェクトも最新の内容にそろえる
+            session.messages = latest.messages
+            session.attachments = latest.attachments
+            session.last_active = latest.last_active
+            self._remember(session)
+
+    @staticmethod
+    def _extend(session: Session, messages: Optional[List[Dict]], attachments: Optional[List[Dict]]):
+        if messages:
+            session.messages.extend(messages)
+        for attachment in attachments or []:
+            if attachment not in session.attachments:
+                session.attachments.append(attachment)
+        session.last_active = time.time()
+
+    def ping(self) -> bool:
+        """SQLiteに問い合わせられるか (SQLiteを使わない場合は常に True)"""
+        with self._lock:
+            if self._db is None:
+                return True
+            try:
+                self._db.execute("SELECT 1").fetchone()
+                return True
+            except sqlite3.Error:
+                return False
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._delete_locked(session_id)
+
+    def _delete_locked(self, session_id: str) -> bool:
+        found = self._sessions.pop(session_id, None) is not None
+        if self._db is not None:
+            found = self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0 or found
+            self._db.commit()
+        return found
+
+    def expire(self) -> int:
+        """期限切れのセッションを削除し、削除件数を返す"""
+        with self._lock:
+            return self._expire_locked(time.time())
+
+    def _expire_locked(self, now: float) -> int:
+        if self.idle_ttl <= 0:
+            return 0
+        expired = [sid for sid, session in self._sessions.items() if self._expired(session, now)]
+        for sid in expired:
+            del self._sessions[sid]
+        if self._db is not None:
+            deleted = self._db.execute(
+                "DELETE FROM sessions WHERE last_active < ?", (now - self.idle_ttl,)
+            ).rowcount
+            self._db.commit()
+            return max(len(expired), deleted)
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,319 @@
+"""
+ローカルで動くOpenAI互換のフェイクサーバー
+
+`POST /v1/chat/completions` を実装し、APIキーなしで `/api/chat`、Streamlitのチャット、
+`OpenAIPromptGenerator` の性能を測るためのものです。
+
+- ストリーミング(SSE)と一括応答、`response_format={"type": "json_object"}` に対応
+- 最初のトークンまでの時間(TTFT)とトークン間隔を設定可能
+- エラー注入(500)とレート制限(429 + Retry-After)を再現
+- 直近のリクエストと先頭が一致した分をプロンプトキャッシュとして usage.cached_tokens に反映
+- モデルごとのTTFT・常に失敗するモデルを指定して、モデルのフォールバックやヘッジを試せる
+
+単体で起動:
+  python benchmarks/fake_openai.py --port 8001 --ttft 0.4 --itl 0.02 --rpm 120
+  OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=dummy \
+    CHAT_RATE_LIMIT=0 UPLOAD_RATE_LIMIT=0 CHAT_COALESCE=0 python main.py
+
+テストから利用:
+    with FakeOpenAIServer(ttft=0.1) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, Iterable, List, Optional
+
+
+# 測定用にバックエンドを起動するときの環境変数
+# (同じクライアントから大量に送るので頻度制限を外し、同じ本文の相乗りもさせない)
+BACKEND_ENV = {"CHAT_RATE_LIMIT": "0", "UPLOAD_RATE_LIMIT": "0", "CHAT_COALESCE": "0"}
+
+DEFAULT_TOKENS = [f"トークン{i} " for i in range(200)]
+
+
+# プロンプトキャッシュの再現 (OpenAIと同様に1024トークン以上の先頭一致から128トークン単位)
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+
+def _serialize(messages: List[dict]) -> str:
+    return "".join(f"{m.get('role', '')}\n{m.get('content', '')}\n" for m in messages)
+
+
+def _estimate_tokens(messages: List[dict]) -> int:
+    return len(_serialize(messages)) // 4
+
+
+def _json_object_content(body: dict) -> str:
+    """json_object 指定時の応答(OpenAIPromptGenerator が期待する prompts 配列)"""
+    text = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+    match = re.search(r"生成数:\s*(\d+)", text)
+    count = int(match.group(1)) if match else 3
+    prompts = [
+        {
+            "title": f"フェイクプロンプト{i}",
+            "system_prompt": f"あなたはテスト用のアシスタント{i}です。",
+            "recommended_attachments": ["資料A", "資料B", "資料C", "資料D"],
+        }
+        for i in range(1, count + 1)
+    ]
+    return json.dumps({"prompts": prompts}, ensure_ascii=False)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        if self.server.config.verbose:
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        config = self.server.config
+        retry_after = config.check_rate_limit()
+        if retry_after is not None:
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+                {"Retry-After": str(retry_after)},
+            )
+            return
+        if body.get("model") in config.failing_models or (config.error_rate and random.random() < config.error_rate):
+            self._send_json(500, {"error": {"message": "Injected server error (fake)", "type": "server_error"}})
+            return
+
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            content = _json_object_content(body)
+            tokens = [content[i:i + 16] for i in range(0, len(content), 16)]
+        else:
+            tokens = config.tokens
+
+        if body.get("stream"):
+            self._stream(body, tokens)
+        else:
+            self._complete(body, tokens)
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _usage(self, body: dict, tokens: List[str]) -> dict:
+        messages = body.get("messages", [])
+        prompt_tokens = _estimate_tokens(messages)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "prompt_tokens_details": {"cached_tokens": self.server.config.cached_prefix_tokens(messages)},
+        }
+
+    def _chunk(self, completion_id: str, model: str, delta: Optional[dict], finish_reason: Optional[str] = None,
+               usage: Optional[dict] = None) -> bytes:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage is not None:
+            payload["usage"] = usage
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    def _write_chunked(self, data: bytes):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, body: dict, tokens: List[str]):
+        config = self.server.config
+        model = body.get("model", "fake")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            time.sleep(config.ttft_for(model))
+            self._write_chunked(self._chunk(completion_id, model, {"role": "assistant", "content": ""}))
+            for i, token in enumerate(tokens):
+                if i and config.inter_token_latency:
+                    time.sleep(config.inter_token_latency)
+                self._write_chunked(self._chunk(completion_id, model, {"content": token}))
+            self._write_chunked(self._chunk(completion_id, model, {}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._write_chunked(self._chunk(completion_id, model, None, usage=self._usage(body, tokens)))
+            self._write_chunked(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # クライアントが途中で切断
+
+    def _complete(self, body: dict, tokens: List[str]):
+        config = self.server.config
+        time.sleep(config.ttft_for(body.get("model", "fake")) + config.inter_token_latency * max(0, len(tokens) - 1))
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": self._usage(body, tokens),
+        })
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    config: "FakeOpenAIServer"
+
+
+class FakeOpenAIServer:
+    """別スレッドで起動するフェイクサーバー"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, tokens: Optional[List[str]] = None,
+                 ttft: float = 0.0, inter_token_latency: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rpm: int = 0, rate_limit_rate: float = 0.0, model_ttft: Optional[Dict[str, float]] = None,
+                 failing_models: Iterable[str] = (), verbose: bool = False):
+        """
+        ttft: 最初のトークンまでの秒数
+        model_ttft: モデルごとの最初のトークンまでの秒数 (指定のないモデルは ttft)
+        failing_models: 常に500エラーを返すモデル
+        inter_token_latency: トークン間の秒数
+        error_rate: 500エラーを返す確率
+        rate_limit_rpm: 1分あたりの上限リクエスト数(超過分は429)。0で無制限
+        rate_limit_rate: 上限と無関係に429を返す確率
+        """
+        self.tokens = tokens if tokens is not None else DEFAULT_TOKENS
+        self.ttft = ttft
+        self.inter_token_latency = inter_token_latency
+        self.error_rate = error_rate
+        self.rate_limit_rpm = rate_limit_rpm
+        self.rate_limit_rate = rate_limit_rate
+        self.model_ttft = dict(model_ttft or {})
+        self.failing_models = set(failing_models)
+        self.verbose = verbose
+        self._window: Deque[float] = deque()
+        self._window_lock = threading.Lock()
+        self._recent_prompts: Deque[str] = deque(maxlen=64)
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.config = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def ttft_for(self, model: str) -> float:
+        return self.model_ttft.get(model, self.ttft)
+
+    def check_rate_limit(self) -> Optional[int]:
+        """制限に掛かった場合は Retry-After の秒数を返す"""
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            return 1
+        if not self.rate_limit_rpm:
+            return None
+        now = time.monotonic()
+        with self._window_lock:
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            if len(self._window) >= self.rate_limit_rpm:
+                return max(1, int(60 - (now - self._window[0])) + 1)
+            self._window.append(now)
+        return None
+
+    def cached_prefix_tokens(self, messages: List[dict]) -> int:
+        """直近のリクエストとの最長の先頭一致をキャッシュ済みトークン数として返す"""
+        prompt = _serialize(messages)
+        with self._window_lock:
+            recent = list(self._recent_prompts)
+            self._recent_prompts.append(prompt)
+        longest = max((len(os.path.commonprefix([prompt, other])) for other in recent), default=0)
+        tokens = longest // 4
+        if tokens < CACHE_MIN_TOKENS:
+            return 0
+        return tokens - tokens % CACHE_INCREMENT
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI互換のフェイクサーバー')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--ttft', type=float, default=0.3, help='最初のトークンまでの秒数 (デフォルト: 0.3)')
+    parser.add_argument('--itl', type=float, default=0.02, help='トークン間の秒数 (デフォルト: 0.02)')
+    parser.add_argument('--tokens', type=int, default=200, help='1応答あたりのトークン数 (デフォルト: 200)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='500エラーを返す確率')
+    parser.add_argument('--rpm', type=int, default=0, help='1分あたりのリクエスト上限 (超過分は429)')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='429を返す確率')
+    parser.add_argument('--model-ttft', action='append', default=[], metavar='MODEL=SEC',
+                        help='モデルごとの最初のトークンまでの秒数 (複数指定可)')
+    parser.add_argument('--fail-model', action='append', default=[], help='常に500エラーを返すモデル (複数指定可)')
+    parser.add_argument('--verbose', action='store_true', help='アクセスログを表示')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        args.host, args.port,
+        tokens=[f"トークン{i} " for i in range(args.tokens)],
+        ttft=args.ttft,
+        inter_token_latency=args.itl,
+        error_rate=args.error_rate,
+        rate_limit_rpm=args.rpm,
+        rate_limit_rate=args.rate_limit_rate,
+        model_ttft={m: float(sec) for m, sec in (item.split("=", 1) for item in args.model_ttft)},
+        failing_models=args.fail_model,
+        verbose=args.verbose,
+    )
+    print(f"✓ フェイクOpenAIサーバー起動: {server.base_url}")
+    print(f"  OPENAI_BASE_URL={server.base_url} を設定して各アプリを起動してください")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+ベンチマーク用のファイル生成
+
+サイズを段階的に変えたPDF/DOCX/XLSX/CSVをメモリ上に生成します。
+PDFは外部ライブラリなしで最小構成のファイルを書き出します。
+"""
+
+import io
+from typing import List
+
+import pandas as pd
+from docx import Document
+
+
+LINE = "The quick brown fox jumps over the lazy dog. Contract clause {n} applies to both parties."
+
+
+def make_pdf(pages: int, lines_per_page: int = 40) -> bytes:
+    """テキストだけのPDFを生成する(Helvetica、1ページ40行)"""
+    objects: List[bytes] = []
+
+    def add(obj: bytes) -> int:
+        objects.append(obj)
+        return len(objects)
+
+    font_id = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = add(b"")  # 後で埋める
+    page_ids = []
+    for p in range(pages):
+        text_ops = ["BT", "/F1 10 Tf", "12 TL", "50 780 Td"]
+        for n in range(lines_per_page):
+            text_ops.append(f"({LINE.format(n=p * lines_per_page + n)}) Tj T*")
+        text_ops.append("ET")
+        stream = "\n".join(text_ops).encode("latin-1")
+        content_id = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (pages_id, font_id, content_id)
+        ))
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    objects[pages_id - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+    catalog_id = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % i + obj + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog_id, xref))
+    return out.getvalue()
+
+
+def make_docx(paragraphs: int, table_rows: int = 0) -> bytes:
+    doc = Document()
+    for n in range(paragraphs):
+        doc.add_paragraph(LINE.format(n=n))
+    if table_rows:
+        table = doc.add_table(rows=table_rows, cols=4)
+        for r, row in enumerate(table.rows):
+            for c, cell in enumerate(row.cells):
+                cell.text = f"r{r}c{c}"
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def make_docx_pages(pages: int, paragraphs_per_page: int = 25, table_every: int = 5) -> bytes:
+    """ページ数相当の段落と、数ページごとの表 (10行4列) を本文中に並べたDOCX"""
+    doc = Document()
+    for page in range(pages):
+        for n in range(paragraphs_per_page):
+            doc.add_paragraph(LINE.format(n=page * paragraphs_per_page + n))
+        if table_every and page % table_every == table_every - 1:
+            table = doc.add_table(rows=10, cols=4)
+            for r, row in enumerate(table.rows):
+                for c, cell in enumerate(row.cells):
+                    cell.text = f"p{page}r{r}c{c}"
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def _frame(rows: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        "id": range(rows),
+        "name": [f"item-{i}" for i in range(rows)],
+        "price": [i * 1.5 for i in range(rows)],
+        "note": [LINE.format(n=i) for i in range(rows)],
+    })
+
+
+def make_xlsx(rows: int, sheets: int = 2) -> bytes:
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        for s in range(sheets):
+            _frame(rows).to_excel(writer, sheet_name=f"Sheet{s + 1}", index=False)
+    return buffer.getvalue()
+
+
+def make_csv(rows: int) -> bytes:
+    return _frame(rows).to_csv(index=False).encode("utf-8")
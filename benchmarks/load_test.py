@@ -0,0 +1,186 @@
+"""
+/api/chat 負荷試験
+
+起動中のバックエンドに対してN本のSSEセッションを同時に流し、
+最初のトークンまでの時間(TTFT)・全体のレイテンシのp50/p95/p99とスループットを表示します。
+上流はフェイクOpenAIサーバー(benchmarks/fake_openai.py)を想定しています。
+
+使用例:
+  python benchmarks/fake_openai.py --port 8001 --ttft 0.3 --itl 0.02 &
+  (cd backend && OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=dummy python main.py) &
+  python benchmarks/load_test.py --url http://localhost:8000 -c 50 -n 500
+
+  # バックエンドも上流も自前で起動する場合
+  python benchmarks/load_test.py --spawn -c 20 -n 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+
+sys.path.insert(0, str(BENCH_DIR))
+
+from fake_openai import BACKEND_ENV, FakeOpenAIServer  # noqa: E402
+
+
+def percentile(values: List[float], q: float) -> float:
+    """線形補間なしの単純なパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def run_session(client: httpx.AsyncClient, body: Dict) -> Dict:
+    """1セッション分のSSEを最後まで読み、所要時間を返す"""
+    start = time.perf_counter()
+    ttft: Optional[float] = None
+    events = 0
+    error: Optional[str] = None
+    try:
+        async with client.stream("POST", "/api/chat", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return {"ok": False, "status": response.status_code, "total": time.perf_counter() - start}
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                payload = line[6:]
+                if payload == "[DONE]":
+                    break
+                data = json.loads(payload)
+                if "error" in data:
+                    error = data["error"]
+                    break
+                if "content" in data:
+                    events += 1
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    return {
+        "ok": error is None,
+        "status": 200,
+        "error": error,
+        "ttft": ttft,
+        "total": time.perf_counter() - start,
+        "events": events,
+    }
+
+
+async def run_load(url: str, concurrency: int, requests: int, body: Dict, timeout: float) -> List[Dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        async def bounded():
+            async with semaphore:
+                return await run_session(client, body)
+
+        return await asyncio.gather(*(bounded() for _ in range(requests)))
+
+
+def report(results: List[Dict], elapsed: float):
+    ok = [r for r in results if r["ok"]]
+    failed = [r for r in results if not r["ok"]]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    totals = [r["total"] for r in ok]
+    events = sum(r.get("events", 0) for r in ok)
+
+    print(f"\n{'=' * 60}")
+    print(f"リクエスト: {len(results)}件 (成功 {len(ok)} / 失敗 {len(failed)})  経過: {elapsed:.2f}秒")
+    print(f"スループット: {len(ok) / elapsed:.1f} req/s, {events / elapsed:.1f} events/s")
+    print(f"{'':10s} {'p50[ms]':>10s} {'p95[ms]':>10s} {'p99[ms]':>10s} {'max[ms]':>10s}")
+    for label, values in (("TTFT", ttfts), ("全体", totals)):
+        if values:
+            print(f"{label:10s} " + " ".join(
+                f"{percentile(values, q) * 1000:10.1f}" for q in (0.5, 0.95, 0.99, 1.0)
+            ))
+    if failed:
+        reasons: Dict[str, int] = {}
+        for r in failed:
+            reason = r.get("error") or f"HTTP {r['status']}"
+            reasons[str(reason)[:80]] = reasons.get(str(reason)[:80], 0) + 1
+        print("失敗の内訳:")
+        for reason, count in sorted(reasons.items(), key=lambda x: -x[1]):
+            print(f"  • {reason}: {count}件")
+    print(f"{'=' * 60}")
+
+
+def wait_until_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"バックエンドが起動しませんでした: {url}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/api/chat のSSE負荷試験')
+    parser.add_argument('--url', type=str, default='http://localhost:8000', help='バックエンドのURL')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='同時セッション数 (デフォルト: 10)')
+    parser.add_argument('-n', '--requests', type=int, default=100, help='総リクエスト数 (デフォルト: 100)')
+    parser.add_argument('--message', type=str, default='こんにちは', help='送信するメッセージ')
+    parser.add_argument('--timeout', type=float, default=120.0, help='1リクエストのタイムアウト秒数')
+    parser.add_argument('--spawn', action='store_true',
+                       help='フェイクOpenAIサーバーとバックエンドをこのスクリプトから起動する')
+    parser.add_argument('--port', type=int, default=8765, help='--spawn 時のバックエンドのポート')
+    parser.add_argument('--ttft', type=float, default=0.3, help='--spawn 時のフェイクサーバーのTTFT秒数')
+    parser.add_argument('--itl', type=float, default=0.02, help='--spawn 時のフェイクサーバーのトークン間隔秒数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='--spawn 時の500エラー注入率')
+    parser.add_argument('--rpm', type=int, default=0, help='--spawn 時の1分あたりリクエスト上限')
+    args = parser.parse_args()
+
+    body = {
+        "messages": [{"role": "user", "content": args.message}],
+        "system_prompt": "あなたは優秀なアシスタントです。",
+    }
+
+    server = None
+    backend = None
+    url = args.url.rstrip("/")
+    if args.spawn:
+        server = FakeOpenAIServer(
+            ttft=args.ttft, inter_token_latency=args.itl,
+            error_rate=args.error_rate, rate_limit_rpm=args.rpm,
+        ).start()
+        env = dict(os.environ, OPENAI_BASE_URL=server.base_url, OPENAI_API_KEY="load-test", CATALOG_WATCH_INTERVAL="0",
+                   **BACKEND_ENV)
+        backend = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+            cwd=ROOT_DIR / "backend", env=env,
+        )
+        url = f"http://127.0.0.1:{args.port}"
+        print(f"✓ フェイクOpenAIサーバー: {server.base_url}")
+
+    try:
+        wait_until_ready(url)
+        print(f"負荷試験: {url}/api/chat  同時{args.concurrency}セッション × 合計{args.requests}件")
+        start = time.perf_counter()
+        results = asyncio.run(run_load(url, args.concurrency, args.requests, body, args.timeout))
+        report(results, time.perf_counter() - start)
+    finally:
+        if backend:
+            backend.terminate()
+            backend.wait()
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+ベンチマークスイート
+
+カタログ読み込み・サンプリング・ファイル抽出・チャットストリーミングの所要時間と
+ピークメモリを計測し、コミットごとの結果を benchmarks/results/<commit>.json に保存します。
+ベースラインと比較して中央値が閾値を超えて悪化したケースがあれば終了コード1で終わります。
+
+使用例:
+  python benchmarks/run_benchmarks.py                    # 全ケース
+  python benchmarks/run_benchmarks.py --quick            # 小さいサイズのみ
+  python benchmarks/run_benchmarks.py -k read_file       # 名前で絞り込み
+  python benchmarks/run_benchmarks.py --save-baseline    # 結果をベースラインとして保存
+  python benchmarks/run_benchmarks.py --threshold 0.3    # 30%以上の悪化で失敗
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+RESULTS_DIR = BENCH_DIR / "results"
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+
+sys.path.insert(0, str(BENCH_DIR))
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+sys.path.insert(0, str(ROOT_DIR / "src"))
+
+from fake_openai import BACKEND_ENV, FakeOpenAIServer  # noqa: E402
+import fixtures  # noqa: E402
+
+
+def _load_module(name: str, path: Path):
+    """同名の main.py が複数あるため、別名でモジュールとして読み込む"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Case:
+    """1つのベンチマークケース"""
+
+    def __init__(self, name: str, func: Callable[[], Optional[Dict]], repeat: int = 5):
+        self.name = name
+        self.func = func
+        self.repeat = repeat
+
+    def run(self) -> Dict:
+        self.func()  # ウォームアップ
+        timings = []
+        extra: Dict = {}
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            extra = self.func() or {}
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        self.func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        timings.sort()
+        return {
+            "median": statistics.median(timings),
+            "min": timings[0],
+            "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            "repeat": self.repeat,
+            "peak_kb": round(peak / 1024, 1),
+            "extra": extra,
+        }
+
+
+def cli_cases(quick: bool) -> Iterator[Case]:
+    """src/main.py の PromptGenerator"""
+    cli = _load_module("cli_main", ROOT_DIR / "src" / "main.py")
+    output_dir = Path(tempfile.mkdtemp(prefix="bench_output_"))
+    generator = cli.PromptGenerator(str(ROOT_DIR / "prompts_data"), str(output_dir))
+    categories = sorted(generator.catalog.categories())
+    if quick:
+        categories = categories[:3]
+
+    def load_all():
+        generator = cli.PromptGenerator(str(ROOT_DIR / "prompts_data"), str(output_dir))
+        for category in categories:
+            generator.load_prompts(category)
+
+    yield Case("cli.load_prompts.all_categories", load_all)
+
+    for category in categories:
+        def sample(category=category):
+            for _ in range(100):
+                generator.generate_from_samples(category, 10)
+
+        yield Case(f"cli.generate_from_samples.{category}.x100", sample)
+
+
+def backend_cases(backend, quick: bool) -> Iterator[Case]:
+    """FastAPIバックエンド(インプロセスのASGI呼び出し)"""
+    import httpx
+
+    clients = 10 if quick else 50
+    categories = sorted(p.stem for p in (ROOT_DIR / "prompts_data").glob("*.json"))
+
+    async def concurrent(paths: List[str]):
+        transport = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            responses = await asyncio.gather(*(client.get(path) for path in paths))
+        assert all(r.status_code == 200 for r in responses)
+
+    yield Case(
+        f"backend.get_categories.concurrent{clients}",
+        lambda: asyncio.run(concurrent(["/api/categories"] * clients)),
+    )
+    yield Case(
+        f"backend.get_prompts.concurrent{clients}",
+        lambda: asyncio.run(concurrent([f"/api/prompts/{categories[i % len(categories)]}" for i in range(clients)])),
+    )
+
+    # ファイル抽出
+    from fastapi import UploadFile
+
+    def extract(filename: str, data: bytes):
+        upload = UploadFile(file=io.BytesIO(data), filename=filename)
+        content, file_type = asyncio.run(backend.read_file_content(upload))
+        assert file_type != "error", content
+        return {"chars": len(content)}
+
+    sizes = {
+        "pdf": [5, 25] if quick else [10, 50, 100],
+        "docx": [200, 1000] if quick else [500, 2500, 10000],
+        "xlsx": [500, 2000] if quick else [1000, 5000, 20000],
+        "csv": [1000, 5000] if quick else [5000, 25000, 100000],
+    }
+    makers = {
+        "pdf": fixtures.make_pdf,
+        "docx": lambda n: fixtures.make_docx(n, table_rows=n // 20),
+        "xlsx": fixtures.make_xlsx,
+        "csv": fixtures.make_csv,
+    }
+    for ext, counts in sizes.items():
+        for count in counts:
+            data = makers[ext](count)
+            yield Case(
+                f"backend.read_file_content.{ext}.{count}",
+                lambda ext=ext, data=data: extract(f"bench.{ext}", data),
+                repeat=3,
+            )
+
+
+def extraction_cases(quick: bool) -> Iterator[Case]:
+    """
+    DOCXの抽出: 逐次解析 (src/extraction.py) と python-docx で文書全体を読み込む方式の比較
+    PDFの抽出: エンジン (src/pdf_engine.py) ごとの比較
+    """
+    from docx import Document
+    import extraction
+
+    pages = 50 if quick else 500
+    data = fixtures.make_docx_pages(pages)
+
+    def python_docx():
+        doc = Document(io.BytesIO(data))
+        content = "\n\n".join(para.text for para in doc.paragraphs if para.text.strip())
+        return {"chars": len(content)}
+
+    def streaming(max_tokens: Optional[int] = None):
+        document = extraction.extract(data, "bench.docx", max_tokens=max_tokens)
+        return {"chars": document.chars, "units": len(document.units)}
+
+    yield Case(f"extraction.docx.python_docx.{pages}pages", python_docx, repeat=3)
+    yield Case(f"extraction.docx.streaming.{pages}pages", streaming, repeat=3)
+    yield Case(f"extraction.docx.streaming_15000tokens.{pages}pages", lambda: streaming(15000), repeat=3)
+
+    # PDFのエンジン別 (layout は従来の pdfplumber のみ、auto は PDFium で読めないページだけ pdfplumber)
+    from pdf_engine import PdfEngine
+
+    pdf_pages = 20 if quick else 100
+    pdf_data = fixtures.make_pdf(pdf_pages)
+    for engine in ("fast", "auto", "layout"):
+        def read_pdf(engine=PdfEngine(engine, workers=1)):
+            stats: Dict[str, int] = {}
+            chars = sum(len(text) for _, text in engine.pages(pdf_data, 0, stats))
+            return dict(stats, chars=chars)
+
+        yield Case(f"extraction.pdf.{engine}.{pdf_pages}pages", read_pdf, repeat=3)
+
+
+def chat_cases(backend, server: FakeOpenAIServer, quick: bool) -> Iterator[Case]:
+    """/api/chat のSSEスループット(フェイクOpenAIサーバー経由)"""
+    import httpx
+
+    sessions = 4 if quick else 16
+
+    async def run_sessions():
+        transport = httpx.ASGITransport(app=backend.app)
+        # セッションごとに本文を変える (同じ本文だと相乗りして上流へのストリームが1本になる)
+        bodies = [
+            {"messages": [{"role": "user", "content": f"こんにちは ({i})"}], "system_prompt": "あなたは優秀なアシスタントです。"}
+            for i in range(sessions)
+        ]
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            responses = await asyncio.gather(*(client.post("/api/chat", json=body) for body in bodies))
+        assert all(r.status_code == 200 for r in responses), [r.status_code for r in responses]
+        counts = [r.text.count("data: {\"content\"") for r in responses]
+        assert all(counts), f"イベントのないセッションがあります: {counts}"
+        return sum(counts)
+
+    def throughput():
+        start = time.perf_counter()
+        events = asyncio.run(run_sessions())
+        elapsed = time.perf_counter() - start
+        return {"events": events, "events_per_second": round(events / elapsed, 1)}
+
+    yield Case(f"backend.chat_sse.sessions{sessions}", throughput, repeat=3)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[Tuple[str, float, float]]:
+    """中央値が (1 + threshold) 倍を超えて悪化したケースを返す"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous and current["median"] > previous["median"] * (1 + threshold):
+            regressions.append((name, previous["median"], current["median"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AIGenPrompts4U ベンチマーク')
+    parser.add_argument('-k', dest='filter', type=str, help='ケース名の部分一致で絞り込み')
+    parser.add_argument('--quick', action='store_true', help='小さいサイズのみ実行')
+    parser.add_argument('--baseline', type=str, default=str(DEFAULT_BASELINE),
+                       help=f'比較対象の結果ファイル (デフォルト: {DEFAULT_BASELINE.relative_to(ROOT_DIR)})')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                       help='中央値の悪化をエラーにする割合 (デフォルト: 0.2 = 20%%)')
+    parser.add_argument('--save-baseline', action='store_true', help='今回の結果をベースラインとして保存')
+    args = parser.parse_args()
+
+    # 生成物(chat_history, output)は一時ディレクトリに出す
+    os.chdir(tempfile.mkdtemp(prefix="bench_cwd_"))
+
+    server = FakeOpenAIServer().start()
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["CATALOG_WATCH_INTERVAL"] = "0"
+    os.environ["EXTRACT_CACHE_MAX_FILES"] = "0"  # 抽出のたびに解析させる
+    os.environ.update(BACKEND_ENV)
+    backend = _load_module("backend_main", ROOT_DIR / "backend" / "main.py")
+
+    cases: List[Case] = []
+    cases.extend(cli_cases(args.quick))
+    cases.extend(backend_cases(backend, args.quick))
+    cases.extend(extraction_cases(args.quick))
+    cases.extend(chat_cases(backend, server, args.quick))
+    if args.filter:
+        cases = [case for case in cases if args.filter in case.name]
+
+    results: Dict[str, Dict] = {}
+    print(f"{'ケース':60s} {'中央値[ms]':>12s} {'p95[ms]':>10s} {'ピーク[KB]':>12s}")
+    print("-" * 98)
+    for case in cases:
+        result = case.run()
+        results[case.name] = result
+        extra = " ".join(f"{k}={v}" for k, v in result["extra"].items())
+        print(f"{case.name:60s} {result['median'] * 1000:12.2f} {result['p95'] * 1000:10.2f} {result['peak_kb']:12.1f} {extra}")
+    server.stop()
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    RESULTS_DIR.mkdir(exist_ok=True)
+    result_path = RESULTS_DIR / f"{commit}.json"
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✓ 結果を保存しました: {result_path}")
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✓ ベースラインを更新しました: {baseline_path}")
+        return
+
+    if baseline_path.exists():
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get("results", {}), args.threshold)
+        if regressions:
+            print(f"\n✗ ベースライン ({baseline.get('commit')}) から {args.threshold:.0%} 以上悪化しました:")
+            for name, before, after in regressions:
+                print(f"  • {name}: {before * 1000:.2f}ms → {after * 1000:.2f}ms")
+            sys.exit(1)
+        print(f"✓ ベースライン ({baseline.get('commit')}) との比較: 悪化なし")
+
+
+if __name__ == "__main__":
+    main()
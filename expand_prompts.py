@@ -4,8 +4,15 @@
 """
 
 import json
+import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+from prompt_dedup import SignatureIndex
+
+PROMPTS_DIR = Path(__file__).parent / "prompts_data"
+INDEX_PATH = Path(__file__).parent / "build" / "minhash_index.json"
+
 # マネジメント用プロンプトを90個追加
 management_additions = [
     {
@@ -43,4 +50,11 @@ management_additions = [
 # 残り85個のプロンプトも作成
 # (id 16-100)
 
+# 既存カタログとの近似重複チェック(変更のあったカテゴリだけ署名を再計算)
+index = SignatureIndex.load_or_build(PROMPTS_DIR, INDEX_PATH)
+management_additions, duplicates = index.check_additions("management", management_additions)
+for dup in duplicates:
+    matches = ", ".join(f"{key} ({score:.2f})" for key, score in dup["matches"])
+    print(f"重複のため除外: {dup['prompt']['title']} ≈ {matches}")
+
 print("Management prompts expansion script ready")
@@ -0,0 +1,274 @@
+"""
+保存済みチャット履歴の全文検索インデックス
+
+SQLite FTS5 の trigram トークナイザで、日本語も分かち書きなしで部分一致検索できます。
+ChatStore から保存・追記・削除のたびに差分だけが反映されるため、全件を読み直すのは
+sync() で取りこぼしを追いつかせるときだけです。
+
+3文字以上の語は trigram 索引で、1〜2文字の語 (「契約」「請求」など) は、本文を2文字ずつに区切った
+bigram 索引 (message_bigrams) で検索します。記号を含む短い語のように、どちらの索引でも引けない語だけを
+LIKE で絞り込みます (3文字以上の語と一緒に指定された短い語も、trigram 索引で引いた候補を LIKE で絞る)。
+索引で引ける語が1つもないときは、新しい LIKE_SCAN_ROWS 件のメッセージだけを走査します。
+結果は会話ごとに最新の一致メッセージ1件で、新しく追記された順に件数分だけ返します。
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+SNIPPET_TOKENS = 16
+HIGHLIGHT = ("**", "**")
+# どの索引でも引けない語だけの検索で、LIKE で走査する新しいメッセージの件数
+LIKE_SCAN_ROWS = 50000
+
+# bigram 索引に入れる文字の並び (unicode61 トークナイザが1語として扱う文字だけ)
+_WORD_RUN_RE = re.compile(r"[^\W_]+")
+
+
+def _bigrams(text: str) -> str:
+    """
+    文字の並びごとに、隣り合う2文字と末尾の1文字を空白区切りで並べる (「契約書」→「契約 約書 書」)
+    2文字の語は bigram そのもの、1文字の語はその文字で始まる bigram (前方一致) で引ける
+    """
+    tokens = []
+    for run in _WORD_RUN_RE.findall(str(text or "")):
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return " ".join(tokens)
+
+
+def _phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _split_terms(query: str) -> Tuple[List[str], List[str], List[str]]:
+    """空白区切りの語を (trigram 索引で引く語, bigram 索引で引く語, LIKE で絞る語) に分ける"""
+    long_terms, short_terms, like_terms = [], [], []
+    for term in query.split():
+        if len(term) >= 3:
+            long_terms.append(term)
+        elif _WORD_RUN_RE.fullmatch(term):
+            short_terms.append(term)
+        else:
+            like_terms.append(term)
+    return long_terms, short_terms, like_terms
+
+
+class ChatSearchIndex:
+    """会話ごとのメッセージを行単位で持つ全文検索インデックス"""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = 0
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "filename TEXT PRIMARY KEY, title TEXT, timestamp TEXT, "
+            "message_count INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+            "filename UNINDEXED, position UNINDEXED, role UNINDEXED, content, tokenize='trigram')"
+        )
+        # 短い語用の bigram 索引 (rowid は messages と同じ)。本文は持たない
+        has_bigrams = self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'message_bigrams'"
+        ).fetchone() is not None
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS message_bigrams USING fts5("
+            "content, content='', tokenize='unicode61 remove_diacritics 0')"
+        )
+        if not has_bigrams:
+            # bigram 索引がなかった頃の索引は、既存のメッセージから作る
+            self._db.execute(
+                "INSERT INTO message_bigrams (rowid, content) SELECT rowid, bigrams(content) FROM messages"
+            )
+        self._db.commit()
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """プロセスごとのSQLite接続 (WALモード。fork後の子プロセスでは開き直す)"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=10.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.create_function("bigrams", 1, _bigrams, deterministic=True)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def ping(self) -> bool:
+        """SQLiteに問い合わせられるか"""
+        with self._lock:
+            try:
+                self._db.execute("SELECT 1").fetchone()
+                return True
+            except sqlite3.Error:
+                return False
+
+    def _record_file(self, path: Path, title: str, timestamp: str, message_count: int):
+        stat = path.stat()
+        self._db.execute(
+            "INSERT OR REPLACE INTO conversations (filename, title, timestamp, message_count, mtime_ns, size) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (path.name, title, timestamp, message_count, stat.st_mtime_ns, stat.st_size),
+        )
+
+    def add_messages(self, path: Path, meta: Dict, messages: Iterable[Dict], start: int):
+        """追記されたメッセージだけを索引に加える (start は最初のメッセージの位置)"""
+        rows = [
+            (path.name, start + offset, message.get("role", ""), str(message.get("content", "")))
+            for offset, message in enumerate(messages)
+        ]
+        with self._lock:
+            for row in rows:
+                rowid = self._db.execute(
+                    "INSERT INTO messages (filename, position, role, content) VALUES (?, ?, ?, ?)", row
+                ).lastrowid
+                self._db.execute(
+                    "INSERT INTO message_bigrams (rowid, content) VALUES (?, ?)", (rowid, _bigrams(row[3]))
+                )
+            self._record_file(path, meta.get("title", "無題"), meta.get("timestamp", ""), start + len(rows))
+            self._db.commit()
+
+    def replace(self, path: Path, meta: Dict, messages: List[Dict]):
+        """会話全体を索引し直す (書き直し・取りこぼしの追いつき用)"""
+        with self._lock:
+            self._delete_messages(path.name)
+        self.add_messages(path, meta, messages, 0)
+
+    def update_meta(self, path: Path, meta: Dict, message_count: int):
+        with self._lock:
+            self._record_file(path, meta.get("title", "無題"), meta.get("timestamp", ""), message_count)
+            self._db.commit()
+
+    def remove(self, filename: str):
+        with self._lock:
+            self._delete_messages(filename)
+            self._db.execute("DELETE FROM conversations WHERE filename = ?", (filename,))
+            self._db.commit()
+
+    def _delete_messages(self, filename: str):
+        # content='' の索引は行の削除に元の本文が要るので、messages から作り直して渡す
+        self._db.execute(
+            "INSERT INTO message_bigrams (message_bigrams, rowid, content) "
+            "SELECT 'delete', rowid, bigrams(content) FROM messages WHERE filename = ?",
+            (filename,),
+        )
+        self._db.execute("DELETE FROM messages WHERE filename = ?", (filename,))
+
+    def sync(self, store) -> int:
+        """
+        ディレクトリ上のファイルと索引を突き合わせ、変更・追加・削除された会話だけを反映する
+        (別プロセスでの保存や、索引導入前の履歴の取り込み用)。反映した件数を返す
+        """
+        with self._lock:
+            indexed = {
+                filename: (mtime_ns, size)
+                for filename, mtime_ns, size in self._db.execute(
+                    "SELECT filename, mtime_ns, size FROM conversations"
+                )
+            }
+        changed = 0
+        present = set()
+        for path in store.history_files():
+            present.add(path.name)
+            stat = path.stat()
+            if indexed.get(path.name) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            data = store.load(path.name)
+            if data is None:
+                continue
+            self.replace(path, data, data.get("messages", []))
+            changed += 1
+        for filename in set(indexed) - present:
+            self.remove(filename)
+            changed += 1
+        return changed
+
+    def search(self, query: str, limit: int = 20) -> List[Dict]:
+        """
+        一致した会話を新しく追記された順に返す (会話ごとに最新の一致メッセージのスニペットを1件)
+        関連度順 (bm25) は一致件数に比例して重くなるため、索引の並び (rowid) の新しい順に読み、
+        異なる会話が limit 件そろった時点で打ち切る (1つの長い会話が枠を使い切ることはない)
+        """
+        long_terms, short_terms, like_terms = _split_terms(query.strip())
+        if not (long_terms or short_terms or like_terms):
+            return []
+
+        # 索引で候補を引く語を1種類選び、残りの語は候補に対する LIKE で絞る
+        if long_terms:
+            source, order = "messages AS m", "m.rowid"
+            conditions = ["messages MATCH ?"]
+            params: List = [" AND ".join(_phrase(t) for t in long_terms)]
+            like_terms = short_terms + like_terms
+        elif short_terms:
+            # bigram 索引の並び順で読み、本文は rowid で1件ずつ引く
+            source, order = "message_bigrams AS b CROSS JOIN messages AS m ON m.rowid = b.rowid", "b.rowid"
+            conditions = ["message_bigrams MATCH ?"]
+            params = [" AND ".join(_phrase(t) if len(t) == 2 else _phrase(t) + "*" for t in short_terms)]
+        else:
+            # 索引で絞れない語だけなら、新しいメッセージに限って走査する
+            source, order = "messages AS m", "m.rowid"
+            conditions = ["m.rowid > (SELECT coalesce(max(rowid), 0) FROM messages) - ?"]
+            params = [LIKE_SCAN_ROWS]
+        for term in like_terms:
+            conditions.append("m.content LIKE ? ESCAPE '\\'")
+            params.append("%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+
+        with self._lock:
+            # 会話ごとに最新の一致メッセージを1件選ぶ (本文・スニペットはまだ作らない)
+            cursor = self._db.execute(
+                f"SELECT m.rowid, m.filename FROM {source} WHERE {' AND '.join(conditions)} ORDER BY {order} DESC",
+                params,
+            )
+            latest: Dict[str, int] = {}
+            while len(latest) < limit:
+                batch = cursor.fetchmany(256)
+                if not batch:
+                    break
+                for rowid, filename in batch:
+                    latest.setdefault(filename, rowid)
+                    if len(latest) >= limit:
+                        break
+            cursor.close()
+            rowids = list(latest.values())
+            if not rowids:
+                return []
+            placeholders = ",".join("?" * len(rowids))
+            if long_terms:
+                snippet, snippet_params = "snippet(messages, 3, ?, ?, '…', ?)", [*HIGHLIGHT, SNIPPET_TOKENS]
+                match, match_params = "messages MATCH ? AND ", params[:1]
+            else:
+                snippet, snippet_params = "substr(m.content, 1, 120)", []
+                match, match_params = "", []
+            rows = self._db.execute(
+                f"SELECT m.rowid, m.filename, m.position, m.role, {snippet}, c.title, c.timestamp "
+                "FROM messages AS m JOIN conversations AS c ON c.filename = m.filename "
+                f"WHERE {match}m.rowid IN ({placeholders})",
+                (*snippet_params, *match_params, *rowids),
+            ).fetchall()
+
+        order = {rowid: i for i, rowid in enumerate(rowids)}
+        rows.sort(key=lambda row: order[row[0]])
+        return [
+            {
+                "filename": filename,
+                "title": title,
+                "timestamp": timestamp,
+                "position": position,
+                "role": role,
+                "snippet": snippet,
+            }
+            for _, filename, position, role, snippet, title, timestamp in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
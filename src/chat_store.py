@@ -0,0 +1,355 @@
+"""
+追記型のチャット履歴ストア
+
+1つの会話を1つのJSONLファイル (chat_history/<会話ID>.jsonl) に保存します。
+
+  {"type": "meta", "title": ..., "timestamp": ..., "selected_prompt": ..., "attachments": [...]}
+  {"type": "message", "role": "user", "content": ...}
+  {"type": "message", "role": "assistant", "content": ...}
+  ...
+
+- 保存は前回から増えたメッセージだけを末尾に追記するので O(新しいメッセージ)
+- 同じ会話を何度自動保存しても同じファイルが更新されるだけ (重複コピーを作らない)
+- fsync はまとめて行い (fsync_interval 秒に1回、または flush()/終了時)、書き込みごとには行わない
+- タイトル変更などでメタ情報の行が溜まったら、1ファイルを書き直して圧縮する
+- 以前の形式 (<タイトル>_<日時>.json) も一覧・読み込み・削除できる
+- search_index (ChatSearchIndex) を渡すと、保存・追記・削除のたびに差分だけを索引に反映する
+- 複数プロセス(ワーカー)からの書き込みはディレクトリ単位のファイルロック(fcntl.flock)で直列化し、
+  他プロセスがファイルを伸ばしていたらキャッシュを捨てて読み直す (fcntl のないWindowsではプロセス内のみ)
+"""
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+SEGMENT_SUFFIX = ".jsonl"
+LEGACY_SUFFIX = ".json"
+META_FIELDS = ("title", "timestamp", "selected_prompt", "attachments")
+# メタ情報の行がこの数を超えたら圧縮する
+COMPACT_META_THRESHOLD = 8
+# 会話IDに使える文字 (ファイル名になるため、区切り文字や「..」を含むIDは受け付けない)
+CONVERSATION_ID_RE = re.compile(r"^[0-9A-Za-z_-]+$")
+
+
+def new_conversation_id() -> str:
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+def _dump(record: Dict) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+class _SegmentState:
+    """ファイルごとの既知の状態 (毎回ファイルを読み直さないためのキャッシュ)"""
+
+    def __init__(self, meta: Dict, message_count: int, meta_records: int, size: int,
+                 complete: Optional[int] = None):
+        self.meta = meta
+        self.message_count = message_count
+        self.meta_records = meta_records
+        # 最後に読み書きした時点のファイルサイズ (他プロセスによる追記の検出用)
+        self.size = size
+        # 改行で終わっている行までのバイト数 (これより後ろは書き込み途中の行)
+        self.complete = size if complete is None else complete
+
+
+class ChatStore:
+    """会話ごとのJSONLセグメントに追記するチャット履歴ストア"""
+
+    def __init__(self, history_dir="chat_history", fsync_interval: float = 1.0, search_index=None):
+        self.history_dir = Path(history_dir)
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        self.fsync_interval = fsync_interval
+        self.search_index = search_index
+        self._lock = threading.Lock()
+        self._states: Dict[Path, _SegmentState] = {}
+        self._unsynced: set = set()
+        self._last_sync = time.monotonic()
+        self._lock_path = self.history_dir / ".write.lock"
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """プロセス内(スレッド)とプロセス間(ファイルロック)の両方で書き込みを直列化する"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # パス・読み込み
+
+    def path_for(self, conversation_id: str) -> Path:
+        """会話IDからファイルのパスを得る (不正なIDは ValueError)"""
+        if not isinstance(conversation_id, str) or not CONVERSATION_ID_RE.match(conversation_id):
+            raise ValueError(f"不正な会話IDです: {conversation_id!r}")
+        return self.history_dir / f"{conversation_id}{SEGMENT_SUFFIX}"
+
+    def resolve(self, filename: str) -> Optional[Path]:
+        """ファイル名 (会話ID.jsonl / 旧形式の .json) から実際のパスを得る"""
+        path = self.history_dir / Path(filename).name
+        if path.suffix not in (SEGMENT_SUFFIX, LEGACY_SUFFIX) or not path.exists():
+            return None
+        return path
+
+    def history_files(self) -> List[Path]:
+        return [p for p in self.history_dir.iterdir() if p.suffix in (SEGMENT_SUFFIX, LEGACY_SUFFIX)]
+
+    def _scan(self, path: Path) -> _SegmentState:
+        """ファイルを1回読んでメタ情報とメッセージ数を求める (メッセージ本文はパースしない)"""
+        meta: Dict = {}
+        count = 0
+        meta_records = 0
+        complete_bytes = 0
+        size = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                size += len(line.encode('utf-8'))
+                if not line.endswith("\n"):
+                    break  # 書き込み途中の行 (読み取りでは数えず、ファイルにも触らない)
+                complete_bytes = size
+                if line.startswith('{"type":"meta"'):
+                    record = json.loads(line)
+                    meta.update({k: record[k] for k in META_FIELDS if k in record})
+                    meta_records += 1
+                else:
+                    count += 1
+        return _SegmentState(meta, count, meta_records, size, complete_bytes)
+
+    def _repair(self, path: Path, state: _SegmentState):
+        """
+        途中で終わった行の後ろに追記しないよう切り詰める
+        書き込みのロック (_locked) の中でだけ呼ぶ。ロック中に残っている途中の行は、書き込み中に
+        落ちたプロセスのものなので捨ててよい
+        """
+        if state.complete < state.size:
+            os.truncate(path, state.complete)
+            state.size = state.complete
+
+    def _state(self, path: Path) -> Optional[_SegmentState]:
+        state = self._states.get(path)
+        if not path.exists():
+            self._states.pop(path, None)
+            return None
+        if state is None or state.size != path.stat().st_size:
+            # 未読み込み、または他のプロセスが更新した
+            state = self._states[path] = self._scan(path)
+        return state
+
+    def load(self, filename: str) -> Optional[Dict]:
+        """会話を読み込む (旧形式と同じ title / timestamp / messages / selected_prompt を持つ辞書)"""
+        path = self.resolve(filename)
+        if path is None:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            if path.suffix == LEGACY_SUFFIX:
+                return json.load(f)
+            meta: Dict = {}
+            messages: List[Dict] = []
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中で終わった行
+                if record.pop("type", None) == "meta":
+                    meta.update({k: record[k] for k in META_FIELDS if k in record})
+                else:
+                    messages.append(record)
+        return {
+            "conversation_id": path.stem,
+            "title": meta.get("title", "無題"),
+            "timestamp": meta.get("timestamp", ""),
+            "messages": messages,
+            "selected_prompt": meta.get("selected_prompt"),
+            "attachments": meta.get("attachments", []),
+        }
+
+    def list(self) -> List[Dict]:
+        """保存された会話の一覧 (更新が新しい順)"""
+        paths = self.history_files()
+        paths.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+        histories = []
+        for path in paths:
+            try:
+                if path.suffix == LEGACY_SUFFIX:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    meta, count = data, len(data.get("messages", []))
+                else:
+                    with self._lock:
+                        state = self._state(path)
+                    meta, count = state.meta, state.message_count
+            except Exception:
+                continue
+            histories.append({
+                "filename": path.name,
+                "filepath": path,
+                "title": meta.get("title", "無題"),
+                "timestamp": meta.get("timestamp", ""),
+                "message_count": count,
+            })
+        return histories
+
+    # 書き込み
+
+    def save(self, conversation_id: str, messages: List[Dict], title: Optional[str] = None,
+             selected_prompt: Optional[Dict] = None, attachments: Optional[List[Dict]] = None,
+             rename: bool = False) -> Path:
+        """
+        会話を保存する。既存の会話なら前回から増えたメッセージだけを追記する
+        title は新規作成時のみ使い、既存の会話では rename=True の場合だけ変更する
+        """
+        path = self.path_for(conversation_id)
+        with self._locked():
+            state = self._state(path)
+            if state is not None:
+                self._repair(path, state)
+            if state is None:
+                meta = {
+                    "title": title or "無題",
+                    "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
+                    "selected_prompt": selected_prompt,
+                    "attachments": attachments or [],
+                }
+                self._rewrite(path, meta, messages)
+                return path
+
+            if len(messages) < state.message_count:
+                # 履歴が追記でなくなった (短くなった) 場合は書き直す
+                meta = dict(state.meta, selected_prompt=selected_prompt, attachments=attachments or [])
+                if rename and title:
+                    meta["title"] = title
+                self._rewrite(path, meta, messages)
+                return path
+
+            changes = {}
+            if rename and title and title != state.meta.get("title"):
+                changes["title"] = title
+            if selected_prompt != state.meta.get("selected_prompt"):
+                changes["selected_prompt"] = selected_prompt
+            if (attachments or []) != state.meta.get("attachments", []):
+                changes["attachments"] = attachments or []
+
+            new_messages = messages[state.message_count:]
+            lines = []
+            if changes:
+                lines.append(_dump({"type": "meta", **changes}))
+            lines.extend(_dump({"type": "message", **m}) for m in new_messages)
+            if lines:
+                state.size = state.complete = self._append(path, lines)
+                start = state.message_count
+                state.meta.update(changes)
+                state.message_count = len(messages)
+                state.meta_records += 1 if changes else 0
+                if state.meta_records > COMPACT_META_THRESHOLD:
+                    self._rewrite(path, state.meta, None)
+                elif self.search_index is not None:
+                    if new_messages:
+                        self.search_index.add_messages(path, state.meta, new_messages, start)
+                    else:
+                        self.search_index.update_meta(path, state.meta, state.message_count)
+        return path
+
+    def append(self, conversation_id: str, message: Dict) -> Path:
+        """完了したメッセージを1件追記する (会話が未作成なら作成する)"""
+        path = self.path_for(conversation_id)
+        with self._locked():
+            state = self._state(path)
+            if state is not None:
+                self._repair(path, state)
+            if state is None:
+                meta = {"title": "無題", "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
+                        "selected_prompt": None, "attachments": []}
+                self._rewrite(path, meta, [message])
+                return path
+            state.size = state.complete = self._append(path, [_dump({"type": "message", **message})])
+            state.message_count += 1
+            if self.search_index is not None:
+                self.search_index.add_messages(path, state.meta, [message], state.message_count - 1)
+        return path
+
+    def delete(self, filename: str) -> bool:
+        path = self.resolve(filename)
+        if path is None:
+            return False
+        with self._locked():
+            path.unlink(missing_ok=True)
+            self._states.pop(path, None)
+            self._unsynced.discard(path)
+            if self.search_index is not None:
+                self.search_index.remove(path.name)
+        return True
+
+    def compact(self, filename: str) -> bool:
+        """メタ情報の行を1行にまとめて書き直す"""
+        path = self.resolve(filename)
+        if path is None or path.suffix != SEGMENT_SUFFIX:
+            return False
+        with self._locked():
+            state = self._state(path)
+            self._rewrite(path, state.meta, None)
+        return True
+
+    def _append(self, path: Path, lines: List[str]) -> int:
+        """追記して、追記後のファイルサイズを返す"""
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("".join(lines))
+            f.flush()
+            size = os.fstat(f.fileno()).st_size
+        self._unsynced.add(path)
+        if time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync_locked()
+        return size
+
+    def _rewrite(self, path: Path, meta: Dict, messages: Optional[List[Dict]]):
+        """メタ情報1行 + メッセージでファイルを書き直す (messages=None なら既存のメッセージを使う)"""
+        if messages is None:
+            messages = self.load(path.name)["messages"] if path.exists() else []
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(_dump({"type": "meta", **{k: meta.get(k) for k in META_FIELDS}}))
+            f.writelines(_dump({"type": "message", **m}) for m in messages)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._states[path] = _SegmentState(dict(meta), len(messages), 1, path.stat().st_size)
+        self._unsynced.discard(path)
+        if self.search_index is not None:
+            self.search_index.replace(path, meta, messages)
+
+    def _sync_locked(self):
+        for path in list(self._unsynced):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._unsynced.clear()
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        """未fsyncの追記をディスクに確定させる"""
+        with self._lock:
+            self._sync_locked()
@@ -0,0 +1,141 @@
+"""
+会話ごとの添付資料チャンク索引 (BM25)
+
+大きな添付資料は全文を毎ターン送らず、チャンクに分けて会話ごとに索引しておき、
+今回の質問に関係する上位k件だけを最新のユーザー発言に添えて送ります。
+添付が何十件あっても1ターンのプロンプトは抜粋の分しか増えません。
+
+- 小さな資料 (min_tokens 未満) は従来どおり会話に固定し、プロンプトキャッシュを効かせる
+- 語の単位は文字2-gram (日本語を分かち書きなしで扱う。外部ライブラリ不要)
+- 索引は会話のキー (会話ID・セッションID) ごとにプロセス内でキャッシュし、資料が増えたら差分だけ追加する。
+  保存済みの履歴を開いたときは、履歴に含まれる添付資料から作り直す
+"""
+
+import heapq
+import math
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from doc_chunker import chunk_text, estimate_tokens
+
+
+RETRIEVAL_HEADER = "以下は添付資料のうち、今回の質問に関係しそうな部分の抜粋です。回答の根拠として参照してください。"
+
+
+def _terms(text: str) -> List[str]:
+    text = "".join(unicodedata.normalize("NFKC", text).lower().split())
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+class ChunkIndex:
+    """1つの会話の添付資料チャンクのBM25索引"""
+
+    def __init__(self, chunk_tokens: int = 600, overlap_tokens: int = 60, k1: float = 1.5, b: float = 0.75):
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.k1 = k1
+        self.b = b
+        self.chunks: List[Dict] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths: List[int] = []
+        self._digests: List[str] = []
+        self._lock = threading.Lock()
+
+    def _add(self, attachment: Dict):
+        for chunk in chunk_text(attachment["content"], self.chunk_tokens, self.overlap_tokens):
+            chunk_id = len(self.chunks)
+            chunk["name"] = attachment["name"]
+            self.chunks.append(chunk)
+            counts = Counter(_terms(chunk["text"]))
+            self._lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self._postings.setdefault(term, []).append((chunk_id, tf))
+        self._digests.append(attachment["digest"])
+
+    def sync(self, attachments: List[Dict]):
+        """添付資料の一覧に合わせる (追加分だけ索引し、削除があれば作り直す)"""
+        digests = [a["digest"] for a in attachments]
+        with self._lock:
+            if any(d not in digests for d in self._digests):
+                self.chunks, self._postings, self._lengths, self._digests = [], {}, [], []
+            for attachment in attachments:
+                if attachment["digest"] not in self._digests:
+                    self._add(attachment)
+
+    def search(self, query: str, top_k: int = 5) -> List[Dict]:
+        """関連度の高い上位k件のチャンクを、資料中の順に並べて返す (score 付き)"""
+        with self._lock:
+            if not self.chunks:
+                return []
+            count = len(self.chunks)
+            average = sum(self._lengths) / count or 1.0
+            scores: Dict[int, float] = {}
+            for term in set(_terms(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1.0 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings:
+                    norm = tf + self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / average)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+            best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            return [dict(self.chunks[chunk_id], score=score) for chunk_id, score in sorted(best)]
+
+
+class ChunkIndexCache:
+    """会話のキーごとの索引 (件数上限付きLRU)"""
+
+    def __init__(self, max_entries: int = 256, chunk_tokens: int = 600, overlap_tokens: int = 60):
+        self.max_entries = max_entries
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self._indexes: "OrderedDict[str, ChunkIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> ChunkIndex:
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = self._indexes[key] = ChunkIndex(self.chunk_tokens, self.overlap_tokens)
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+            return index
+
+    def discard(self, key: str):
+        with self._lock:
+            self._indexes.pop(key, None)
+
+
+def partition_attachments(attachments: List[Dict], min_tokens: int) -> Tuple[List[Dict], List[Dict]]:
+    """(全文を固定する小さな資料, 索引して抜粋だけ送る大きな資料) に分ける"""
+    pinned, indexed = [], []
+    for attachment in attachments:
+        large = min_tokens > 0 and estimate_tokens(attachment["content"]) >= min_tokens
+        (indexed if large else pinned).append(attachment)
+    return pinned, indexed
+
+
+def format_context(chunks: List[Dict]) -> str:
+    blocks = []
+    for chunk in chunks:
+        label = f" {chunk['label'].strip('-= ')}" if chunk.get("label") else ""
+        blocks.append(f"--- 📎 {chunk['name']}{label} ---\n{chunk['text']}")
+    return RETRIEVAL_HEADER + "\n\n" + "\n\n".join(blocks)
+
+
+def retrieve_attachments(cache: ChunkIndexCache, key: str, attachments: List[Dict], query: str,
+                         top_k: int = 6, min_tokens: int = 2000) -> Tuple[List[Dict], Optional[str]]:
+    """
+    添付資料を (会話に固定する資料, 今回の発言に添える抜粋) に変換する
+    大きな資料がなければ抜粋は None
+    """
+    pinned, indexed = partition_attachments(attachments, min_tokens)
+    if not indexed:
+        return pinned, None
+    index = cache.get(key)
+    index.sync(indexed)
+    chunks = index.search(query, top_k)
+    return pinned, format_context(chunks) if chunks else None
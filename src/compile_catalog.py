@@ -0,0 +1,208 @@
+"""
+prompts_data コンパイラ
+
+全カテゴリのJSONを一度に検証・正規化し、各フロントエンド(CLI/Streamlit/FastAPI)が
+生ファイルの代わりに読み込む build/catalog.json を出力します。
+検証コストはビルド時に一度だけ払い、リクエストごとには払いません。
+
+- スキーマ検証: id(int) / title / system_prompt / recommended_attachments(list[str])
+- Unicode正規化: NFC、全角英数字→半角、半角カナ→全角
+- グローバルID: `カテゴリ:id` (カテゴリ内のid重複はエラー、idの欠落は自動採番)
+- 出力: 最小化JSON + タイトル正規化キー + グローバルID索引 + カテゴリごとの統計
+
+使用例:
+  python src/compile_catalog.py
+  python src/compile_catalog.py --check   # 検証のみ(成果物を書き出さない)
+"""
+
+import argparse
+import json
+import os
+import sys
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from prompt_catalog import (
+    ARTIFACT_VERSION, CatalogError, default_artifact_path, normalize_title, prompt_stats, prompt_uid, source_stamp,
+)
+
+
+REQUIRED_FIELDS = ("title", "system_prompt", "recommended_attachments")
+
+# 全角英数字 (Ａ-Ｚ, ａ-ｚ, ０-９) → 半角
+_FULLWIDTH_ALNUM = {
+    code: code - 0xFEE0
+    for code in list(range(0xFF10, 0xFF1A)) + list(range(0xFF21, 0xFF3B)) + list(range(0xFF41, 0xFF5B))
+}
+
+
+def normalize_text(text: str) -> str:
+    """表記揺れを正規化する(NFC、全角英数字→半角、半角カナ→全角)"""
+    text = text.translate(_FULLWIDTH_ALNUM)
+    # 半角カナ(U+FF61-U+FF9F)だけをNFKCで全角に寄せる
+    if any("｡" <= ch <= "ﾟ" for ch in text):
+        text = "".join(
+            unicodedata.normalize("NFKC", ch) if "｡" <= ch <= "ﾟ" else ch
+            for ch in text
+        )
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def validate_prompt(prompt, where: str, errors: List[str]) -> bool:
+    """1件のプロンプトを検証する。問題があればerrorsに追記しFalseを返す"""
+    if not isinstance(prompt, dict):
+        errors.append(f"{where}: オブジェクトではありません")
+        return False
+
+    ok = True
+    if "id" in prompt and (not isinstance(prompt["id"], int) or isinstance(prompt["id"], bool)):
+        errors.append(f"{where}: id は整数である必要があります ({prompt['id']!r})")
+        ok = False
+    for field in REQUIRED_FIELDS:
+        if field not in prompt:
+            errors.append(f"{where}: {field} がありません")
+            ok = False
+    for field in ("title", "system_prompt"):
+        if field in prompt and (not isinstance(prompt[field], str) or not prompt[field].strip()):
+            errors.append(f"{where}: {field} は空でない文字列である必要があります")
+            ok = False
+    attachments = prompt.get("recommended_attachments")
+    if attachments is not None and (not isinstance(attachments, list) or not all(isinstance(a, str) for a in attachments)):
+        errors.append(f"{where}: recommended_attachments は文字列のリストである必要があります")
+        ok = False
+    return ok
+
+
+def canonicalize_prompt(prompt: Dict) -> Dict:
+    """フィールド順を固定し、文字列を正規化したプロンプトを返す"""
+    return {
+        "id": prompt["id"],
+        "title": normalize_text(prompt["title"]),
+        "system_prompt": normalize_text(prompt["system_prompt"]),
+        "recommended_attachments": [normalize_text(a) for a in prompt["recommended_attachments"]],
+    }
+
+
+def compile_category(name: str, data, errors: List[str], warnings: List[str]) -> Dict:
+    """1カテゴリ分を検証・正規化する"""
+    if not isinstance(data, dict) or not isinstance(data.get("prompts"), list):
+        errors.append(f"{name}: 'prompts' 配列がありません")
+        return {}
+    if not isinstance(data.get("category"), str) or not data["category"].strip():
+        errors.append(f"{name}: 'category' (表示名) がありません")
+
+    valid = []
+    for pos, prompt in enumerate(data["prompts"]):
+        if validate_prompt(prompt, f"{name}[{pos}]", errors):
+            valid.append(prompt)
+
+    # id の重複検出と欠落分の採番(既存の最大値の続きから、ファイル内の順序で安定)
+    seen: Dict[int, int] = {}
+    for pos, prompt in enumerate(valid):
+        if "id" not in prompt:
+            continue
+        if prompt["id"] in seen:
+            errors.append(f"{name}: id {prompt['id']} が重複しています (#{seen[prompt['id']]} と #{pos})")
+        else:
+            seen[prompt["id"]] = pos
+    next_id = max(seen, default=0) + 1
+    prompts = []
+    for prompt in valid:
+        if "id" not in prompt:
+            prompt = dict(prompt, id=next_id)
+            warnings.append(f"{name}: 「{prompt['title']}」に id {next_id} を割り当てました")
+            next_id += 1
+        prompts.append(canonicalize_prompt(prompt))
+
+    return {
+        "category": normalize_text(data.get("category", name) or name),
+        "count": len(prompts),
+        "prompts": prompts,
+        "title_keys": [normalize_title(p["title"]) for p in prompts],
+        "stats": prompt_stats(prompts),
+    }
+
+
+def compile_catalog(prompts_dir: Path) -> Tuple[Dict, List[str]]:
+    """
+    全ファイルを1パスで検証・正規化して成果物を組み立てる
+    エラーがあればCatalogErrorを送出する。戻り値は (成果物, 警告)
+    """
+    prompts_dir = Path(prompts_dir)
+    stamp = source_stamp(prompts_dir)
+    errors: List[str] = []
+    warnings: List[str] = []
+    categories = {}
+
+    for file_name in stamp:
+        name = Path(file_name).stem
+        try:
+            with open(prompts_dir / file_name, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            errors.append(f"{name}: JSONを読み込めません ({e})")
+            continue
+        entry = compile_category(name, data, errors, warnings)
+        if entry:
+            categories[name] = entry
+
+    index = {}
+    for name, entry in categories.items():
+        for pos, prompt in enumerate(entry["prompts"]):
+            index[prompt_uid(name, prompt["id"])] = [name, pos]
+
+    if errors:
+        raise CatalogError(errors)
+
+    artifact = {
+        "version": ARTIFACT_VERSION,
+        "sources": stamp,
+        "total": sum(entry["count"] for entry in categories.values()),
+        "categories": categories,
+        "index": index,
+    }
+    return artifact, warnings
+
+
+def write_artifact(artifact: Dict, path: Path):
+    """成果物を最小化JSONとしてアトミックに書き出す"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='prompts_data を検証・正規化して build/catalog.json を生成')
+    parser.add_argument('--prompts-dir', type=str, default='prompts_data',
+                       help='プロンプトデータのディレクトリ (デフォルト: prompts_data)')
+    parser.add_argument('--out', type=str,
+                       help='出力先 (デフォルト: <prompts_dirの親>/build/catalog.json)')
+    parser.add_argument('--check', action='store_true',
+                       help='検証のみ行い成果物は書き出さない')
+    args = parser.parse_args()
+
+    prompts_dir = Path(args.prompts_dir)
+    try:
+        artifact, warnings = compile_catalog(prompts_dir)
+    except CatalogError as e:
+        print(f"✗ 検証エラー ({len(e.errors)}件):")
+        for error in e.errors:
+            print(f"  • {error}")
+        sys.exit(1)
+
+    for warning in warnings:
+        print(f"警告: {warning}")
+
+    print(f"✓ 検証OK: {len(artifact['categories'])}カテゴリ / {artifact['total']}個のプロンプト")
+    if not args.check:
+        out_path = Path(args.out) if args.out else default_artifact_path(prompts_dir)
+        write_artifact(artifact, out_path)
+        print(f"✓ 生成完了: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+抽出したテキストのチャンク分割
+
+ファイルから抽出したテキスト (ページは「--- ページ N ---」、シートは「=== シート: 名前 ===」で始まる) を、
+トークン数の上限つきで、前のチャンクと少し重なるように分割します。
+
+- 区切りはページ・段落(空行)を優先し、それでも大きい段落は行、最後は文字数で切る
+- 各チャンクの先頭にはどのページ(シート)の続きかを付け、答えの根拠を示せるようにする
+- トークン数は他の箇所と同じく 1トークン ≒ 4文字 で概算する
+"""
+
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+SECTION_MARKER = re.compile(r"^(--- ページ \d+ ---|=== シート: .* ===)$")
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def _split_oversized(text: str, max_chars: int) -> Iterator[str]:
+    """上限を超える段落を行単位、それでも長い行は文字数で切る"""
+    buffer = ""
+    for line in text.split("\n"):
+        while len(line) > max_chars:
+            if buffer:
+                yield buffer
+                buffer = ""
+            yield line[:max_chars]
+            line = line[max_chars:]
+        if buffer and len(buffer) + 1 + len(line) > max_chars:
+            yield buffer
+            buffer = line
+        else:
+            buffer = f"{buffer}\n{line}" if buffer else line
+    if buffer:
+        yield buffer
+
+
+def _units(text: str, max_chars: int) -> Iterator[Tuple[str, Optional[str]]]:
+    """(段落, その段落が属するページ・シートの見出し) を順に返す"""
+    label = None
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip("\n")
+        if not paragraph.strip():
+            continue
+        first_line = paragraph.split("\n", 1)[0]
+        if SECTION_MARKER.match(first_line):
+            label = first_line
+        for piece in _split_oversized(paragraph, max_chars):
+            yield piece, label
+
+
+def chunk_text(text: str, max_tokens: int = 4000, overlap_tokens: int = 200) -> List[Dict]:
+    """
+    テキストをチャンクに分割する
+    戻り値は {"index", "text", "tokens", "label"} のリスト (label は先頭の段落が属するページ・シート)
+    """
+    max_chars = max_tokens * 4
+    overlap_chars = overlap_tokens * 4
+    chunks: List[Dict] = []
+    current: List[Tuple[str, Optional[str]]] = []
+    size = 0
+
+    def flush():
+        parts = [unit for unit, _ in current]
+        label = current[0][1]
+        if label and not parts[0].startswith(label):
+            # ページの途中から始まる場合は見出しを補う
+            parts.insert(0, f"{label} (続き)")
+        body = "\n\n".join(parts)
+        chunks.append({"index": len(chunks), "text": body, "tokens": estimate_tokens(body), "label": label})
+
+    for unit, label in _units(text, max_chars):
+        if current and size + len(unit) + 2 > max_chars:
+            flush()
+            # 直前のチャンクの末尾を重なりとして引き継ぐ
+            carried: List[Tuple[str, Optional[str]]] = []
+            carried_size = 0
+            for previous in reversed(current):
+                if carried_size + len(previous[0]) > overlap_chars or carried_size + len(previous[0]) + len(unit) > max_chars:
+                    break
+                carried.insert(0, previous)
+                carried_size += len(previous[0]) + 2
+            current, size = carried, carried_size
+        current.append((unit, label))
+        size += len(unit) + 2
+    if current:
+        flush()
+    return chunks
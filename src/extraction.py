@@ -0,0 +1,428 @@
+"""
+添付ファイルの構造化抽出
+
+ファイルの中身を1本の文字列ではなく、ページ・シート・段落などの単位 (Unit) の並びとして取り出します。
+単位ごとに全文中の位置 (offset)・文字数・トークン数・ハッシュを持つので、切り詰めや分割は
+巨大な文字列を走査し直さずに単位の境界で行えます。
+
+- 全文 (text) は従来と同じ形式 (「--- ページ N ---」「=== シート: 名前 ===」の見出し、単位の間は空行)
+- トークン上限 (max_tokens) を渡すと、上限を超えた時点で読むのをやめ、続きの位置 (next) を覚えておく。
+  後でもっと必要になったら、続きの単位だけを読み足す (resume)
+- 抽出結果は JSONL (1行目がヘッダ、以降1行1単位) で保存でき、ExtractionCache はファイルの
+  SHA-1・形式・抽出の設定 (PDFエンジンなど) をキーに gzip して保存する。同じファイルを再度
+  アップロードしても解析し直さない (拡張子や設定が変われば別の結果として抽出する)
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+import zipfile
+from bisect import bisect_right
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from xml.etree import ElementTree
+
+import pandas as pd
+
+from doc_chunker import estimate_tokens
+from pdf_engine import get_pdf_engine
+
+
+FORMAT_VERSION = 1
+SEPARATOR = "\n\n"
+TEXT_BLOCK_CHARS = 4000  # テキストファイルを単位に分けるときの目安
+
+FILE_TYPES = {
+    ".pdf": "pdf",
+    ".docx": "word",
+    ".xlsx": "excel",
+    ".xls": "excel",
+    ".csv": "csv",
+}
+
+
+class ExtractionError(ValueError):
+    """ファイルから内容を取り出せない (利用者に表示するメッセージを持つ)"""
+
+
+class Unit(NamedTuple):
+    """抽出結果の1単位 (PDFの1ページ、Excelの1シート、Wordの1段落など)"""
+    kind: str       # page / sheet / paragraph / table / text
+    label: str      # 見出し (「--- ページ 3 ---」など。なければ空)
+    text: str       # 本文 (見出しを含まない)
+    position: int   # 元ファイル内の位置 (ページ・シート・段落の番号。続きを読むときに使う)
+    offset: int     # 全文 (text) での開始位置
+    chars: int      # 見出しを含めた文字数
+    tokens: int
+    digest: str
+
+    @property
+    def rendered(self) -> str:
+        return f"{self.label}\n{self.text}" if self.label else self.text
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class ExtractedDocument:
+    """単位の並びとしての抽出結果"""
+
+    def __init__(self, name: str, file_type: str, source: str = "", meta: Optional[Dict] = None):
+        self.name = name
+        self.file_type = file_type
+        self.source = source  # 元ファイルの SHA-1
+        self.meta: Dict = meta or {}
+        self.units: List[Unit] = []
+        self.next: Optional[int] = None  # 上限で読むのをやめた場合、続きの位置
+        self._offsets: List[int] = []
+        self._text: Optional[str] = None
+
+    def add(self, kind: str, label: str, text: str, position: int, digest: Optional[str] = None) -> Unit:
+        rendered = f"{label}\n{text}" if label else text
+        offset = self.chars + len(SEPARATOR) if self.units else 0
+        unit = Unit(kind, label, text, position, offset, len(rendered), estimate_tokens(rendered),
+                    digest or _digest(rendered))
+        self.units.append(unit)
+        self._offsets.append(offset)
+        self._text = None
+        return unit
+
+    @property
+    def complete(self) -> bool:
+        return self.next is None
+
+    @property
+    def chars(self) -> int:
+        if not self.units:
+            return 0
+        last = self.units[-1]
+        return last.offset + last.chars
+
+    @property
+    def tokens(self) -> int:
+        return self.chars // 4
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = SEPARATOR.join(unit.rendered for unit in self.units)
+        return self._text
+
+    def truncate(self, max_tokens: int) -> Tuple[str, bool]:
+        """
+        全文を max_tokens までに切り詰める (戻り値は (本文, 切り詰めたか))
+        上限の直前で終わる単位の境界か、上限を含む単位の中の最後の改行で切る (どちらも上限の90%以降にある場合)
+        """
+        max_chars = max_tokens * 4
+        if self.chars <= max_chars:
+            return self.text, not self.complete
+        i = bisect_right(self._offsets, max_chars) - 1
+        unit = self.units[i]
+        cut = max_chars - unit.offset
+        if cut >= unit.chars:
+            # 上限が単位の間の区切りにある
+            return SEPARATOR.join(u.rendered for u in self.units[:i + 1]), True
+        body = unit.rendered[:cut]
+        last_newline = body.rfind("\n")
+        if last_newline >= 0 and unit.offset + last_newline > max_chars * 0.9:
+            body = body[:last_newline]
+        elif i > 0 and unit.offset - len(SEPARATOR) > max_chars * 0.9:
+            body = ""
+        parts = [u.rendered for u in self.units[:i]]
+        if body:
+            parts.append(body)
+        return SEPARATOR.join(parts), True
+
+    def to_jsonl(self) -> str:
+        header = {"v": FORMAT_VERSION, "name": self.name, "type": self.file_type, "source": self.source,
+                  "meta": self.meta, "next": self.next}
+        lines = [json.dumps(header, ensure_ascii=False)]
+        lines.extend(json.dumps([u.kind, u.label, u.text, u.position, u.digest], ensure_ascii=False)
+                     for u in self.units)
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def from_jsonl(cls, data: str) -> "ExtractedDocument":
+        lines = data.splitlines()
+        header = json.loads(lines[0])
+        if header.get("v") != FORMAT_VERSION:
+            raise ValueError(f"未対応の形式です: {header.get('v')}")
+        document = cls(header["name"], header["type"], header["source"], header["meta"])
+        for line in lines[1:]:
+            kind, label, text, position, digest = json.loads(line)
+            document.add(kind, label, text, position, digest)
+        document.next = header["next"]
+        return document
+
+
+# 形式ごとの抽出 (position から先の単位を (position, kind, label, text) で順に返す)
+
+def _pdf_units(data: bytes, document: ExtractedDocument, start: int) -> Iterator[Tuple[int, str, str, str]]:
+    engine = get_pdf_engine()
+    document.meta["pages"] = engine.page_count(data)
+    # ページごとにどちらのエンジンで読んだか (fast / layout)
+    stats = document.meta.setdefault("engines", {})
+    for i, page_text in engine.pages(data, start, stats):
+        if page_text:
+            yield i, "page", f"--- ページ {i + 1} ---", page_text
+
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _run_text(paragraph) -> str:
+    """段落の文字列 (w:pPr のタブ位置などは含めない)"""
+    parts = []
+    for run in paragraph.iter(f"{WORD_NS}r"):
+        for node in run:
+            if node.tag == f"{WORD_NS}t":
+                parts.append(node.text or "")
+            elif node.tag == f"{WORD_NS}tab":
+                parts.append("\t")
+            elif node.tag in (f"{WORD_NS}br", f"{WORD_NS}cr"):
+                parts.append("\n")
+    return "".join(parts)
+
+
+def _table_text(table) -> str:
+    """表を1行1レコードの「| セル | セル |」形式にする (入れ子の表はセルの文字列に含める)"""
+    rows = []
+    for row in table.iterfind(f"{WORD_NS}tr"):
+        cells = [
+            " ".join(text for text in (_run_text(p).strip() for p in cell.iter(f"{WORD_NS}p")) if text)
+            for cell in row.iterfind(f"{WORD_NS}tc")
+        ]
+        if any(cells):
+            rows.append("| " + " | ".join(cell.replace("\n", " ") for cell in cells) + " |")
+    return "\n".join(rows)
+
+
+def _docx_units(data: bytes, document: ExtractedDocument, start: int) -> Iterator[Tuple[int, str, str, str]]:
+    """
+    word/document.xml を先頭から少しずつ解析し、本文直下の段落と表を文書の順に返す
+    python-docx のように文書全体のオブジェクトを作らず、処理した要素はすぐ捨てる
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        try:
+            stream = archive.open("word/document.xml")
+        except KeyError:
+            raise ExtractionError("Wordファイルの本文 (word/document.xml) が見つかりません")
+        with stream:
+            depth = 0
+            body = None
+            position = 0
+            for event, element in ElementTree.iterparse(stream, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if depth == 2 and element.tag == f"{WORD_NS}body":
+                        body = element
+                    continue
+                depth -= 1
+                if depth != 2 or body is None:
+                    continue
+                # 本文直下の要素 (段落・表・コンテンツコントロール)
+                if position >= start:
+                    if element.tag == f"{WORD_NS}p":
+                        text = _run_text(element)
+                        if text.strip():
+                            document.meta["paragraphs"] = document.meta.get("paragraphs", 0) + 1
+                            yield position, "paragraph", "", text
+                    elif element.tag == f"{WORD_NS}tbl":
+                        text = _table_text(element)
+                        if text:
+                            document.meta["tables"] = document.meta.get("tables", 0) + 1
+                            yield position, "table", "", text
+                    elif element.tag == f"{WORD_NS}sdt":
+                        text = "\n".join(t for t in (_run_text(p) for p in element.iter(f"{WORD_NS}p")) if t.strip())
+                        if text:
+                            yield position, "paragraph", "", text
+                position += 1
+                element.clear()
+                body.remove(element)
+
+
+def _excel_units(data: bytes, document: ExtractedDocument, start: int) -> Iterator[Tuple[int, str, str, str]]:
+    excel_file = pd.ExcelFile(io.BytesIO(data))
+    document.meta["sheets"] = len(excel_file.sheet_names)
+    for i in range(start, len(excel_file.sheet_names)):
+        name = excel_file.sheet_names[i]
+        df = pd.read_excel(excel_file, sheet_name=name)
+        text = f"行数: {len(df)}, 列数: {len(df.columns)}\n\n" + df.to_string(index=False)
+        yield i, "sheet", f"=== シート: {name} ===", text
+
+
+def _csv_units(data: bytes, document: ExtractedDocument, start: int) -> Iterator[Tuple[int, str, str, str]]:
+    if start > 0:
+        return
+    for encoding in ["utf-8", "shift_jis", "cp932"]:
+        try:
+            df = pd.read_csv(io.StringIO(data.decode(encoding)))
+        except (UnicodeDecodeError, pd.errors.ParserError):
+            continue
+        document.meta["rows"] = len(df)
+        document.meta["columns"] = len(df.columns)
+        yield 0, "table", "", f"行数: {len(df)}, 列数: {len(df.columns)}\n\n" + df.to_string(index=False)
+        return
+    raise ExtractionError("CSVファイルのエンコーディングを判別できませんでした")
+
+
+def _text_units(data: bytes, document: ExtractedDocument, start: int) -> Iterator[Tuple[int, str, str, str]]:
+    for encoding in ["utf-8", "shift_jis", "cp932", "latin-1"]:
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    # 空行で区切った段落を TEXT_BLOCK_CHARS 程度ずつまとめる (つなぎ直すと元の文字列に戻る)
+    pieces = text.split(SEPARATOR)
+    block: List[str] = []
+    size = 0
+    block_start = 0
+    for i, piece in enumerate(pieces):
+        if block and size + len(piece) > TEXT_BLOCK_CHARS:
+            if block_start >= start:
+                yield block_start, "text", "", SEPARATOR.join(block)
+            block, size, block_start = [], 0, i
+        block.append(piece)
+        size += len(piece) + len(SEPARATOR)
+    if block_start >= start:
+        yield block_start, "text", "", SEPARATOR.join(block)
+
+
+EXTRACTORS = {
+    "pdf": _pdf_units,
+    "word": _docx_units,
+    "excel": _excel_units,
+    "csv": _csv_units,
+    "text": _text_units,
+}
+
+EMPTY_MESSAGES = {
+    "pdf": "PDFからテキストを抽出できませんでした",
+    "word": "Wordファイルからテキストを抽出できませんでした",
+}
+
+
+def file_type_for(name: str) -> str:
+    suffix = Path(name).suffix.lower()
+    if suffix == ".doc":
+        raise ExtractionError(".doc形式は非対応です。.docx形式に変換してください")
+    return FILE_TYPES.get(suffix, "text")
+
+
+def extractor_settings(file_type: str) -> str:
+    """抽出結果を左右する設定 (キャッシュのキーに含める。設定のない形式は空)"""
+    if file_type == "pdf":
+        return get_pdf_engine().settings
+    return ""
+
+
+def extract(data: bytes, name: str, max_tokens: Optional[int] = None,
+            resume: Optional[ExtractedDocument] = None, source: Optional[str] = None) -> ExtractedDocument:
+    """
+    ファイルの中身を単位の並びとして取り出す
+    max_tokens を超えたらそこで止める (next に続きの位置が残る)。resume には途中まで読んだ結果を渡す
+    """
+    file_type = file_type_for(name)
+    if resume is not None:
+        document = resume
+        document.name = name
+        start, document.next = resume.next, None
+        if start is None:
+            return document
+    else:
+        document = ExtractedDocument(name, file_type, source or hashlib.sha1(data).hexdigest())
+        start = 0
+    max_chars = max_tokens * 4 if max_tokens is not None else None
+    units = EXTRACTORS[file_type](data, document, start)
+    try:
+        for position, kind, label, text in units:
+            document.add(kind, label, text, position)
+            if max_chars is not None and document.chars > max_chars:
+                document.next = position + 1
+                break
+    finally:
+        units.close()
+    if document.complete and not document.units and file_type in EMPTY_MESSAGES:
+        raise ExtractionError(EMPTY_MESSAGES[file_type])
+    return document
+
+
+class ExtractionCache:
+    """
+    抽出結果のディスクキャッシュ (元ファイルの SHA-1・形式・抽出の設定ごとに gzip した JSONL を1ファイル)
+    上限を超えたら更新の古いものから消す。書き込みは一時ファイルからの置き換えなので複数プロセスで共有できる
+    """
+
+    def __init__(self, directory, max_files: int = 256):
+        self.directory = Path(directory)
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(source: str, file_type: str) -> str:
+        """同じ中身でも形式や設定が違えば抽出結果は変わるので、どちらもキーに含める"""
+        settings = extractor_settings(file_type)
+        if settings:
+            return f"{source}-{file_type}-{hashlib.sha1(settings.encode('utf-8')).hexdigest()[:8]}"
+        return f"{source}-{file_type}"
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.jsonl.gz"
+
+    def load(self, key: str) -> Optional[ExtractedDocument]:
+        try:
+            with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+                return ExtractedDocument.from_jsonl(f.read())
+        except (OSError, ValueError, KeyError, IndexError):
+            return None
+
+    def store(self, key: str, document: ExtractedDocument):
+        if self.max_files <= 0:
+            return
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=3) as f:
+                f.write(document.to_jsonl())
+            os.replace(tmp, path)
+            self._prune()
+
+    def _prune(self):
+        entries = []
+        for path in self.directory.glob("*.jsonl.gz"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_files)]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def extract(self, data: bytes, name: str, max_tokens: Optional[int] = None) -> Tuple[ExtractedDocument, str]:
+        """
+        キャッシュを使って抽出する。戻り値は (抽出結果, hit / resume / miss)
+        途中までのキャッシュで足りなければ、続きの単位だけを読み足して保存し直す
+        """
+        source = hashlib.sha1(data).hexdigest()
+        file_type = file_type_for(name)
+        key = self.key_for(source, file_type)
+        cached = self.load(key) if self.max_files > 0 else None
+        if cached is not None and cached.file_type == file_type:
+            cached.name = name
+            if cached.complete or (max_tokens is not None and cached.chars > max_tokens * 4):
+                return cached, "hit"
+            document = extract(data, name, max_tokens, resume=cached)
+            self.store(key, document)
+            return document, "resume"
+        document = extract(data, name, max_tokens, source=source)
+        self.store(key, document)
+        return document, "miss"
@@ -3,6 +3,7 @@ AIGenPrompts4U - システムプロンプト生成アプリケーション
 
 このアプリケーションは、様々なカテゴリのシステムプロンプトを生成します。
 - サンプルから10個をランダム抽出
+- 複数カテゴリをまたいだ重み付き抽出(--mix)
 - OpenAI APIを使用して新規作成(オプション)
 """
 
@@ -13,6 +14,9 @@ from pathlib import Path
 from typing import List, Dict, Optional
 import argparse
 
+from prompt_catalog import PromptCatalog, parse_mix
+from prompt_usage import UsageTracker
+
 
 class PromptGenerator:
     """システムプロンプト生成クラス"""
@@ -21,6 +25,7 @@ class PromptGenerator:
         self.prompts_dir = Path(prompts_dir)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
+        self._catalog: Optional[PromptCatalog] = None
         
         # 利用可能なカテゴリ
         self.categories = {
@@ -40,48 +45,25 @@ class PromptGenerator:
             "meeting": "会議カンペ作成用"
         }
     
+    @property
+    def catalog(self) -> PromptCatalog:
+        """全カテゴリを一度だけ読み込んだ共有インデックス"""
+        if self._catalog is None:
+            self._catalog = PromptCatalog(str(self.prompts_dir))
+        return self._catalog
+    
     def list_categories(self) -> Dict[str, str]:
         """利用可能なカテゴリを表示"""
         return self.categories
     
     def load_prompts(self, category: str) -> List[Dict]:
         """指定カテゴリのプロンプトを読み込む"""
-        file_map = {
-            "industry": "industry.json",
-            "idea": "idea.json",
-            "management": "management.json",
-            "sales": "sales.json",
-            "summary": "summary.json",
-            "engineer": "engineer.json",
-            "email": "email.json",
-            "negotiation": "negotiation.json",
-            "meeting": "meeting.json",
-            "consultant": "consultant.json",
-            "medical": "medical.json",
-            "investment": "investment.json",
-            "dating": "dating.json",
-            "job_interview": "job_interview.json",
-            "education": "education.json",
-            "legal": "legal.json",
-            "sns_content": "sns_content.json",
-            "startup": "startup.json",
-            "programmer": "programmer.json",
-            "python_engineer": "python_engineer.json",
-            "ai_engineer": "ai_engineer.json",
-            "chatgpt_api": "chatgpt_api.json"
-        }
-        
-        if category not in file_map:
+        # カタログに読み込まれているカテゴリ (prompts_data の全ファイル) をそのまま使う
+        data = self.catalog.get(category)
+        if data is None:
             raise ValueError(f"カテゴリ '{category}' は現在準備中です。")
         
-        file_path = self.prompts_dir / file_map[category]
-        if not file_path.exists():
-            raise FileNotFoundError(f"プロンプトファイルが見つかりません: {file_path}")
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        return data.get("prompts", [])
+        return list(data.get("prompts", []))
     
     def generate_from_samples(self, category: str, count: int = 10) -> List[Dict]:
         """サンプルからランダムに抽出"""
@@ -94,6 +76,16 @@ class PromptGenerator:
         selected = random.sample(prompts, count)
         return selected
     
+    def generate_mix(self, weights: Dict[str, float], count: int = 10, dedup: bool = True,
+                     popularity: Optional[Dict[str, float]] = None) -> List[Dict]:
+        """複数カテゴリから重みに応じてランダムに抽出 (popularity を渡すと利用実績の多いものを選びやすくする)"""
+        selected = self.catalog.sample_mix(weights, count, dedup=dedup, popularity=popularity)
+        
+        if len(selected) < count:
+            print(f"警告: 抽出できたプロンプトは{len(selected)}個です。")
+        
+        return [dict(prompt, category=category) for category, prompt in selected]
+    
     def save_output(self, prompts: List[Dict], category: str, filename: Optional[str] = None):
         """生成結果をファイルに保存"""
         if filename is None:
@@ -151,6 +143,12 @@ def main():
   
   # 結果を表示せずファイルのみ出力
   python src/main.py --category sales --no-display
+  
+  # 複数カテゴリを重み付きで10個抽出
+  python src/main.py --mix engineer:5,python_engineer:3,ai_engineer:2
+
+  # 利用実績の多いプロンプトを選びやすくする
+  python src/main.py --mix engineer:5,python_engineer:3 --popular
         """
     )
     
@@ -158,6 +156,12 @@ def main():
                        help='利用可能なカテゴリを表示')
     parser.add_argument('--category', type=str,
                        help='プロンプトのカテゴリを指定')
+    parser.add_argument('--mix', type=str,
+                       help='複数カテゴリを重み付きで抽出 (例: engineer:5,python_engineer:3)')
+    parser.add_argument('--no-dedup', action='store_true',
+                       help='--mix 使用時にほぼ同一タイトルの重複除去を行わない')
+    parser.add_argument('--popular', action='store_true',
+                       help='--mix 使用時に利用実績 (build/usage.sqlite3) の多いプロンプトを選びやすくする')
     parser.add_argument('--count', type=int, default=10,
                        help='生成するプロンプトの数 (デフォルト: 10)')
     parser.add_argument('--no-display', action='store_true',
@@ -179,6 +183,32 @@ def main():
         print("\n使用方法: python src/main.py --category <カテゴリ名>")
         return
     
+    # 複数カテゴリの重み付き抽出
+    if args.mix:
+        try:
+            weights = parse_mix(args.mix)
+            print(f"\n{', '.join(weights)} からプロンプトを抽出中...")
+            popularity = None
+            if args.popular:
+                usage_db = os.getenv("PROMPT_USAGE_DB", str(generator.prompts_dir.parent / "build" / "usage.sqlite3"))
+                if usage_db and Path(usage_db).exists():
+                    popularity = UsageTracker(usage_db, flush_interval=0).sampling_weights()
+                else:
+                    print("警告: 利用実績がないため、人気度を使わずに抽出します。")
+            prompts = generator.generate_mix(weights, args.count, dedup=not args.no_dedup, popularity=popularity)
+            
+            if not args.no_display:
+                generator.display_prompts(prompts)
+            
+            output_path = generator.save_output(prompts, "mix", args.output)
+            
+            print(f"\n生成されたプロンプト数: {len(prompts)}")
+            print(f"出力ファイル: {output_path}")
+        
+        except Exception as e:
+            print(f"\nエラーが発生しました: {e}")
+        return
+    
     # カテゴリが指定されていない場合
     if not args.category:
         print("エラー: カテゴリを指定してください。")
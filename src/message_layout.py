@@ -0,0 +1,101 @@
+"""
+上流APIに送るメッセージ列の組み立て
+
+プロバイダ側のプロンプトキャッシュは「前回と先頭から一致する部分」にしか効かないため、
+変わりにくいものから順に並べます。
+
+  1. システムプロンプト        (会話中は不変)
+  2. 固定された添付資料         (追加のみ。一度送った資料は同じバイト列のまま先頭側に残る)
+  3. これまでの会話履歴         (末尾に追加されるだけ)
+  4. 今回のユーザー発言
+
+添付ファイルの内容を最新のユーザー発言に埋め込むと毎ターン先頭が変わってキャッシュが効かないため、
+ファイルは会話単位で固定し、メッセージにはユーザーが入力した本文だけを残します。
+大きな資料は固定せず、今回の質問に関係する抜粋 (chunk_index) だけを最新のユーザー発言に添えます。
+抜粋は末尾の発言にしか付けないので、それより前の並びは前のターンと一致したままです。
+"""
+
+import hashlib
+from typing import Dict, List, Optional
+
+
+FILE_TYPE_LABELS = {
+    "pdf": ("📕", "PDFファイル"),
+    "word": ("📘", "Wordファイル"),
+    "excel": ("📊", "Excelファイル"),
+    "csv": ("📄", "CSVファイル"),
+    "text": ("📝", "テキストファイル"),
+}
+
+ATTACHMENTS_HEADER = "以下はユーザーが添付した資料です。質問に答える際に参照してください。"
+
+
+def make_attachment(name: str, file_type: str, content: str, truncated: bool = False, size: int = 0) -> Dict:
+    """固定添付資料を1件作る (digest は同じ資料の重複登録を防ぐためのもの)"""
+    return {
+        "name": name,
+        "type": file_type,
+        "size": size,
+        "truncated": truncated,
+        "content": content,
+        "digest": hashlib.sha1(content.encode("utf-8")).hexdigest(),
+    }
+
+
+def pin_attachment(attachments: List[Dict], attachment: Dict) -> bool:
+    """
+    添付資料を末尾に追加する (同じ内容が既にあれば追加しない)
+    既存の並びは変えないので、先頭側のバイト列は前のターンと一致したままになる
+    """
+    if any(a.get("digest") == attachment["digest"] for a in attachments):
+        return False
+    attachments.append(attachment)
+    return True
+
+
+def format_attachment(attachment: Dict) -> str:
+    icon, label = FILE_TYPE_LABELS.get(attachment.get("type", "text"), FILE_TYPE_LABELS["text"])
+    notice = " ⚠️ (ファイルが大きいため一部省略されました)" if attachment.get("truncated") else ""
+    return f"--- {icon} {attachment['name']} ({label}){notice} ---\n{attachment['content']}"
+
+
+def build_messages(system_prompt: Optional[str], attachments: List[Dict], history: List[Dict],
+                   new_turn: Optional[Dict] = None, context: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    キャッシュしやすい順にメッセージ列を組み立てる
+    history / new_turn の各要素は role と content を持つ辞書 (それ以外のキーは送らない)
+    context は最後のユーザー発言の前に添える抜粋 (履歴には保存しない)
+    """
+    messages: List[Dict[str, str]] = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    if attachments:
+        blocks = "\n\n".join(format_attachment(a) for a in attachments)
+        messages.append({"role": "system", "content": f"{ATTACHMENTS_HEADER}\n\n{blocks}"})
+    for message in history:
+        messages.append({"role": message["role"], "content": message["content"]})
+    if new_turn is not None:
+        messages.append({"role": new_turn["role"], "content": new_turn["content"]})
+    if context:
+        for message in reversed(messages):
+            if message["role"] == "user":
+                message["content"] = f"{context}\n\n---\n{message['content']}"
+                break
+    return messages
+
+
+def usage_summary(usage) -> Optional[Dict[str, int]]:
+    """
+    レスポンスの usage から入力・キャッシュ済み・出力トークン数を取り出す
+    (SDKのオブジェクトと辞書のどちらでも受け付ける)
+    """
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens") or 0,
+        "cached_tokens": details.get("cached_tokens") or 0,
+        "completion_tokens": usage.get("completion_tokens") or 0,
+    }
@@ -0,0 +1,362 @@
+"""
+モデルのルーティングとフォールバック
+
+リクエストごとに使うモデルをルール (用途・入力の大きさ・添付資料の有無・カテゴリ) で選び、
+モデルごとに最初のトークンまでの時間 (TTFT) とエラー率の指数移動平均 (EWMA) を記録します。
+
+- 最近遅い・失敗が続いているモデルは後回しにし、フォールバック先を先に試す (cooldown 秒たったら再び試す)
+- 最初のトークンが届く前に失敗したら次の候補に送り直す (届いた後の失敗はそのまま呼び出し元に返す)
+- hedge_after 秒たっても最初のトークンが届かなければ次の候補にも同時に送り、先に返ってきた方を使う
+- 上流の呼び出しは create(model) として受け取るので、ローカルの偽サーバーでもそのまま試せる
+
+設定は MODEL_ROUTES_FILE (JSON) または環境変数 (from_env を参照) で与えます。
+
+  {
+    "default": {"chat": "gpt-5", "generate": "gpt-4o"},
+    "fallbacks": {"gpt-5": ["gpt-5-mini"], "gpt-4o": ["gpt-4o-mini"]},
+    "rules": [
+      {"task": "chat", "max_input_tokens": 200, "attachments": false, "model": "gpt-5-mini"}
+    ],
+    "hedge_after": 0, "slow_ttft": 0, "error_threshold": 0.5, "cooldown": 30
+  }
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+
+DEFAULT_MODELS = {"chat": "gpt-5", "generate": "gpt-4o"}
+
+_router: Optional["ModelRouter"] = None
+_router_lock = threading.Lock()
+
+
+def get_model_router() -> "ModelRouter":
+    """プロセス内で共有するルーター (初回呼び出し時に環境変数から作成。統計もプロセス内で共有)"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ModelRouter.from_env()
+    return _router
+
+
+class RoutingRule:
+    """条件にすべて一致したリクエストを model に振り分ける (None の条件は問わない)"""
+
+    def __init__(self, model: str, task: Optional[str] = None, min_input_tokens: Optional[int] = None,
+                 max_input_tokens: Optional[int] = None, attachments: Optional[bool] = None,
+                 categories: Optional[List[str]] = None):
+        self.model = model
+        self.task = task
+        self.min_input_tokens = min_input_tokens
+        self.max_input_tokens = max_input_tokens
+        self.attachments = attachments
+        self.categories = set(categories) if categories else None
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "RoutingRule":
+        return cls(
+            data["model"], data.get("task"), data.get("min_input_tokens"), data.get("max_input_tokens"),
+            data.get("attachments"), data.get("categories"),
+        )
+
+    def matches(self, task: str, input_tokens: int, has_attachments: bool, category: Optional[str]) -> bool:
+        if self.task is not None and self.task != task:
+            return False
+        if self.min_input_tokens is not None and input_tokens < self.min_input_tokens:
+            return False
+        if self.max_input_tokens is not None and input_tokens > self.max_input_tokens:
+            return False
+        if self.attachments is not None and self.attachments != has_attachments:
+            return False
+        if self.categories is not None and category not in self.categories:
+            return False
+        return True
+
+
+class ModelStats:
+    """1モデルの TTFT とエラー率の指数移動平均"""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.updated_at = 0.0
+
+    def record(self, ttft: Optional[float] = None, error: bool = False):
+        self.requests += 1
+        self.errors += 1 if error else 0
+        self.error_rate += self.alpha * ((1.0 if error else 0.0) - self.error_rate)
+        if ttft is not None:
+            self.ttft = ttft if self.ttft is None else self.ttft + self.alpha * (ttft - self.ttft)
+        self.updated_at = time.monotonic()
+
+    def to_dict(self) -> Dict:
+        return {"ttft": self.ttft, "error_rate": self.error_rate, "requests": self.requests, "errors": self.errors}
+
+
+class ModelRouter:
+    """ルールによるモデル選択と、TTFT・エラー率に基づくフォールバック/ヘッジ"""
+
+    def __init__(self, defaults: Optional[Dict[str, str]] = None, rules: Optional[List[RoutingRule]] = None,
+                 fallbacks: Optional[Dict[str, List[str]]] = None, hedge_after: float = 0.0,
+                 slow_ttft: float = 0.0, error_threshold: float = 0.5, cooldown: float = 30.0, alpha: float = 0.2):
+        """
+        hedge_after: 最初のトークンをこの秒数待っても来なければ次の候補にも送る (0で無効)
+        slow_ttft: TTFT の移動平均がこの秒数を超えたモデルを後回しにする (0で無効)
+        error_threshold: エラー率の移動平均がこれを超えたモデルを後回しにする
+        cooldown: 後回しにしたモデルを、最後の記録からこの秒数後に再び先頭で試す
+        """
+        self.defaults = dict(DEFAULT_MODELS, **(defaults or {}))
+        self.rules = rules or []
+        self.fallbacks = fallbacks or {}
+        self.hedge_after = hedge_after
+        self.slow_ttft = slow_ttft
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        # (model, outcome, ttft) を受け取るコールバック (メトリクス記録用)。outcome は ok / error / hedge_lost
+        self.listeners: List[Callable[[str, str, Optional[float]], None]] = []
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "ModelRouter":
+        return cls(
+            defaults=config.get("default"),
+            rules=[RoutingRule.from_dict(r) for r in config.get("rules", [])],
+            fallbacks=config.get("fallbacks"),
+            hedge_after=float(config.get("hedge_after", 0)),
+            slow_ttft=float(config.get("slow_ttft", 0)),
+            error_threshold=float(config.get("error_threshold", 0.5)),
+            cooldown=float(config.get("cooldown", 30)),
+        )
+
+    @classmethod
+    def from_env(cls) -> "ModelRouter":
+        """
+        MODEL_ROUTES_FILE があればそのJSONを読む。なければ次の環境変数から組み立てる
+          CHAT_MODEL / GENERATE_MODEL         用途ごとのモデル
+          CHAT_FALLBACK_MODELS                CHAT_MODEL が使えないときの候補 (カンマ区切り)
+          CHAT_LIGHT_MODEL                    添付なしの短い入力 (CHAT_LIGHT_MAX_TOKENS 以下) に使う軽いモデル
+          MODEL_HEDGE_AFTER / MODEL_SLOW_TTFT ヘッジ・後回しのしきい値(秒)
+        """
+        path = os.getenv("MODEL_ROUTES_FILE")
+        if path:
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls.from_config(json.load(f))
+
+        chat_model = os.getenv("CHAT_MODEL", DEFAULT_MODELS["chat"])
+        rules = []
+        light_model = os.getenv("CHAT_LIGHT_MODEL")
+        if light_model:
+            rules.append(RoutingRule(light_model, task="chat", attachments=False,
+                                     max_input_tokens=int(os.getenv("CHAT_LIGHT_MAX_TOKENS", "200"))))
+        fallbacks = [m.strip() for m in os.getenv("CHAT_FALLBACK_MODELS", "").split(",") if m.strip()]
+        fallback_map = {chat_model: fallbacks}
+        if light_model:
+            # 軽いモデルが使えないときは通常のモデルに戻す
+            fallback_map[light_model] = [chat_model] + fallbacks
+        return cls(
+            defaults={"chat": chat_model, "generate": os.getenv("GENERATE_MODEL", DEFAULT_MODELS["generate"])},
+            rules=rules,
+            fallbacks=fallback_map,
+            hedge_after=float(os.getenv("MODEL_HEDGE_AFTER", "0")),
+            slow_ttft=float(os.getenv("MODEL_SLOW_TTFT", "0")),
+        )
+
+    # 選択
+
+    def select(self, task: str = "chat", input_tokens: int = 0, has_attachments: bool = False,
+               category: Optional[str] = None) -> str:
+        """ルールに一致した最初のモデル (なければ用途ごとの既定のモデル)"""
+        for rule in self.rules:
+            if rule.matches(task, input_tokens, has_attachments, category):
+                return rule.model
+        return self.defaults.get(task, self.defaults["chat"])
+
+    def candidates(self, task: str = "chat", input_tokens: int = 0, has_attachments: bool = False,
+                   category: Optional[str] = None) -> List[str]:
+        """試す順のモデル一覧 (選ばれたモデルとフォールバック先。不調なモデルは後ろに回す)"""
+        primary = self.select(task, input_tokens, has_attachments, category)
+        models = [primary]
+        for model in self.fallbacks.get(primary, []):
+            if model not in models:
+                models.append(model)
+        return sorted(models, key=lambda m: not self.healthy(m))
+
+    def healthy(self, model: str) -> bool:
+        stats = self._stats.get(model)
+        if stats is None or time.monotonic() - stats.updated_at > self.cooldown:
+            return True
+        if stats.error_rate > self.error_threshold:
+            return False
+        if self.slow_ttft > 0 and stats.ttft is not None and stats.ttft > self.slow_ttft:
+            return False
+        return True
+
+    def record(self, model: str, outcome: str, ttft: Optional[float] = None):
+        if outcome != "hedge_lost":
+            with self._lock:
+                stats = self._stats.get(model)
+                if stats is None:
+                    stats = self._stats[model] = ModelStats(self.alpha)
+                stats.record(ttft, error=outcome == "error")
+        for listener in self.listeners:
+            listener(model, outcome, ttft)
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {model: dict(s.to_dict(), healthy=self.healthy(model)) for model, s in self._stats.items()}
+
+    # 呼び出し
+
+    def stream(self, create: Callable[[str], Iterable], candidates: List[str],
+               is_token: Optional[Callable[[Any], bool]] = None) -> "RoutedStream":
+        """
+        候補を順に試すストリームを返す
+        create(model) は上流のストリーム (チャンクのイテラブル) を開く関数
+        is_token(chunk) が真になった最初のチャンクを「最初のトークン」とみなす (省略時は最初のチャンク)
+        """
+        return RoutedStream(self, create, candidates, is_token or (lambda chunk: True))
+
+    def call(self, create: Callable[[str], Any], candidates: List[str]) -> Any:
+        """ストリーミングでない呼び出し (失敗したら次の候補。応答までの時間を TTFT として記録)"""
+        last_error: Optional[Exception] = None
+        for model in candidates:
+            start = time.perf_counter()
+            try:
+                result = create(model)
+            except Exception as e:
+                self.record(model, "error")
+                last_error = e
+                continue
+            self.record(model, "ok", time.perf_counter() - start)
+            return result
+        raise last_error or RuntimeError("no model candidates")
+
+
+class _Attempt:
+    """1つのモデルへの呼び出し (別スレッドで読み、イベントをキューに入れる)"""
+
+    def __init__(self, model: str, create: Callable[[str], Iterable], events: "queue.Queue"):
+        self.model = model
+        self.started = time.perf_counter()
+        self.cancelled = threading.Event()
+        # 最初のトークンより前に届いたチャンク
+        self.buffer: List[Any] = []
+        threading.Thread(target=self._run, args=(create, events), daemon=True).start()
+
+    def _run(self, create: Callable[[str], Iterable], events: "queue.Queue"):
+        stream = None
+        try:
+            stream = create(self.model)
+            for chunk in stream:
+                if self.cancelled.is_set():
+                    break
+                events.put((self, "chunk", chunk))
+            events.put((self, "done", None))
+        except Exception as e:
+            events.put((self, "error", e))
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                try:
+                    close()
+                except Exception:
+                    pass
+
+
+class RoutedStream:
+    """フォールバック・ヘッジ付きのストリーム (model は実際に応答したモデル)"""
+
+    def __init__(self, router: ModelRouter, create: Callable[[str], Iterable], candidates: List[str],
+                 is_token: Callable[[Any], bool]):
+        self.router = router
+        self.model: Optional[str] = None
+        self.hedged = False
+        self._create = create
+        self._candidates = list(candidates)
+        self._is_token = is_token
+        self._iterator = self._iterate()
+
+    def __iter__(self) -> Iterator:
+        return self._iterator
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def close(self):
+        self._iterator.close()
+
+    def _iterate(self) -> Iterator:
+        events: "queue.Queue" = queue.Queue()
+        pending = list(self._candidates)
+        active: List[_Attempt] = []
+        hedge_after = self.router.hedge_after
+
+        def launch() -> Optional[float]:
+            active.append(_Attempt(pending.pop(0), self._create, events))
+            return time.monotonic() + hedge_after if hedge_after > 0 else None
+
+        hedge_at = launch()
+        winner: Optional[_Attempt] = None
+        finished = False
+        try:
+            # 最初のトークンを最初に返したモデルを採用する
+            while winner is None:
+                timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None and pending else None
+                try:
+                    attempt, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    self.hedged = True
+                    launch()
+                    hedge_at = None
+                    continue
+                if attempt not in active:
+                    continue
+                if kind == "chunk":
+                    attempt.buffer.append(payload)
+                    if self._is_token(payload):
+                        winner = attempt
+                elif kind == "done":
+                    winner, finished = attempt, True
+                else:
+                    active.remove(attempt)
+                    self.router.record(attempt.model, "error")
+                    if not active:
+                        if not pending:
+                            raise payload
+                        hedge_at = launch()
+
+            self.model = winner.model
+            self.router.record(winner.model, "ok", time.perf_counter() - winner.started)
+            for other in active:
+                if other is not winner:
+                    other.cancelled.set()
+                    self.router.record(other.model, "hedge_lost")
+            active = [winner]
+
+            yield from winner.buffer
+            while not finished:
+                attempt, kind, payload = events.get()
+                if attempt is not winner:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    finished = True
+                else:
+                    # 応答の途中で切れた場合は送り直さない (同じ内容を二重に返さないため)
+                    self.router.record(winner.model, "error")
+                    raise payload
+        finally:
+            for attempt in active:
+                attempt.cancelled.set()
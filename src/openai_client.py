@@ -0,0 +1,78 @@
+"""
+プロセス内で共有するOpenAIクライアント
+
+クライアントを作り直すたびに接続プールも作り直され、TLSハンドシェイクからやり直しになります。
+APIキー・接続先ごとに1つだけ作って使い回し、keep-alive の接続を再利用します。
+
+- 接続プール・keep-alive・タイムアウト・リトライ回数は環境変数で調整できる
+- OPENAI_HTTP2=1 で HTTP/2 を使う (h2 が必要: pip install "httpx[http2]")
+- fork 後の子プロセス (gunicorn のワーカーなど) では親の接続を使わず作り直す
+"""
+
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+
+_clients: Dict[Tuple, object] = {}
+_lock = threading.Lock()
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+def _http2_enabled() -> bool:
+    if os.getenv("OPENAI_HTTP2", "0") != "1":
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("警告: OPENAI_HTTP2=1 ですが h2 がインストールされていないため HTTP/1.1 を使います")
+        return False
+    return True
+
+
+def build_http_client() -> httpx.Client:
+    """接続プール付きのHTTPクライアントを作る"""
+    max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+    return httpx.Client(
+        http2=_http2_enabled(),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", str(max_connections))),
+            keepalive_expiry=_env_float("OPENAI_KEEPALIVE_EXPIRY", 60.0),
+        ),
+        # ストリーミングでは read がトークン間の待ち時間の上限になる
+        timeout=httpx.Timeout(
+            _env_float("OPENAI_TIMEOUT", 600.0),
+            connect=_env_float("OPENAI_CONNECT_TIMEOUT", 10.0),
+        ),
+    )
+
+
+def get_openai_client(api_key: Optional[str] = None):
+    """
+    共有のOpenAIクライアントを取得する (初回呼び出し時に作成)
+    APIキーが未設定なら None
+    """
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    key = (api_key, os.getenv("OPENAI_BASE_URL"), os.getpid())
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(
+                api_key=api_key,
+                max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "2")),
+                http_client=build_http_client(),
+            )
+            _clients[key] = client
+    return client
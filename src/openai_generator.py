@@ -6,6 +6,8 @@ import os
 from typing import List, Dict, Optional
 import json
 
+from model_router import get_model_router
+
 
 class OpenAIPromptGenerator:
     """OpenAI APIを使用してプロンプトを生成するクラス"""
@@ -17,8 +19,9 @@ class OpenAIPromptGenerator:
             raise ValueError("OpenAI API Keyが設定されていません。")
         
         try:
-            from openai import OpenAI
-            self.client = OpenAI(api_key=self.api_key)
+            from openai_client import get_openai_client
+            # プロセス内で共有するクライアント (接続を使い回す)
+            self.client = get_openai_client(self.api_key)
         except ImportError:
             raise ImportError("openaiライブラリがインストールされていません。pip install openai を実行してください。")
     
@@ -45,14 +48,19 @@ class OpenAIPromptGenerator:
 """
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.8,
-                response_format={"type": "json_object"}
+            # 用途 "generate" のモデル (失敗したらフォールバック先に送り直す)
+            router = get_model_router()
+            response = router.call(
+                lambda model: self.client.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": system_message},
+                        {"role": "user", "content": user_message}
+                    ],
+                    temperature=0.8,
+                    response_format={"type": "json_object"}
+                ),
+                router.candidates("generate", category=category),
             )
             
             content = response.choices[0].message.content
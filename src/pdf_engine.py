@@ -0,0 +1,211 @@
+"""
+PDFのテキスト抽出エンジン
+
+pdfplumber の extract_text はページごとにレイアウト解析をするため遅いので、既定ではまず
+PDFium (pypdfium2) のテキスト層をそのまま読み (fast)、読めた文字列が怪しいページだけ
+pdfplumber (layout) で読み直します。
+
+- ページの選び方 (auto): 文字化け (私用領域・制御文字・置換文字) の割合が多いページと、
+  1平方インチあたりの文字数が PDF_LAYOUT_DENSITY を超える表・段組みの多いページを layout で読む
+- PDF_PAGES_PER_TASK ページずつの範囲に分け、layout で読むページは PDF_WORKERS 個のワーカープロセスで並列に読む
+  (PDFium での読み取りは1ページ数ミリ秒なのでこのプロセスで行う)。結果はページ順に返し、
+  呼び出し側が読むのをやめたら先読み中の範囲は取り消す
+- 出力はどのエンジンでも pdfplumber と同じく1行ごとに改行した文字列 (見出しは呼び出し側で付ける)
+"""
+
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pdfplumber
+import pypdfium2 as pdfium
+
+
+ENGINES = ("auto", "fast", "layout")
+GARBAGE_RATIO = 0.1  # 文字化けとみなす割合
+POINTS_PER_SQUARE_INCH = 72 * 72
+
+# PDFium はスレッドセーフではないので、同じプロセス内の呼び出しはすべてこのロックの中で行う
+_pdfium_lock = threading.Lock()
+
+
+def _clean(text: str) -> str:
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+def garbage_ratio(text: str) -> float:
+    """空白以外の文字のうち、私用領域・未割り当て・制御文字・置換文字の割合"""
+    total = bad = 0
+    for ch in text:
+        if ch.isspace():
+            continue
+        total += 1
+        if ch == "\ufffd" or unicodedata.category(ch) in ("Co", "Cn", "Cc"):
+            bad += 1
+    return bad / total if total else 0.0
+
+
+def choose_engine(text: str, char_count: int, width: float, height: float, layout_density: float) -> str:
+    """fast で読んだ結果から、そのページを layout で読み直すか決める"""
+    if garbage_ratio(text) > GARBAGE_RATIO:
+        return "layout"
+    area = width * height / POINTS_PER_SQUARE_INCH
+    if layout_density > 0 and area > 0 and char_count / area > layout_density:
+        return "layout"
+    return "fast"
+
+
+def scan_range(pdf, start: int, stop: int, engine: str = "auto",
+               layout_density: float = 60.0) -> List[Tuple[int, str, str]]:
+    """
+    PDFium で start から stop の手前までのページを読み、(ページ番号(0始まり), 本文, 使うエンジン) を返す
+    使うエンジンが layout のページは本文を layout_pages で読み直す
+    """
+    results: List[Tuple[int, str, str]] = []
+    for i in range(start, min(stop, len(pdf))):
+        if engine == "layout":
+            results.append((i, "", "layout"))
+            continue
+        page = pdf[i]
+        textpage = page.get_textpage()
+        char_count = textpage.count_chars()
+        text = _clean(textpage.get_text_range()) if char_count else ""
+        used = "fast"
+        if engine == "auto" and char_count:
+            width, height = page.get_size()
+            used = choose_engine(text, char_count, width, height, layout_density)
+        textpage.close()
+        page.close()
+        results.append((i, text, used))
+    return results
+
+
+def layout_pages(source, indices: List[int]) -> Dict[int, str]:
+    """pdfplumber でレイアウト解析して読む (ワーカープロセスからも呼ぶ。source はパスかバイト列)"""
+    texts: Dict[int, str] = {}
+    with pdfplumber.open(source if isinstance(source, str) else io.BytesIO(source)) as pdf:
+        for i in indices:
+            page = pdf.pages[i]
+            texts[i] = page.extract_text() or ""
+            page.close()  # ページごとの解析結果を手放してメモリを抑える
+    return texts
+
+
+class PdfEngine:
+    """ページ範囲をワーカープロセスに振り分けてPDFを読む"""
+
+    def __init__(self, engine: str = "auto", workers: int = 0, pages_per_task: int = 16,
+                 layout_density: float = 60.0):
+        if engine not in ENGINES:
+            raise ValueError(f"PDF_ENGINE は {', '.join(ENGINES)} のいずれかです: {engine}")
+        self.engine = engine
+        self.workers = workers
+        self.pages_per_task = max(1, pages_per_task)
+        self.layout_density = layout_density
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "PdfEngine":
+        return cls(
+            engine=os.getenv("PDF_ENGINE", "auto"),
+            workers=int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1)))),
+            pages_per_task=int(os.getenv("PDF_PAGES_PER_TASK", "16")),
+            layout_density=float(os.getenv("PDF_LAYOUT_DENSITY", "60")),
+        )
+
+    @property
+    def settings(self) -> str:
+        """抽出結果を左右する設定 (ワーカー数・タスクの大きさは結果に影響しないので含めない)"""
+        return f"engine={self.engine};layout_density={self.layout_density:g}"
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # fork だと親のスレッドが持っていたロックを引き継ぐため spawn で起動する
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+    def page_count(self, data: bytes) -> int:
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(data)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+
+    def pages(self, data: bytes, start: int = 0, stats: Optional[Dict[str, int]] = None) -> Iterator[Tuple[int, str]]:
+        """
+        start ページ目 (0始まり) から順に (ページ番号, 本文) を返す
+        stats を渡すとエンジンごとのページ数を数える
+        """
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(data)
+        path = None
+        pending = deque()
+        try:
+            total = len(pdf)  # ページ数は開いたときに読み込み済み
+            queue = deque(range(start, total, self.pages_per_task))
+            while queue or pending:
+                # PDFium での読み取りは速いのでこのプロセスで先に進め、layout で読み直すページの範囲だけを
+                # ワーカーに送る。先読みはワーカー数の2倍の範囲まで (途中でやめたときに無駄に読まない)
+                while queue and len(pending) < max(1, self.workers * 2):
+                    first = queue.popleft()
+                    with _pdfium_lock:
+                        scanned = scan_range(pdf, first, first + self.pages_per_task, self.engine, self.layout_density)
+                    layout = [i for i, _, used in scanned if used == "layout"]
+                    if not layout:
+                        pending.append((scanned, None))
+                    elif self.workers <= 1:
+                        pending.append((scanned, layout_pages(data, layout)))
+                    else:
+                        if path is None:
+                            # ワーカーには一時ファイルのパスを渡す (範囲ごとにバイト列を送らない)
+                            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+                                f.write(data)
+                                path = f.name
+                        pending.append((scanned, self._pool().submit(layout_pages, path, layout)))
+                scanned, layout = pending.popleft()
+                if isinstance(layout, Future):
+                    layout = layout.result()
+                for i, text, used in scanned:
+                    if stats is not None:
+                        stats[used] = stats.get(used, 0) + 1
+                    yield i, layout[i] if used == "layout" else text
+        finally:
+            futures = [layout for _, layout in pending if isinstance(layout, Future)]
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()  # 実行中の範囲が一時ファイルを読み終えるのを待つ
+            if path is not None:
+                os.unlink(path)
+            with _pdfium_lock:
+                pdf.close()
+
+
+_engine: Optional[PdfEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_pdf_engine() -> PdfEngine:
+    """プロセス内で共有するエンジン (PDF_ENGINE / PDF_WORKERS / PDF_PAGES_PER_TASK / PDF_LAYOUT_DENSITY)"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = PdfEngine.from_env()
+        return _engine
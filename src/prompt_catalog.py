@@ -0,0 +1,515 @@
+"""
+プロンプトカタログ(事前読み込みインデックス)
+
+prompts_data配下の全カテゴリを一度だけ読み込み、
+複数カテゴリをまたいだ重み付きサンプリングを高速に行います。
+
+build/catalog.json (src/compile_catalog.py の出力) が最新であればそれを読み込み、
+検証・正規化済みのデータを使います。古い・存在しない場合や、起動後に変更されたファイルは
+生のJSONを読み、ファイルごとに同じ検証・正規化を行います。
+
+カテゴリごとの統計 (件数・システムプロンプトの文字数/トークン数の分布・推奨添付資料の種類数) は
+コンパイル時 (成果物がなければ読み込み時) に一度だけ計算し、全体の集計はスナップショットごとに
+一度だけ行います。読み取り側は計算済みの値を参照するだけです。
+"""
+
+import json
+import logging
+import random
+import re
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from doc_chunker import estimate_tokens
+
+
+logger = logging.getLogger(__name__)
+
+# タイトル比較時に無視する記号・空白
+_TITLE_IGNORE_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+ARTIFACT_VERSION = 1
+
+
+class CatalogError(Exception):
+    """検証エラーのまとめ"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+def default_artifact_path(prompts_dir: Path) -> Path:
+    """prompts_dataと同じ階層の build/catalog.json"""
+    return Path(prompts_dir).parent / "build" / "catalog.json"
+
+
+def source_stamp(prompts_dir: Path) -> Dict[str, List[int]]:
+    """各ソースファイルの (mtime_ns, size)。成果物の鮮度判定に使う"""
+    stamp = {}
+    for file_path in sorted(Path(prompts_dir).glob("*.json")):
+        st = file_path.stat()
+        stamp[file_path.name] = [st.st_mtime_ns, st.st_size]
+    return stamp
+
+
+def load_artifact(prompts_dir: Path, artifact_path: Optional[Path] = None) -> Optional[Dict]:
+    """コンパイル済みカタログが最新なら読み込んで返す。それ以外はNone"""
+    artifact_path = Path(artifact_path) if artifact_path else default_artifact_path(prompts_dir)
+    if not artifact_path.exists():
+        return None
+    try:
+        with open(artifact_path, 'r', encoding='utf-8') as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if artifact.get("version") != ARTIFACT_VERSION or artifact.get("sources") != source_stamp(prompts_dir):
+        return None
+    return artifact
+
+
+def prompt_uid(category: str, prompt_id) -> str:
+    """カテゴリをまたいで一意なプロンプトID"""
+    return f"{category}:{prompt_id}"
+
+
+def length_distribution(values: List[int]) -> Dict[str, float]:
+    """長さの分布 (最小・四分位・90パーセンタイル・最大・平均)"""
+    if not values:
+        return {"min": 0, "p25": 0, "p50": 0, "p75": 0, "p90": 0, "max": 0, "mean": 0.0}
+    values = sorted(values)
+
+    def percentile(q: float) -> int:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        "min": values[0],
+        "p25": percentile(0.25),
+        "p50": percentile(0.5),
+        "p75": percentile(0.75),
+        "p90": percentile(0.9),
+        "max": values[-1],
+        "mean": round(sum(values) / len(values), 1),
+    }
+
+
+def prompt_stats(prompts: List[Dict]) -> Dict:
+    """プロンプト一覧の統計 (件数・システムプロンプトの文字数/トークン数の分布・推奨添付資料の種類数)"""
+    chars = [len(p.get("system_prompt", "")) for p in prompts]
+    attachments = {a for p in prompts for a in p.get("recommended_attachments", [])}
+    return {
+        "count": len(prompts),
+        "chars": length_distribution(chars),
+        "tokens": length_distribution([estimate_tokens(p.get("system_prompt", "")) for p in prompts]),
+        "attachment_vocabulary": len(attachments),
+    }
+
+
+def weighted_order(weights: List[float], rng) -> List[int]:
+    """重みに比例した確率で先に来る並び順を返す (重み付きの非復元抽出)"""
+    keys = [rng.random() ** (1.0 / w) if w > 0 else 0.0 for w in weights]
+    return sorted(range(len(weights)), key=keys.__getitem__, reverse=True)
+
+
+def normalize_title(title: str) -> str:
+    """ほぼ同一のタイトルを同一視するための正規化キーを返す"""
+    text = unicodedata.normalize("NFKC", title or "").lower()
+    return _TITLE_IGNORE_RE.sub("", text)
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """
+    `engineer:5,python_engineer:3,ai_engineer` 形式の指定を解析する
+    重みを省略したカテゴリは1として扱う
+    """
+    weights: Dict[str, float] = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, weight = part.partition(":")
+        name = name.strip()
+        try:
+            value = float(weight) if weight.strip() else 1.0
+        except ValueError:
+            raise ValueError(f"重みの指定が不正です: '{part}'")
+        if value < 0:
+            raise ValueError(f"重みは0以上で指定してください: '{part}'")
+        weights[name] = weights.get(name, 0.0) + value
+    if not weights:
+        raise ValueError("--mix にカテゴリが指定されていません。")
+    return weights
+
+
+def allocate_counts(weights: Dict[str, float], capacity: Dict[str, int], total: int) -> Dict[str, int]:
+    """
+    重みに比例して総数を各カテゴリへ割り当てる(最大剰余法)
+    各カテゴリの件数上限を超えた分は他のカテゴリへ再配分する
+    """
+    counts = {name: 0 for name in weights}
+    remaining = min(total, sum(capacity[name] for name in weights if weights[name] > 0))
+    active = [name for name in weights if weights[name] > 0]
+
+    while remaining > 0 and active:
+        weight_sum = sum(weights[name] for name in active)
+        quotas = {name: remaining * weights[name] / weight_sum for name in active}
+        shares = {name: int(quotas[name]) for name in active}
+        leftover = remaining - sum(shares.values())
+        for name in sorted(active, key=lambda n: quotas[n] - shares[n], reverse=True)[:leftover]:
+            shares[name] += 1
+
+        for name in active:
+            granted = min(shares[name], capacity[name] - counts[name])
+            counts[name] += granted
+            remaining -= granted
+        active = [name for name in active if counts[name] < capacity[name]]
+
+    return counts
+
+
+class CategoryEntry(NamedTuple):
+    """1カテゴリ分の読み込み済みデータ(読み取り専用として扱う)"""
+    data: Dict
+    title_keys: List[str]
+    uids: Dict[str, int]
+    stats: Dict
+
+    @property
+    def prompts(self) -> List[Dict]:
+        return self.data.get("prompts", [])
+
+    @property
+    def count(self) -> int:
+        return len(self.prompts)
+
+
+class CatalogSnapshot(NamedTuple):
+    """ある時点のカタログ全体。更新時は丸ごと差し替える(コピーオンライト)"""
+    entries: Dict[str, CategoryEntry]
+    stamps: Dict[str, List[int]]
+    from_artifact: bool
+
+
+def build_entry(name: str, data: Dict, title_keys: Optional[List[str]] = None,
+                stats: Optional[Dict] = None) -> CategoryEntry:
+    """カテゴリのJSONからインデックス付きのエントリを作る (title_keys・stats は成果物にあればそれを使う)"""
+    prompts = data.get("prompts", [])
+    if title_keys is None:
+        title_keys = [normalize_title(p.get("title", "")) for p in prompts]
+    if stats is None:
+        stats = prompt_stats(prompts)
+    uids = {prompt_uid(name, p.get("id")): pos for pos, p in enumerate(prompts)}
+    return CategoryEntry(data, title_keys, uids, stats)
+
+
+def read_category_file(file_path: Path) -> CategoryEntry:
+    """
+    1カテゴリのJSONを読み、compile_catalog と同じ検証・正規化をしてエントリを作る
+    (成果物から読んだカテゴリと同じ形になる)。問題があれば CatalogError を送出する
+    """
+    # compile_catalog はこのモジュールを読み込むので、循環しないよう使うときに読み込む
+    from compile_catalog import compile_category
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    errors: List[str] = []
+    warnings: List[str] = []
+    compiled = compile_category(file_path.stem, data, errors, warnings)
+    if errors:
+        raise CatalogError(errors)
+    for warning in warnings:
+        logger.info("%s", warning)
+    return build_entry(
+        file_path.stem,
+        {"category": compiled["category"], "prompts": compiled["prompts"]},
+        compiled["title_keys"],
+        compiled["stats"],
+    )
+
+
+class PromptCatalog:
+    """
+    全カテゴリのプロンプトを保持する読み取り専用インデックス
+
+    読み取り側はロックを取らず、その時点のスナップショットを1回参照するだけです。
+    更新(reload/refresh)は新しいスナップショットを組み立ててから参照を差し替えるため、
+    途中状態が見えることはありません。
+    """
+
+    def __init__(self, prompts_dir: str = "prompts_data", artifact_path: Optional[str] = None):
+        self.prompts_dir = Path(prompts_dir)
+        self.artifact_path = Path(artifact_path) if artifact_path else default_artifact_path(self.prompts_dir)
+        self._snapshot = CatalogSnapshot({}, {}, False)
+        # 更新処理同士の直列化用(読み取り側は使わない)
+        self._update_lock = threading.Lock()
+        # 読み込みに失敗したファイルのスタンプ(同じ内容で何度も再試行しない)
+        self._failed_stamps: Dict[str, List[int]] = {}
+        # システムプロンプトの本文 -> グローバルID (スナップショットごとに作り直す)
+        self._system_prompt_index: Optional[Tuple[CatalogSnapshot, Dict[str, str]]] = None
+        # カタログ全体の統計 (スナップショットごとに作り直す)
+        self._stats: Optional[Tuple[CatalogSnapshot, Dict]] = None
+        self.reload()
+
+    @property
+    def snapshot(self) -> CatalogSnapshot:
+        return self._snapshot
+
+    @property
+    def from_artifact(self) -> bool:
+        return self._snapshot.from_artifact
+
+    def reload(self):
+        """カタログを読み込み直す(コンパイル済み成果物があれば優先)"""
+        with self._update_lock:
+            artifact = load_artifact(self.prompts_dir, self.artifact_path)
+            if artifact is not None:
+                entries = {
+                    name: build_entry(
+                        name,
+                        {"category": entry["category"], "prompts": entry["prompts"]},
+                        entry["title_keys"],
+                        entry.get("stats"),
+                    )
+                    for name, entry in artifact["categories"].items()
+                }
+                self._snapshot = CatalogSnapshot(entries, artifact["sources"], True)
+                return
+
+            entries = {}
+            stamps = {}
+            for name, stamp in source_stamp(self.prompts_dir).items():
+                try:
+                    entries[Path(name).stem] = read_category_file(self.prompts_dir / name)
+                except (OSError, ValueError, CatalogError) as e:
+                    # 検証に通らないカテゴリは載せない (直れば refresh で読み込まれる)
+                    logger.error("カテゴリを読み込めません (%s): %s", name, e)
+                    self._failed_stamps[name] = stamp
+                    continue
+                stamps[name] = stamp
+            self._snapshot = CatalogSnapshot(entries, stamps, False)
+
+    def refresh(self) -> List[str]:
+        """
+        変更のあったカテゴリだけを読み込み直して差し替える
+        変更されたファイルは compile_catalog と同じ検証・正規化を通す。
+        読み込みや検証に失敗したカテゴリ(書き込み途中など)は旧データのまま、ファイルが変わったら再試行する
+        戻り値は更新したカテゴリキーのリスト
+        """
+        with self._update_lock:
+            current = self._snapshot
+            stamps = source_stamp(self.prompts_dir)
+            if stamps == current.stamps:
+                return []
+
+            entries = dict(current.entries)
+            new_stamps = dict(current.stamps)
+            changed = []
+            for name, stamp in stamps.items():
+                if current.stamps.get(name) == stamp or self._failed_stamps.get(name) == stamp:
+                    continue
+                try:
+                    entries[Path(name).stem] = read_category_file(self.prompts_dir / name)
+                except (OSError, ValueError, CatalogError) as e:
+                    # 書き込み途中のファイルや検証エラー。旧データのまま配信を続ける
+                    logger.warning("カテゴリの再読み込みに失敗しました (%s): %s", name, e)
+                    self._failed_stamps[name] = stamp
+                    continue
+                self._failed_stamps.pop(name, None)
+                new_stamps[name] = stamp
+                changed.append(Path(name).stem)
+            for name in [n for n in current.stamps if n not in stamps]:
+                entries.pop(Path(name).stem, None)
+                del new_stamps[name]
+                changed.append(Path(name).stem)
+
+            if changed:
+                self._snapshot = CatalogSnapshot(entries, new_stamps, False)
+            return changed
+
+    def categories(self) -> List[str]:
+        """読み込み済みのカテゴリキー一覧"""
+        return list(self._snapshot.entries.keys())
+
+    def get(self, category: str) -> Optional[Dict]:
+        """カテゴリのJSONデータ(category, prompts)を返す"""
+        entry = self._snapshot.entries.get(category)
+        return entry.data if entry else None
+
+    def prompts(self, category: str) -> List[Dict]:
+        """カテゴリのプロンプト一覧を返す"""
+        entry = self._snapshot.entries.get(category)
+        return entry.prompts if entry else []
+
+    def counts(self) -> Dict[str, int]:
+        """カテゴリごとのプロンプト数"""
+        return {name: entry.count for name, entry in self._snapshot.entries.items()}
+
+    def stats(self) -> Dict:
+        """
+        カタログ全体とカテゴリごとの統計
+        スナップショットが変わったとき (prompts_data の変更時) だけ集計し直し、それ以外は同じ辞書を返す
+        """
+        snapshot = self._snapshot
+        cached = self._stats
+        if cached is None or cached[0] is not snapshot:
+            prompts = [p for entry in snapshot.entries.values() for p in entry.prompts]
+            stats = prompt_stats(prompts)
+            stats["categories"] = {name: entry.stats for name, entry in snapshot.entries.items()}
+            stats["category_count"] = len(snapshot.entries)
+            cached = self._stats = (snapshot, stats)
+        return cached[1]
+
+    def find(self, uid: str) -> Optional[Tuple[str, Dict]]:
+        """グローバルID (`カテゴリ:id`) からプロンプトを引く"""
+        name = uid.split(":", 1)[0]
+        entry = self._snapshot.entries.get(name)
+        if entry is None or uid not in entry.uids:
+            return None
+        return name, entry.prompts[entry.uids[uid]]
+
+    def find_by_system_prompt(self, system_prompt: Optional[str]) -> Optional[str]:
+        """システムプロンプトの本文からグローバルIDを引く (カタログの本文のまま使われている場合のみ)"""
+        if not system_prompt:
+            return None
+        snapshot = self._snapshot
+        cached = self._system_prompt_index
+        if cached is None or cached[0] is not snapshot:
+            index: Dict[str, str] = {}
+            for name, entry in snapshot.entries.items():
+                for prompt in entry.prompts:
+                    index.setdefault(prompt.get("system_prompt", ""), prompt_uid(name, prompt.get("id")))
+            cached = self._system_prompt_index = (snapshot, index)
+        return cached[1].get(system_prompt)
+
+    def sample_mix(self, weights: Dict[str, float], count: int = 10,
+                   dedup: bool = True, rng: Optional[random.Random] = None,
+                   popularity: Optional[Dict[str, float]] = None) -> List[Tuple[str, Dict]]:
+        """
+        複数カテゴリから重みに応じてランダム抽出する
+        popularity (グローバルID -> 重み。含まれないものは1) を渡すと、カテゴリ内でも重みに応じて選ぶ
+        戻り値は (カテゴリキー, プロンプト) のリスト
+        """
+        entries = self._snapshot.entries
+        unknown = [name for name in weights if name not in entries]
+        if unknown:
+            raise ValueError(f"カテゴリ '{', '.join(unknown)}' は存在しません。")
+
+        rng = rng or random
+        capacity = {name: entries[name].count for name in weights}
+        counts = allocate_counts(weights, capacity, count)
+
+        selected: List[Tuple[str, Dict]] = []
+        seen = set()
+        for name, quota in counts.items():
+            if quota <= 0:
+                continue
+            prompts = entries[name].prompts
+            keys = entries[name].title_keys
+            if popularity:
+                order = weighted_order(
+                    [popularity.get(prompt_uid(name, p.get("id")), 1.0) for p in prompts], rng
+                )
+            else:
+                order = rng.sample(range(len(prompts)), len(prompts))
+            if not dedup:
+                selected.extend((name, prompts[i]) for i in order[:quota])
+                continue
+
+            # 重複タイトルを避けながら、足りなければ同カテゴリの残りから補充する
+            taken = 0
+            for i in order:
+                if taken >= quota:
+                    break
+                if keys[i] in seen:
+                    continue
+                seen.add(keys[i])
+                selected.append((name, prompts[i]))
+                taken += 1
+
+        rng.shuffle(selected)
+        return selected
+
+
+class CatalogWatcher:
+    """
+    prompts_dataを監視し、変更のあったカテゴリだけをバックグラウンドで差し替える
+
+    基本はファイルの (mtime, size) のポーリングで、watchdog がインストールされていれば
+    inotify等のイベントで即座に起こされます。リクエスト処理のスレッドでは何もしません。
+    """
+
+    # イベント受信後、連続書き込みが落ち着くまで待つ秒数
+    DEBOUNCE_SECONDS = 0.2
+
+    def __init__(self, catalog: PromptCatalog, interval: float = 2.0):
+        self.catalog = catalog
+        self.interval = interval
+        self._listeners: List[Callable[[List[str]], None]] = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._observer = None
+
+    def add_listener(self, callback: Callable[[List[str]], None]):
+        """差し替え後に変更カテゴリのリストを受け取るコールバックを登録する"""
+        self._listeners.append(callback)
+
+    def start(self) -> "CatalogWatcher":
+        if self._thread is not None:
+            return self
+        self._start_observer()
+        self._thread = threading.Thread(target=self._run, name="catalog-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def _start_observer(self):
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return
+
+        wake = self._wake
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if str(getattr(event, "src_path", "")).endswith(".json"):
+                    wake.set()
+
+        observer = Observer()
+        observer.schedule(_Handler(), str(self.catalog.prompts_dir), recursive=False)
+        observer.daemon = True
+        observer.start()
+        self._observer = observer
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._wake.wait(self.interval):
+                self._wake.clear()
+                self._stop.wait(self.DEBOUNCE_SECONDS)
+            if self._stop.is_set():
+                break
+            try:
+                changed = self.catalog.refresh()
+            except Exception:
+                logger.exception("カタログの更新に失敗しました")
+                continue
+            if changed:
+                logger.info("カタログを更新しました: %s", ", ".join(changed))
+                for callback in self._listeners:
+                    try:
+                        callback(changed)
+                    except Exception:
+                        logger.exception("カタログ更新後の処理に失敗しました")
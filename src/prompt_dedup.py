@@ -0,0 +1,327 @@
+"""
+プロンプト重複検出ツール (MinHash/LSH)
+
+system_promptの文字シングルからMinHash署名を作り、LSHバンディングで
+候補ペアだけを比較することで、全カテゴリの近似重複を準線形時間で検出します。
+署名インデックスはファイルに保存され、新規追加分だけを差分チェックできます。
+
+使用例:
+  python src/prompt_dedup.py
+  python src/prompt_dedup.py --threshold 0.7 --merge-out output/merged
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import re
+import unicodedata
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# メルセンヌ素数 (2^61 - 1)
+_PRIME = (1 << 61) - 1
+_WHITESPACE_RE = re.compile(r"\s+")
+
+DEFAULT_INDEX_PATH = Path("build") / "minhash_index.json"
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角の揺れと空白を吸収する"""
+    return _WHITESPACE_RE.sub("", unicodedata.normalize("NFKC", text or "")).lower()
+
+
+class MinHasher:
+    """文字シングル → MinHash署名"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = random.Random(seed)
+        self._params = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+
+    def shingles(self, text: str) -> List[int]:
+        """正規化済みテキストの文字kグラムを32bitハッシュの集合にする"""
+        text = normalize_text(text)
+        k = self.shingle_size
+        if len(text) <= k:
+            return [zlib.crc32(text.encode("utf-8"))]
+        return list({zlib.crc32(text[i:i + k].encode("utf-8")) for i in range(len(text) - k + 1)})
+
+    def signature(self, text: str) -> List[int]:
+        """MinHash署名を計算する"""
+        hashes = self.shingles(text)
+        return [min([(a * x + b) % _PRIME for x in hashes]) for a, b in self._params]
+
+
+def estimate_similarity(sig_a: List[int], sig_b: List[int]) -> float:
+    """署名の一致率からJaccard係数を推定する"""
+    same = sum(1 for x, y in zip(sig_a, sig_b) if x == y)
+    return same / len(sig_a)
+
+
+class SignatureIndex:
+    """永続化可能なMinHash署名インデックス (LSHバンド付き)"""
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, shingle_size: int = 5, seed: int = 1):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm は bands で割り切れる必要があります。")
+        self.hasher = MinHasher(num_perm, shingle_size, seed)
+        self.bands = bands
+        self.rows = num_perm // bands
+        # key -> {"title": str, "signature": [int]}
+        self.entries: Dict[str, Dict] = {}
+        # ファイル名 -> 内容ハッシュ (差分更新用)
+        self.file_hashes: Dict[str, str] = {}
+        self._buckets: List[Dict[Tuple[int, ...], List[str]]] = [{} for _ in range(bands)]
+
+    # --- LSH ---
+
+    def _band_keys(self, signature: List[int]) -> Iterable[Tuple[int, Tuple[int, ...]]]:
+        for band in range(self.bands):
+            start = band * self.rows
+            yield band, tuple(signature[start:start + self.rows])
+
+    def _insert_buckets(self, key: str, signature: List[int]):
+        for band, band_key in self._band_keys(signature):
+            self._buckets[band].setdefault(band_key, []).append(key)
+
+    def _rebuild_buckets(self):
+        self._buckets = [{} for _ in range(self.bands)]
+        for key, entry in self.entries.items():
+            self._insert_buckets(key, entry["signature"])
+
+    def candidates(self, signature: List[int]) -> set:
+        """いずれかのバンドが一致するキーの集合"""
+        found = set()
+        for band, band_key in self._band_keys(signature):
+            found.update(self._buckets[band].get(band_key, ()))
+        return found
+
+    # --- 登録・検索 ---
+
+    def add(self, key: str, title: str, text: str) -> List[int]:
+        """プロンプトを登録する(同じキーは上書き)"""
+        if key in self.entries:
+            self.remove(key)
+        signature = self.hasher.signature(text)
+        self.entries[key] = {"title": title, "signature": signature}
+        self._insert_buckets(key, signature)
+        return signature
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for band, band_key in self._band_keys(entry["signature"]):
+            bucket = self._buckets[band].get(band_key)
+            if bucket and key in bucket:
+                bucket.remove(key)
+                if not bucket:
+                    del self._buckets[band][band_key]
+
+    def query(self, text: str, threshold: float = 0.8, exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        """textと近似重複する登録済みプロンプトを (キー, 推定類似度) で返す"""
+        signature = self.hasher.signature(text)
+        return self._query_signature(signature, threshold, exclude)
+
+    def _query_signature(self, signature: List[int], threshold: float, exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        matches = []
+        for key in self.candidates(signature):
+            if key == exclude:
+                continue
+            score = estimate_similarity(signature, self.entries[key]["signature"])
+            if score >= threshold:
+                matches.append((key, score))
+        matches.sort(key=lambda m: m[1], reverse=True)
+        return matches
+
+    # --- カタログ単位の更新 ---
+
+    def update_from_dir(self, prompts_dir: Path) -> List[str]:
+        """内容が変わったカテゴリファイルだけ署名を再計算する。更新したファイル名を返す"""
+        prompts_dir = Path(prompts_dir)
+        seen_files = set()
+        updated = []
+        for file_path in sorted(prompts_dir.glob("*.json")):
+            raw = file_path.read_bytes()
+            digest = hashlib.sha1(raw).hexdigest()
+            seen_files.add(file_path.name)
+            if self.file_hashes.get(file_path.name) == digest:
+                continue
+
+            category = file_path.stem
+            for key in [k for k in self.entries if k.split(":", 1)[0] == category]:
+                self.remove(key)
+            for prompt in json.loads(raw.decode("utf-8")).get("prompts", []):
+                self.add(f"{category}:{prompt.get('id')}", prompt.get("title", ""), prompt.get("system_prompt", ""))
+            self.file_hashes[file_path.name] = digest
+            updated.append(file_path.name)
+
+        # 削除されたファイル
+        for name in [n for n in self.file_hashes if n not in seen_files]:
+            category = Path(name).stem
+            for key in [k for k in self.entries if k.split(":", 1)[0] == category]:
+                self.remove(key)
+            del self.file_hashes[name]
+            updated.append(name)
+
+        return updated
+
+    def duplicate_pairs(self, threshold: float = 0.8) -> List[Tuple[str, str, float]]:
+        """登録済みプロンプト同士の近似重複ペアを列挙する"""
+        pairs = {}
+        for key, entry in self.entries.items():
+            for other, score in self._query_signature(entry["signature"], threshold, exclude=key):
+                pair = (key, other) if key < other else (other, key)
+                pairs[pair] = score
+        return sorted(((a, b, s) for (a, b), s in pairs.items()), key=lambda p: p[2], reverse=True)
+
+    def check_additions(self, category: str, prompts: List[Dict], threshold: float = 0.8) -> Tuple[List[Dict], List[Dict]]:
+        """
+        追加予定のプロンプトを既存カタログ(と追加分同士)に対して照合する
+        戻り値は (重複なしのプロンプト, 重複情報のリスト)
+        """
+        unique, duplicates = [], []
+        pending: List[Tuple[str, List[int]]] = []
+        for prompt in prompts:
+            signature = self.hasher.signature(prompt.get("system_prompt", ""))
+            key = f"{category}:{prompt.get('id')}"
+            matches = self._query_signature(signature, threshold, exclude=key)
+            matches += [(k, s) for k, s in ((k, estimate_similarity(signature, sig)) for k, sig in pending) if s >= threshold]
+            if matches:
+                duplicates.append({"prompt": prompt, "matches": matches})
+            else:
+                unique.append(prompt)
+                pending.append((key, signature))
+        return unique, duplicates
+
+    # --- 永続化 ---
+
+    def to_dict(self) -> Dict:
+        return {
+            "num_perm": self.hasher.num_perm,
+            "bands": self.bands,
+            "shingle_size": self.hasher.shingle_size,
+            "seed": self.hasher.seed,
+            "file_hashes": self.file_hashes,
+            "entries": self.entries,
+        }
+
+    def save(self, path: Path = DEFAULT_INDEX_PATH):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: Path = DEFAULT_INDEX_PATH) -> "SignatureIndex":
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        index = cls(data["num_perm"], data["bands"], data["shingle_size"], data["seed"])
+        index.entries = data.get("entries", {})
+        index.file_hashes = data.get("file_hashes", {})
+        index._rebuild_buckets()
+        return index
+
+    @classmethod
+    def load_or_build(cls, prompts_dir: Path, path: Path = DEFAULT_INDEX_PATH) -> "SignatureIndex":
+        """保存済みインデックスを読み込み、変更のあったカテゴリだけ更新して保存する"""
+        path = Path(path)
+        index = cls.load(path) if path.exists() else cls()
+        if index.update_from_dir(prompts_dir) or not path.exists():
+            index.save(path)
+        return index
+
+
+def cluster_pairs(pairs: List[Tuple[str, str, float]]) -> List[List[str]]:
+    """重複ペアをUnion-Findでクラスタにまとめる"""
+    parent: Dict[str, str] = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b, _ in pairs:
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    clusters: Dict[str, List[str]] = {}
+    for key in parent:
+        clusters.setdefault(find(key), []).append(key)
+    return [sorted(members) for members in clusters.values() if len(members) > 1]
+
+
+def write_merged_catalog(prompts_dir: Path, out_dir: Path, clusters: List[List[str]]) -> int:
+    """各クラスタの先頭だけを残したカタログを書き出す。除外した件数を返す"""
+    drop = {key for members in clusters for key in members[1:]}
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for file_path in sorted(Path(prompts_dir).glob("*.json")):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        category = file_path.stem
+        data["prompts"] = [p for p in data.get("prompts", []) if f"{category}:{p.get('id')}" not in drop]
+        with open(out_dir / file_path.name, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    return len(drop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='prompts_data の近似重複プロンプトを検出')
+    parser.add_argument('--prompts-dir', type=str, default='prompts_data',
+                       help='プロンプトデータのディレクトリ (デフォルト: prompts_data)')
+    parser.add_argument('--index', type=str, default=str(DEFAULT_INDEX_PATH),
+                       help=f'署名インデックスの保存先 (デフォルト: {DEFAULT_INDEX_PATH})')
+    parser.add_argument('--threshold', type=float, default=0.8,
+                       help='重複とみなす推定Jaccard類似度 (デフォルト: 0.8)')
+    parser.add_argument('--report', type=str,
+                       help='レポートの出力先 (デフォルト: output/dedup_report_<日時>.json)')
+    parser.add_argument('--merge-out', type=str,
+                       help='重複を除いたカタログを書き出すディレクトリ')
+    args = parser.parse_args()
+
+    prompts_dir = Path(args.prompts_dir)
+    index = SignatureIndex.load_or_build(prompts_dir, Path(args.index))
+    pairs = index.duplicate_pairs(args.threshold)
+    clusters = cluster_pairs(pairs)
+
+    report_path = Path(args.report) if args.report else (
+        Path("output") / f"dedup_report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report = {
+        "threshold": args.threshold,
+        "prompt_count": len(index.entries),
+        "pair_count": len(pairs),
+        "pairs": [
+            {
+                "a": a, "a_title": index.entries[a]["title"],
+                "b": b, "b_title": index.entries[b]["title"],
+                "similarity": round(score, 3),
+            }
+            for a, b, score in pairs
+        ],
+        "clusters": clusters,
+    }
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"対象プロンプト数: {len(index.entries)}")
+    print(f"近似重複ペア: {len(pairs)}件 / クラスタ: {len(clusters)}件")
+    print(f"✓ レポート: {report_path}")
+
+    if args.merge_out:
+        dropped = write_merged_catalog(prompts_dir, Path(args.merge_out), clusters)
+        print(f"✓ 統合カタログ: {args.merge_out} ({dropped}件を除外)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+セマンティックなプロンプト推薦 (ローカル・オフライン)
+
+ユーザーがやりたいことを文章で入力すると、prompts_data全体から
+近いシステムプロンプトを返します。
+
+- ベクトル化: 環境変数 RECOMMEND_MODEL に sentence-transformers のモデル名を
+  指定した場合はそのモデル(CPU)、未指定ならハッシュ化TF-IDF(文字2/3-gram)
+- 保存形式: float32行列をメモリマップ (build/recommend_vectors.<ビルドID>.f32)。
+  ベクトル・IDFはビルドごとに別名の一時ファイルへ書いて置き換え、最後に書く recommend_meta.json が
+  どのファイルを使うかを指す。複数ワーカーが同時に作り直しても、読み手は常にそろった組を読む
+- 検索: 正規化済みベクトルの内積(コサイン類似度)で上位k件、
+  件数が多い場合はIVF(粗いクラスタ分割)で候補を絞り込み
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import unicodedata
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from prompt_catalog import PromptCatalog
+
+
+DEFAULT_INDEX_DIR = Path("build")
+HASH_DIM = 8192
+# この件数以上のときはIVFを自動で使う
+IVF_MIN_ROWS = 5000
+
+
+def _source_digest(prompts_dir: Path) -> str:
+    """prompts_dataの内容ハッシュ(インデックスの鮮度判定用)"""
+    digest = hashlib.sha1()
+    for file_path in sorted(Path(prompts_dir).glob("*.json")):
+        digest.update(file_path.name.encode("utf-8"))
+        digest.update(file_path.read_bytes())
+    return digest.hexdigest()
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class HashedTfidfEncoder:
+    """文字n-gramをハッシュ化したTF-IDFベクトル"""
+
+    name = "hashed-tfidf"
+
+    def __init__(self, dim: int = HASH_DIM, idf: Optional[np.ndarray] = None):
+        self.dim = dim
+        self.idf = idf
+
+    def _counts(self, text: str) -> np.ndarray:
+        text = unicodedata.normalize("NFKC", text or "").lower()
+        text = "".join(text.split())
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for n in (2, 3):
+            for i in range(len(text) - n + 1):
+                vec[zlib.crc32(text[i:i + n].encode("utf-8")) % self.dim] += 1.0
+        return np.log1p(vec)
+
+    def fit(self, texts: List[str]) -> np.ndarray:
+        tf = np.vstack([self._counts(t) for t in texts]) if texts else np.zeros((0, self.dim), np.float32)
+        df = (tf > 0).sum(axis=0)
+        self.idf = (np.log((len(texts) + 1) / (df + 1)) + 1.0).astype(np.float32)
+        return _normalize_rows(tf * self.idf)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        tf = np.vstack([self._counts(t) for t in texts])
+        return _normalize_rows(tf * self.idf)
+
+
+class SentenceModelEncoder:
+    """sentence-transformersのCPUモデル"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def fit(self, texts: List[str]) -> np.ndarray:
+        return self.encode(texts)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=64, normalize_embeddings=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class IVFIndex:
+    """球面k-meansで行列を粗く分割し、近いクラスタだけを探索する"""
+
+    def __init__(self, vectors: np.ndarray, nlist: Optional[int] = None, iterations: int = 10, seed: int = 0):
+        n = len(vectors)
+        self.nlist = max(1, min(n, nlist or int(np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(n, self.nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(vectors @ centroids.T, axis=1)
+            for c in range(self.nlist):
+                members = vectors[assign == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = _normalize_rows(centroids)
+        self.centroids = centroids
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assign == c) for c in range(self.nlist)]
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        nearest = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.concatenate([self.lists[c] for c in nearest])
+
+
+class PromptRecommender:
+    """プロンプト推薦インデックス"""
+
+    def __init__(self, prompts_dir: str = "prompts_data", index_dir: Path = DEFAULT_INDEX_DIR,
+                 model_name: Optional[str] = None, use_ivf: Optional[bool] = None, nprobe: int = 4,
+                 catalog: Optional[PromptCatalog] = None):
+        self.prompts_dir = Path(prompts_dir)
+        self.index_dir = Path(index_dir)
+        self.model_name = model_name if model_name is not None else os.getenv("RECOMMEND_MODEL")
+        self.nprobe = nprobe
+        self.catalog = catalog or PromptCatalog(str(self.prompts_dir))
+        self.items = [
+            (category, prompt)
+            for category in self.catalog.categories()
+            for prompt in self.catalog.prompts(category)
+        ]
+        self.encoder = None
+        self.vectors: Optional[np.ndarray] = None
+        self.load_or_build()
+        if use_ivf is None:
+            use_ivf = len(self.items) >= IVF_MIN_ROWS
+        self.ivf = IVFIndex(np.asarray(self.vectors)) if use_ivf and len(self.items) else None
+
+    def _vectors_path(self, build_id: str) -> Path:
+        return self.index_dir / f"recommend_vectors.{build_id}.f32"
+
+    @property
+    def _meta_path(self) -> Path:
+        return self.index_dir / "recommend_meta.json"
+
+    def _idf_path(self, build_id: str) -> Path:
+        return self.index_dir / f"recommend_idf.{build_id}.npy"
+
+    def _write_atomic(self, path: Path, write):
+        """同じディレクトリの一意な一時ファイルに書いてから置き換える (他のワーカーと書き込みが混ざらない)"""
+        with tempfile.NamedTemporaryFile(dir=self.index_dir, prefix=path.name + ".", suffix=".tmp",
+                                         delete=False) as f:
+            tmp_path = Path(f.name)
+            try:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                f.close()
+                tmp_path.unlink(missing_ok=True)
+                raise
+        os.replace(tmp_path, path)
+
+    def _remove_stale(self, build_id: str):
+        """今のメタ情報が指していないベクトル・IDFを消す (読み込み中のワーカーは開き直して作り直す)"""
+        for pattern in ("recommend_vectors*.f32", "recommend_idf*.npy"):
+            for path in self.index_dir.glob(pattern):
+                if path.name not in (self._vectors_path(build_id).name, self._idf_path(build_id).name):
+                    path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _document(prompt: Dict) -> str:
+        attachments = " ".join(prompt.get("recommended_attachments", []))
+        return f"{prompt.get('title', '')}\n{prompt.get('system_prompt', '')}\n{attachments}"
+
+    def _new_encoder(self):
+        if self.model_name:
+            return SentenceModelEncoder(self.model_name)
+        return HashedTfidfEncoder()
+
+    def load_or_build(self):
+        """保存済みインデックスが最新なら読み込み、古ければ作り直す"""
+        digest = _source_digest(self.prompts_dir)
+        backend = self.model_name or HashedTfidfEncoder.name
+        try:
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            fresh = (
+                meta.get("source") == digest
+                and meta.get("backend") == backend
+                and meta.get("rows") == len(self.items)
+                and (self.model_name or meta.get("dim") == HASH_DIM)
+            )
+            if fresh:
+                self._load(meta)
+                return
+        except (OSError, ValueError, KeyError):
+            # 未作成、旧形式、または他のワーカーが作り直して消したファイルを指している
+            pass
+        self.build(digest)
+
+    def _load(self, meta: Dict):
+        build_id = meta["build"]
+        encoder = (SentenceModelEncoder(self.model_name) if self.model_name
+                   else HashedTfidfEncoder(meta["dim"], np.load(self._idf_path(build_id))))
+        self.vectors = np.memmap(self._vectors_path(build_id), dtype=np.float32, mode="r",
+                                 shape=(meta["rows"], meta["dim"]))
+        self.encoder = encoder
+
+    def build(self, digest: Optional[str] = None):
+        """全プロンプトをベクトル化してメモリマップファイルに書き出す"""
+        self.encoder = self._new_encoder()
+        matrix = self.encoder.fit([self._document(p) for _, p in self.items]).astype(np.float32)
+
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        digest = digest or _source_digest(self.prompts_dir)
+        backend = self.model_name or HashedTfidfEncoder.name
+        # 同じ入力から作ったファイルは同じ名前になる (別々のワーカーが作っても中身は同じ)
+        build_id = hashlib.sha1(f"{digest}:{backend}:{matrix.shape}".encode("utf-8")).hexdigest()[:16]
+        self._write_atomic(self._vectors_path(build_id), matrix.tofile)
+        if isinstance(self.encoder, HashedTfidfEncoder):
+            self._write_atomic(self._idf_path(build_id), lambda f: np.save(f, self.encoder.idf))
+
+        meta = {
+            "source": digest,
+            "backend": backend,
+            "build": build_id,
+            "rows": int(matrix.shape[0]),
+            "dim": int(matrix.shape[1]),
+            "keys": [f"{category}:{p.get('id')}" for category, p in self.items],
+        }
+        # メタ情報は最後に置き換える (これが書き込み完了の印)
+        self._write_atomic(
+            self._meta_path, lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        )
+        self._remove_stale(build_id)
+
+        self.vectors = np.memmap(self._vectors_path(build_id), dtype=np.float32, mode="r", shape=matrix.shape)
+
+    def recommend(self, query: str, top_k: int = 5, category: Optional[str] = None) -> List[Dict]:
+        """クエリに近いプロンプトを類似度の高い順に返す"""
+        if not query or not query.strip() or not self.items:
+            return []
+
+        q = self.encoder.encode([query])[0]
+        if self.ivf is not None and category is None:
+            rows = self.ivf.candidates(q, self.nprobe)
+        elif category is not None:
+            rows = np.array([i for i, (cat, _) in enumerate(self.items) if cat == category], dtype=np.int64)
+        else:
+            rows = None
+
+        scores = self.vectors @ q if rows is None else self.vectors[rows] @ q
+        k = min(top_k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for i in top:
+            row = int(i) if rows is None else int(rows[i])
+            cat, prompt = self.items[row]
+            results.append({
+                "category": cat,
+                "score": round(float(scores[i]), 4),
+                "prompt": prompt,
+            })
+        return results
@@ -0,0 +1,220 @@
+"""
+プロンプトの利用状況の集計
+
+どのプロンプトが実際に使われているかを、プロンプトのグローバルID (`カテゴリ:id`) ごとに数えます。
+
+- 記録 (record) はメモリ上のカウンタを増やすだけで、リクエストの処理中に I/O はしない
+- バックグラウンドのスレッドが flush_interval 秒ごとに、たまった差分をまとめて SQLite に加算する
+  (日ごとの行に UPSERT するので、複数ワーカー・複数アプリから同じファイルに書いても合計が合う)
+- 人気度 (popularity) は書き出しのたびに集計し直してメモリに置く。新しい利用ほど重く数え、
+  half_life_days 日で半分になる。サンプリングの重み (sampling_weights) はここから作る
+
+イベントの種類:
+  view        プロンプトが個別に提示された (推薦結果など。カテゴリの一覧取得は数えない)
+  chat_start  そのプロンプトで会話を始めた
+  turn        そのプロンプトの会話で発言した
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ("view", "chat_start", "turn")
+# 人気度での各イベントの重み (表示されただけより、会話を始めた・続けたほうを重く見る)
+EVENT_WEIGHTS = {"view": 0.1, "chat_start": 1.0, "turn": 0.5}
+
+
+class UsageTracker:
+    """プロンプトごとの利用回数のカウンタ (SQLiteへのまとめ書きは任意)"""
+
+    def __init__(self, db_path: Optional[str] = None, flush_interval: float = 10.0,
+                 half_life_days: float = 30.0):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.half_life_days = half_life_days
+        self._pending: Counter = Counter()  # (uid, event, day) -> まだ書き出していない回数
+        self._totals: Dict[str, Dict[str, int]] = {}  # DB未使用時の累計
+        self._popularity: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = 0
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_usage ("
+                "uid TEXT NOT NULL, event TEXT NOT NULL, day TEXT NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (uid, event, day))"
+            )
+            self._db.commit()
+            self._popularity = self._compute_popularity()
+
+    @property
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """プロセスごとのSQLite接続 (fork後の子プロセスでは親の接続を使わず開き直す)"""
+        if not self.db_path:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    # 記録 (リクエストの処理中に呼ぶ。ロックを取ってカウンタを増やすだけ)
+
+    def record(self, uid: Optional[str], event: str, count: int = 1):
+        if uid:
+            self.record_many([uid], event, count)
+
+    def record_many(self, uids: Iterable[str], event: str, count: int = 1):
+        if event not in EVENTS:
+            raise ValueError(f"未知のイベントです: {event}")
+        day = date.today().isoformat()
+        with self._lock:
+            for uid in uids:
+                self._pending[(uid, event, day)] += count
+
+    # 書き出し
+
+    def start(self) -> "UsageTracker":
+        if self._thread is not None or self.flush_interval <= 0:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="prompt-usage-flush", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """書き出しスレッドを止め、残りを書き出す"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("プロンプトの利用状況の書き出しに失敗しました")
+
+    def flush(self) -> int:
+        """たまった差分を書き出して人気度を集計し直す。戻り値は書き出した行数"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, Counter()
+            if not pending:
+                return 0
+            rows = [(uid, event, day, count) for (uid, event, day), count in pending.items()]
+            if self._db is None:
+                for uid, event, _, count in rows:
+                    counts = self._totals.setdefault(uid, {})
+                    counts[event] = counts.get(event, 0) + count
+            else:
+                try:
+                    self._db.executemany(
+                        "INSERT INTO prompt_usage (uid, event, day, count) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (uid, event, day) DO UPDATE SET count = count + excluded.count",
+                        rows,
+                    )
+                    self._db.commit()
+                except sqlite3.Error:
+                    # 書けなかった分は次回にまわす
+                    with self._lock:
+                        self._pending.update(pending)
+                    raise
+            self._popularity = self._compute_popularity()
+            return len(rows)
+
+    # 集計
+
+    def _rows(self, since: Optional[str] = None) -> List[Tuple[str, str, str, int]]:
+        if self._db is None:
+            today = date.today().isoformat()
+            return [(uid, event, today, count) for uid, counts in self._totals.items() for event, count in counts.items()]
+        if since:
+            return self._db.execute(
+                "SELECT uid, event, day, count FROM prompt_usage WHERE day >= ?", (since,)
+            ).fetchall()
+        return self._db.execute("SELECT uid, event, day, count FROM prompt_usage").fetchall()
+
+    def _compute_popularity(self) -> Dict[str, float]:
+        today = date.today()
+        since = None
+        if self.half_life_days > 0:
+            # 重みが 1/1000 未満になる古い行は読まない
+            since = (today - timedelta(days=math.ceil(self.half_life_days * 10))).isoformat()
+        scores: Dict[str, float] = {}
+        for uid, event, day, count in self._rows(since):
+            decay = 1.0
+            if self.half_life_days > 0:
+                age = (today - date.fromisoformat(day)).days
+                decay = 0.5 ** (age / self.half_life_days)
+            scores[uid] = scores.get(uid, 0.0) + EVENT_WEIGHTS.get(event, 0.0) * count * decay
+        return scores
+
+    def popularity(self) -> Dict[str, float]:
+        """プロンプトごとの人気度 (最後の書き出し時点。呼び出しのたびには集計しない)"""
+        return self._popularity
+
+    def sampling_weights(self, strength: float = 1.0) -> Dict[str, float]:
+        """
+        サンプリングの重み (1 + strength × 人気度/最大の人気度)
+        含まれないプロンプトは重み1として扱う。strength=1 なら最も人気のものが2倍選ばれやすい
+        """
+        scores = self._popularity
+        if strength <= 0 or not scores:
+            return {}
+        top = max(scores.values()) or 1.0
+        return {uid: 1.0 + strength * score / top for uid, score in scores.items()}
+
+    def stats(self, days: Optional[int] = None, top: int = 20) -> Dict:
+        """
+        集計結果 (書き出し済みの分 + このプロセスでまだ書き出していない分)
+        days を指定すると直近その日数だけを数える
+        """
+        since = (date.today() - timedelta(days=days - 1)).isoformat() if days else None
+        totals: Dict[str, Dict[str, int]] = {}
+        # 書き出しの途中で読むと同じ分を二重に数えるので、書き出しと同じロックの中で読む
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self._pending.items())
+            rows = self._rows(since) + [(uid, event, day, count) for (uid, event, day), count in pending]
+        for uid, event, day, count in rows:
+            if since and day < since:
+                continue
+            counts = totals.setdefault(uid, dict.fromkeys(EVENTS, 0))
+            counts[event] += count
+
+        by_category: Dict[str, Dict[str, int]] = {}
+        for uid, counts in totals.items():
+            category = by_category.setdefault(uid.split(":", 1)[0], dict.fromkeys(EVENTS, 0))
+            for event, count in counts.items():
+                category[event] += count
+
+        popularity = self._popularity
+        ranked = sorted(totals, key=lambda uid: (popularity.get(uid, 0.0), totals[uid]["turn"]), reverse=True)
+        return {
+            "generated_at": time.time(),
+            "days": days,
+            "totals": {event: sum(counts[event] for counts in totals.values()) for event in EVENTS},
+            "prompts_used": sum(1 for counts in totals.values() if counts["chat_start"] or counts["turn"]),
+            "categories": by_category,
+            "top": [
+                dict(uid=uid, popularity=round(popularity.get(uid, 0.0), 3), **totals[uid])
+                for uid in ranked[:top]
+            ],
+        }
@@ -0,0 +1,55 @@
+"""
+ストリーミング応答の間引き描画
+
+チャンクが届くたびに全文を描画し直すと、応答が長くなるほどMarkdownの再解析とブラウザへの送信が
+増え (全体で O(n²))、表示がモデルの生成に追いつかなくなります。
+届いたチャンクはリストに溜め、一定間隔 (interval 秒) または一定チャンク数 (max_pending) ごとに
+まとめて描画します。最後に finish() で全文を描画するため、最終的な表示は毎回描画した場合と同じです。
+"""
+
+import time
+from typing import Callable, List
+
+
+class ThrottledRenderer:
+    """placeholder (markdown(text) を持つもの。st.empty() など) に間引いて描画する"""
+
+    def __init__(self, placeholder, interval: float = 0.1, max_pending: int = 64, cursor: str = "▌",
+                 clock: Callable[[], float] = time.monotonic):
+        self.placeholder = placeholder
+        self.interval = interval
+        self.max_pending = max_pending
+        self.cursor = cursor
+        self._clock = clock
+        self._parts: List[str] = []
+        self._pending = 0
+        self._last_render = clock()
+        self.renders = 0
+
+    @property
+    def text(self) -> str:
+        """ここまでに届いた全文"""
+        if len(self._parts) > 1:
+            # 描画のたびに連結済みの1要素にまとめ、次回は差分だけを連結する
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def append(self, chunk: str):
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        self._pending += 1
+        if self._pending >= self.max_pending or self._clock() - self._last_render >= self.interval:
+            self._render(self.text + self.cursor)
+
+    def _render(self, text: str):
+        self.placeholder.markdown(text)
+        self._pending = 0
+        self._last_render = self._clock()
+        self.renders += 1
+
+    def finish(self) -> str:
+        """全文をカーソルなしで描画し、全文を返す"""
+        text = self.text
+        self._render(text)
+        return text
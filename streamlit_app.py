@@ -1,15 +1,27 @@
 import streamlit as st
+import atexit
 import json
 from pathlib import Path
 import random
 from datetime import datetime
 import os
-from openai import OpenAI
 from dotenv import load_dotenv
-import pandas as pd
-import io
-import pdfplumber
-from docx import Document
+import sys
+
+# 共有モジュール (src/) を読み込めるようにする
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+from chat_search import ChatSearchIndex
+from chat_store import ChatStore, new_conversation_id
+from chunk_index import ChunkIndexCache, partition_attachments, retrieve_attachments
+from doc_chunker import estimate_tokens
+from extraction import ExtractionCache
+from message_layout import build_messages, make_attachment, pin_attachment, usage_summary
+from model_router import get_model_router
+from openai_client import get_openai_client
+from prompt_catalog import CatalogWatcher, PromptCatalog, prompt_uid, weighted_order
+from prompt_recommender import PromptRecommender
+from prompt_usage import UsageTracker
+from stream_render import ThrottledRenderer
 
 # 環境変数を読み込む
 load_dotenv()
@@ -96,50 +108,39 @@ st.markdown("""
 CHAT_HISTORY_DIR = Path("chat_history")
 CHAT_HISTORY_DIR.mkdir(exist_ok=True)
 
+# チャット履歴ストア（会話ごとのJSONLに追記し、全文検索インデックスも差分で更新。プロセス内で共有）
+@st.cache_resource
+def get_chat_store():
+    search_index = ChatSearchIndex(CHAT_HISTORY_DIR / "search_index.sqlite3")
+    store = ChatStore(CHAT_HISTORY_DIR, search_index=search_index)
+    search_index.sync(store)
+    return store
+
 # チャット履歴を保存する関数
-def save_chat_history(title, messages, selected_prompt=None):
-    """チャット履歴をJSONファイルに保存"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{title}_{timestamp}.json"
-    filepath = CHAT_HISTORY_DIR / filename
-    
-    history_data = {
-        "title": title,
-        "timestamp": timestamp,
-        "messages": messages,
-        "selected_prompt": selected_prompt
-    }
-    
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(history_data, f, ensure_ascii=False, indent=2)
-    
-    return filepath
+def save_chat_history(title, messages, selected_prompt=None, attachments=None, conversation_id=None, rename=False):
+    """
+    チャット履歴を保存（同じ会話IDなら前回から増えたメッセージだけを追記）
+    title は新規作成時のみ使い、既存の会話では rename=True の場合だけ変更する
+    """
+    return get_chat_store().save(
+        conversation_id or new_conversation_id(),
+        messages,
+        title,
+        selected_prompt,
+        attachments,
+        rename=rename,
+    )
 
 # チャット履歴一覧を取得する関数
 def list_chat_histories():
     """保存されたチャット履歴のリストを取得"""
-    histories = []
-    for filepath in sorted(CHAT_HISTORY_DIR.glob("*.json"), reverse=True):
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                histories.append({
-                    "filename": filepath.name,
-                    "filepath": filepath,
-                    "title": data.get("title", "無題"),
-                    "timestamp": data.get("timestamp", ""),
-                    "message_count": len(data.get("messages", []))
-                })
-        except Exception as e:
-            continue
-    return histories
+    return get_chat_store().list()
 
 # チャット履歴を読み込む関数
 def load_chat_history(filepath):
     """指定されたファイルからチャット履歴を読み込む"""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return get_chat_store().load(Path(filepath).name)
     except Exception as e:
         st.error(f"履歴の読み込みに失敗しました: {str(e)}")
         return None
@@ -148,133 +149,106 @@ def load_chat_history(filepath):
 def delete_chat_history(filepath):
     """指定されたチャット履歴を削除"""
     try:
-        filepath.unlink()
-        return True
+        return get_chat_store().delete(Path(filepath).name)
     except Exception as e:
         st.error(f"履歴の削除に失敗しました: {str(e)}")
         return False
 
-# OpenAI APIクライアント初期化
-def get_openai_client():
-    api_key = os.getenv("OPENAI_API_KEY")
-    if api_key:
-        return OpenAI(api_key=api_key)
-    return None
+# プロンプトカタログ（プロセス内で共有、build/catalog.json があれば優先）
+# prompts_data の変更は監視スレッドが検知し、変更カテゴリだけを差し替える
+@st.cache_resource
+def get_catalog():
+    catalog = PromptCatalog("prompts_data")
+    watcher = CatalogWatcher(catalog)
+    watcher.add_listener(lambda changed: get_recommender.clear())
+    watcher.start()
+    return catalog
 
-# トークン数を概算する関数（1トークン ≒ 4文字）
-def estimate_tokens(text):
-    """テキストのトークン数を概算"""
-    return len(text) // 4
+# プロンプト推薦インデックス（プロセス内で共有）
+@st.cache_resource
+def get_recommender():
+    return PromptRecommender("prompts_data", catalog=get_catalog())
+
+# プロンプトの利用状況（メモリ上で数え、バックエンドと同じ SQLite にまとめて書き出す）
+# 人気度でプロンプト生成の抽選を偏らせる強さ (既定の0では一様に選ぶ)
+POPULARITY_WEIGHT = float(os.getenv("PROMPT_POPULARITY_WEIGHT", "0"))
+
+@st.cache_resource
+def get_usage_tracker():
+    tracker = UsageTracker(
+        os.getenv("PROMPT_USAGE_DB", str(Path(__file__).parent / "build" / "usage.sqlite3")) or None,
+        flush_interval=float(os.getenv("PROMPT_USAGE_FLUSH_INTERVAL", "10")),
+        half_life_days=float(os.getenv("PROMPT_POPULARITY_HALF_LIFE", "30")),
+    ).start()
+    atexit.register(tracker.stop)
+    return tracker
+
+def track_views(uids, key):
+    """個別に表示したプロンプト (推薦結果など) を数える。同じ表示の再実行では数え直さない"""
+    viewed = st.session_state.setdefault("viewed_prompts", {})
+    uids = list(uids)
+    if viewed.get(key) != uids:
+        viewed[key] = uids
+        get_usage_tracker().record_many(uids, "view")
+
+def track_chat(selected_prompt, first_turn):
+    """カタログのプロンプトを使った発言を数える（カウンタを増やすだけ）"""
+    if selected_prompt:
+        uid = get_catalog().find_by_system_prompt(selected_prompt.get("system_prompt"))
+        if uid:
+            if first_turn:
+                get_usage_tracker().record(uid, "chat_start")
+            get_usage_tracker().record(uid, "turn")
+
+# 添付資料の抜粋（RAG_MIN_TOKENS 以上の資料は索引し、質問に関係する上位 RAG_TOP_K 件だけを送る）
+RAG_MIN_TOKENS = int(os.getenv("RAG_MIN_TOKENS", "2000"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "6"))
+RAG_CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "600"))
+
+# 会話ごとの添付資料の索引（プロセス内で共有。再実行や履歴の読み込み後も会話IDで引き継ぐ）
+@st.cache_resource
+def get_chunk_indexes():
+    return ChunkIndexCache(chunk_tokens=RAG_CHUNK_TOKENS)
+
+# ストリーミング応答を描画し直す間隔（秒）
+STREAM_RENDER_INTERVAL = float(os.getenv("STREAM_RENDER_INTERVAL", "0.1"))
 
-# ファイル内容を切り詰める関数
-def truncate_content(content, max_tokens=15000):
-    """
-    コンテンツが大きすぎる場合に切り詰める
-    max_tokens: 最大トークン数（デフォルト15000 ≒ 60,000文字）
-    """
-    estimated_tokens = estimate_tokens(content)
-    
-    if estimated_tokens <= max_tokens:
-        return content, False  # 切り詰めなし
-    
-    # 切り詰める
-    max_chars = max_tokens * 4
-    truncated = content[:max_chars]
-    
-    # 最後の改行で切る（途中で切れないように）
-    last_newline = truncated.rfind('\n')
-    if last_newline > max_chars * 0.9:  # 90%以上の位置に改行があれば
-        truncated = truncated[:last_newline]
-    
-    return truncated, True  # 切り詰めあり
+
+# 抽出結果のキャッシュ (バックエンドと同じ EXTRACT_CACHE_DIR を共有できる)
+@st.cache_resource
+def get_extraction_cache():
+    return ExtractionCache(
+        os.getenv("EXTRACT_CACHE_DIR") or Path(__file__).parent / "build" / "extracted",
+        max_files=int(os.getenv("EXTRACT_CACHE_MAX_FILES", "256")),
+    )
 
 # ファイル内容を読み取る関数
-def read_file_content(uploaded_file):
+def read_file_content(uploaded_file, max_tokens=15000):
     """
-    アップロードされたファイルの内容を読み取り、テキスト形式で返す
+    アップロードされたファイルの内容をページ・シート・段落単位で読み取る
     Excel、CSV、PDF、Word、テキストファイルに対応
+    max_tokens: 最大トークン数（デフォルト15000 ≒ 60,000文字）。これを超えた分は読まずに切り詰める
+    戻り値は (本文, ファイル種別, 切り詰めたか)。失敗した場合は (None, "error: ...", False)
     """
-    file_name = uploaded_file.name
-    file_extension = Path(file_name).suffix.lower()
-    
     try:
-        # PDFファイルの場合
-        if file_extension == '.pdf':
-            uploaded_file.seek(0)
-            text_parts = []
-            with pdfplumber.open(uploaded_file) as pdf:
-                for i, page in enumerate(pdf.pages, 1):
-                    page_text = page.extract_text()
-                    if page_text:
-                        text_parts.append(f"\n--- ページ {i} ---\n{page_text}")
-            
-            if text_parts:
-                content = "".join(text_parts)
-                content += f"\n\n(総ページ数: {len(pdf.pages)})"
-                return content, "pdf"
-            else:
-                return None, "error: PDFからテキストを抽出できませんでした"
-        
-        # Wordファイルの場合
-        elif file_extension in ['.docx', '.doc']:
-            uploaded_file.seek(0)
-            if file_extension == '.docx':
-                doc = Document(uploaded_file)
-                text_parts = []
-                for i, para in enumerate(doc.paragraphs, 1):
-                    if para.text.strip():
-                        text_parts.append(para.text)
-                
-                content = "\n".join(text_parts)
-                if content.strip():
-                    content += f"\n\n(段落数: {len([p for p in doc.paragraphs if p.text.strip()])})"
-                    return content, "word"
-                else:
-                    return None, "error: Wordファイルからテキストを抽出できませんでした"
-            else:
-                return None, "error: .doc形式は非対応です。.docx形式に変換してください"
-        
-        # Excelファイルの場合
-        elif file_extension in ['.xlsx', '.xls']:
-            uploaded_file.seek(0)
-            df_dict = pd.read_excel(uploaded_file, sheet_name=None)
-            
-            content_parts = []
-            for sheet_name, df in df_dict.items():
-                content_parts.append(f"\n=== シート: {sheet_name} ===\n")
-                content_parts.append(df.to_string(index=False))
-                content_parts.append(f"\n(行数: {len(df)}, 列数: {len(df.columns)})\n")
-            
-            return "".join(content_parts), "excel"
-        
-        # CSVファイルの場合
-        elif file_extension == '.csv':
-            uploaded_file.seek(0)
-            for encoding in ['utf-8', 'shift_jis', 'cp932']:
-                try:
-                    uploaded_file.seek(0)
-                    df = pd.read_csv(uploaded_file, encoding=encoding)
-                    content = f"\n{df.to_string(index=False)}\n(行数: {len(df)}, 列数: {len(df.columns)})\n"
-                    return content, "csv"
-                except UnicodeDecodeError:
-                    continue
-            return None, "error: CSVファイルのエンコーディングを判別できませんでした"
-        
-        # テキストファイルの場合
-        else:
-            uploaded_file.seek(0)
-            # 複数のエンコーディングを試す
-            for encoding in ['utf-8', 'shift_jis', 'cp932', 'latin-1']:
-                try:
-                    uploaded_file.seek(0)
-                    content = uploaded_file.read().decode(encoding)
-                    return content, "text"
-                except UnicodeDecodeError:
-                    continue
-            return None, "error: テキストファイルのエンコーディングを判別できませんでした"
-            
+        uploaded_file.seek(0)
+        document, _ = get_extraction_cache().extract(uploaded_file.read(), uploaded_file.name, max_tokens)
     except Exception as e:
-        return None, f"error: {str(e)}"
+        return None, f"error: {str(e)}", False
+    
+    # ページ・シートなどの単位の境界で切り詰める
+    content, was_truncated = document.truncate(max_tokens)
+    if not content.strip():
+        return None, "error: ファイルからテキストを抽出できませんでした", False
+    
+    # ファイル全体の規模を添える
+    if "pages" in document.meta:
+        content += f"\n\n(総ページ数: {document.meta['pages']})"
+    elif document.file_type == "word" and document.complete:
+        content += f"\n\n(段落数: {document.meta.get('paragraphs', 0)}, 表: {document.meta.get('tables', 0)})"
+    elif "sheets" in document.meta:
+        content += f"\n\n(シート数: {document.meta['sheets']})"
+    return content, document.file_type, was_truncated
 
 class PromptGenerator:
     def __init__(self):
@@ -347,14 +321,7 @@ class PromptGenerator:
         if not file_name:
             return None
         
-        file_path = self.prompts_dir / file_name
-        if not file_path.exists():
-            return None
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        return data
+        return get_catalog().get(Path(file_name).stem)
 
     def generate_prompts(self, category, count=10):
         """ランダムにプロンプトを生成"""
@@ -366,8 +333,11 @@ class PromptGenerator:
         if not prompts:
             return None
         
-        # ランダムに選択
-        selected = random.sample(prompts, min(count, len(prompts)))
+        # ランダムに選択（PROMPT_POPULARITY_WEIGHT を指定すると、よく使われているプロンプトほど先に選ばれやすい）
+        popularity = get_usage_tracker().sampling_weights(POPULARITY_WEIGHT)
+        weights = [popularity.get(prompt_uid(category, p.get("id")), 1.0) for p in prompts]
+        order = weighted_order(weights, random)[:min(count, len(prompts))]
+        selected = [prompts[i] for i in order]
         return {
             "category": data.get("category", category),
             "prompts": selected
@@ -386,8 +356,14 @@ def main():
         st.session_state.mode = "generator"  # generator または chatbot
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "attachments" not in st.session_state:
+        st.session_state.attachments = []  # 会話に固定した添付資料
+    if "conversation_id" not in st.session_state:
+        st.session_state.conversation_id = new_conversation_id()
     if "selected_prompt" not in st.session_state:
         st.session_state.selected_prompt = None
+    if "selected_category" not in st.session_state:
+        st.session_state.selected_category = None  # 選んだプロンプトのカテゴリキー (モデルの振り分けに使う)
     
     # サイドバー
     with st.sidebar:
@@ -411,7 +387,9 @@ def main():
                 save_chat_history(
                     auto_title,
                     st.session_state.messages,
-                    st.session_state.selected_prompt
+                    st.session_state.selected_prompt,
+                    st.session_state.attachments,
+                    conversation_id=st.session_state.conversation_id
                 )
                 st.toast(f"✅ 会話を自動保存しました: {auto_title}", icon="💾")
             
@@ -448,7 +426,14 @@ def main():
         
         st.markdown("---")
         st.markdown("**統計情報**")
-        st.info(f"📊 合計22カテゴリ\n\n📝 合計780個のプロンプト")
+        # 統計はカタログの読み込み時に計算済み (prompts_data が変わったときだけ集計し直す)
+        stats = get_catalog().stats()
+        st.info(
+            f"📊 合計{stats['category_count']}カテゴリ\n\n"
+            f"📝 合計{stats['count']}個のプロンプト\n\n"
+            f"📏 システムプロンプト: 中央値{stats['chars']['p50']}文字（約{stats['tokens']['p50']}トークン）\n\n"
+            f"📎 推奨添付資料: {stats['attachment_vocabulary']}種類"
+        )
     
     # メインエリア
     if st.session_state.mode == "generator":
@@ -458,7 +443,12 @@ def main():
     else:
         show_chatbot_mode(generator)
 
-def switch_to_chat(prompt):
+def prompt_category(prompt):
+    """プロンプトのカテゴリキー (プロンプトの辞書には含まれないので、カタログから本文で引く)"""
+    uid = get_catalog().find_by_system_prompt((prompt or {}).get("system_prompt"))
+    return uid.split(":", 1)[0] if uid else None
+
+def switch_to_chat(prompt, category=None):
     """チャットモードに切り替える"""
     # 現在の会話がある場合は自動保存
     if len(st.session_state.messages) > 0:
@@ -466,14 +456,38 @@ def switch_to_chat(prompt):
         save_chat_history(
             auto_title,
             st.session_state.messages,
-            st.session_state.selected_prompt
+            st.session_state.selected_prompt,
+            st.session_state.attachments,
+            conversation_id=st.session_state.conversation_id
         )
         st.toast(f"✅ 前の会話を自動保存しました: {auto_title}", icon="💾")
     
     st.session_state.selected_prompt = prompt
+    st.session_state.selected_category = category or prompt_category(prompt)
     st.session_state.messages = []
+    st.session_state.attachments = []
+    st.session_state.conversation_id = new_conversation_id()
     st.session_state.mode = "chatbot"
 
+def open_chat_history(filepath, title):
+    """保存済みの会話を読み込んでチャットを再開する"""
+    data = load_chat_history(filepath)
+    if data:
+        st.session_state.messages = data.get('messages', [])
+        st.session_state.attachments = data.get('attachments', [])
+        # 旧形式(.json)の履歴は新しい会話IDで続きを保存する
+        st.session_state.conversation_id = data.get('conversation_id') or new_conversation_id()
+        st.session_state.selected_prompt = data.get('selected_prompt')
+        st.session_state.selected_category = prompt_category(data.get('selected_prompt'))
+        st.session_state.show_history = False
+        st.success(f"✅ {title} を読み込みました")
+        st.rerun()
+
+def use_recommended_prompt(prompt, category=None):
+    """推薦されたプロンプトでチャットを開始する"""
+    switch_to_chat(prompt, category)
+    st.session_state.show_prompt_selector = False
+
 def show_generator_mode(generator, generate_button, category, count):
     """プロンプト生成モード"""
     if generate_button:
@@ -511,7 +525,7 @@ def show_generator_mode(generator, generate_button, category, count):
                         # チャットボタン
                         st.markdown("---")
                         button_key = f"chat_expand_{i}_{hash(prompt['title'])}"
-                        if st.button("💬 このプロンプトでチャット", key=button_key, type="primary", use_container_width=True, on_click=switch_to_chat, args=(prompt,)):
+                        if st.button("💬 このプロンプトでチャット", key=button_key, type="primary", use_container_width=True, on_click=switch_to_chat, args=(prompt, category)):
                             pass  # コールバックで処理
             else:
                 st.error("❌ プロンプトの生成に失敗しました")
@@ -562,12 +576,17 @@ def show_chatbot_mode(generator):
                 save_chat_history(
                     auto_title,
                     st.session_state.messages,
-                    st.session_state.selected_prompt
+                    st.session_state.selected_prompt,
+                    st.session_state.attachments,
+                    conversation_id=st.session_state.conversation_id
                 )
                 st.toast(f"✅ 前の会話を自動保存しました: {auto_title}", icon="💾")
             
             st.session_state.messages = []
+            st.session_state.attachments = []
+            st.session_state.conversation_id = new_conversation_id()
             st.session_state.selected_prompt = None
+            st.session_state.selected_category = None
             st.rerun()
     
     with col3:
@@ -592,7 +611,10 @@ def show_chatbot_mode(generator):
                     filepath = save_chat_history(
                         save_title,
                         st.session_state.messages,
-                        st.session_state.selected_prompt
+                        st.session_state.selected_prompt,
+                        st.session_state.attachments,
+                        conversation_id=st.session_state.conversation_id,
+                        rename=True
                     )
                     st.success(f"✅ 保存しました: {filepath.name}")
                     st.session_state.show_save_dialog = False
@@ -606,41 +628,55 @@ def show_chatbot_mode(generator):
     # 履歴表示
     if st.session_state.get('show_history', False):
         with st.expander("📚 会話履歴", expanded=True):
-            histories = list_chat_histories()
+            search_query = st.text_input(
+                "🔍 会話を検索",
+                placeholder="例: 契約書 レビュー",
+                key="history_search_query",
+            )
             
-            if histories:
-                st.markdown(f"**保存された会話: {len(histories)}件**")
-                
-                for hist in histories:
-                    col_h1, col_h2, col_h3 = st.columns([3, 1, 1])
+            if search_query.strip():
+                results = get_chat_store().search_index.search(search_query, limit=20)
+                st.markdown(f"**検索結果: {len(results)}件**")
+                for result in results:
+                    col_s1, col_s2 = st.columns([4, 1])
+                    with col_s1:
+                        st.markdown(f"**{result['title']}**")
+                        st.caption(result['snippet'].replace("\n", " "))
+                    with col_s2:
+                        if st.button("📂 読込", key=f"search_load_{result['filename']}", use_container_width=True):
+                            open_chat_history(CHAT_HISTORY_DIR / result['filename'], result['title'])
+                    st.markdown("---")
+                if not results:
+                    st.info("該当する会話はありません")
+            else:
+                histories = list_chat_histories()
+                if histories:
+                    st.markdown(f"**保存された会話: {len(histories)}件**")
                     
-                    with col_h1:
-                        # タイトルと情報
-                        timestamp_str = datetime.strptime(hist['timestamp'], "%Y%m%d_%H%M%S").strftime("%Y/%m/%d %H:%M")
-                        st.markdown(f"**{hist['title']}**")
-                        st.caption(f"📅 {timestamp_str} | 💬 {hist['message_count']}件のメッセージ")
+                    for hist in histories:
+                        col_h1, col_h2, col_h3 = st.columns([3, 1, 1])
                     
-                    with col_h2:
-                        # 読み込みボタン
-                        if st.button("📂 読込", key=f"load_{hist['filename']}", use_container_width=True):
-                            data = load_chat_history(hist['filepath'])
-                            if data:
-                                st.session_state.messages = data.get('messages', [])
-                                st.session_state.selected_prompt = data.get('selected_prompt')
-                                st.session_state.show_history = False
-                                st.success(f"✅ {hist['title']} を読み込みました")
-                                st.rerun()
+                        with col_h1:
+                            # タイトルと情報
+                            timestamp_str = datetime.strptime(hist['timestamp'], "%Y%m%d_%H%M%S").strftime("%Y/%m/%d %H:%M")
+                            st.markdown(f"**{hist['title']}**")
+                            st.caption(f"📅 {timestamp_str} | 💬 {hist['message_count']}件のメッセージ")
                     
-                    with col_h3:
-                        # 削除ボタン
-                        if st.button("🗑️", key=f"delete_{hist['filename']}", use_container_width=True, help="削除"):
-                            if delete_chat_history(hist['filepath']):
-                                st.success(f"✅ {hist['title']} を削除しました")
-                                st.rerun()
+                        with col_h2:
+                            # 読み込みボタン
+                            if st.button("📂 読込", key=f"load_{hist['filename']}", use_container_width=True):
+                                open_chat_history(hist['filepath'], hist['title'])
                     
-                    st.markdown("---")
-            else:
-                st.info("保存された会話はありません")
+                        with col_h3:
+                            # 削除ボタン
+                            if st.button("🗑️", key=f"delete_{hist['filename']}", use_container_width=True, help="削除"):
+                                if delete_chat_history(hist['filepath']):
+                                    st.success(f"✅ {hist['title']} を削除しました")
+                                    st.rerun()
+                    
+                        st.markdown("---")
+                else:
+                    st.info("保存された会話はありません")
             
             if st.button("❌ 閉じる", use_container_width=True):
                 st.session_state.show_history = False
@@ -649,6 +685,25 @@ def show_chatbot_mode(generator):
     # プロンプト選択ダイアログ
     if hasattr(st.session_state, 'show_prompt_selector') and st.session_state.show_prompt_selector:
         with st.expander("📋 プロンプトを選択", expanded=True):
+            # やりたいことから推薦
+            task_query = st.text_input(
+                "🔍 やりたいことから探す",
+                placeholder="例: 契約書のリスクをチェックしたい",
+                key="prompt_recommend_query"
+            )
+            if task_query:
+                recommendations = get_recommender().recommend(task_query, top_k=5)
+                track_views((prompt_uid(rec['category'], rec['prompt']['id']) for rec in recommendations), "recommend")
+                for i, rec in enumerate(recommendations):
+                    col_r1, col_r2 = st.columns([4, 1])
+                    with col_r1:
+                        st.markdown(f"**{rec['prompt']['title']}**")
+                        st.caption(f"{generator.category_names.get(rec['category'], rec['category'])} | 類似度 {rec['score']:.2f}")
+                    with col_r2:
+                        st.button("✅ 使用", key=f"use_recommended_{i}_{rec['category']}_{rec['prompt']['id']}",
+                                  use_container_width=True, on_click=use_recommended_prompt, args=(rec['prompt'], rec['category']))
+                st.markdown("---")
+            
             category = st.selectbox(
                 "カテゴリを選択",
                 options=list(generator.file_map.keys()),
@@ -676,12 +731,17 @@ def show_chatbot_mode(generator):
                             save_chat_history(
                                 auto_title,
                                 st.session_state.messages,
-                                st.session_state.selected_prompt
+                                st.session_state.selected_prompt,
+                                st.session_state.attachments,
+                                conversation_id=st.session_state.conversation_id
                             )
                             st.toast(f"✅ 前の会話を自動保存しました: {auto_title}", icon="💾")
                         
                         st.session_state.selected_prompt = selected_prompt
+                        st.session_state.selected_category = category
                         st.session_state.messages = []
+                        st.session_state.attachments = []
+                        st.session_state.conversation_id = new_conversation_id()
                         st.session_state.show_prompt_selector = False
                         st.rerun()
             
@@ -757,49 +817,38 @@ def show_chatbot_mode(generator):
             st.error("❌ OpenAI APIキーが設定されていません。`.env`ファイルに`OPENAI_API_KEY`を設定してください。")
             return
         
-        # 添付ファイルの内容を読み取る
-        file_contents = []
+        # 添付ファイルの内容を読み取り、会話に固定する
+        # (メッセージ本文に埋め込むと毎ターン先頭が変わり、プロンプトキャッシュが効かないため)
         file_info_list = []
         total_truncated = False
         
         if uploaded_files:
             for uploaded_file in uploaded_files:
                 # 新しいファイル読み取り関数を使用
-                content, file_type = read_file_content(uploaded_file)
+                # 1ファイルあたり最大15000トークン ≒ 60KB まで
+                truncated_content, file_type, was_truncated = read_file_content(uploaded_file, max_tokens=15000)
                 
-                if content:
-                    # コンテンツを切り詰める（1ファイルあたり最大15000トークン ≒ 60KB）
-                    truncated_content, was_truncated = truncate_content(content, max_tokens=15000)
-                    
+                if truncated_content:
                     if was_truncated:
                         total_truncated = True
                     
-                    # 成功した場合
-                    truncate_notice = " ⚠️ (ファイルが大きいため一部省略されました)" if was_truncated else ""
-                    
-                    if file_type == "pdf":
-                        file_contents.append(f"\n\n--- 📕 {uploaded_file.name} (PDFファイル){truncate_notice} ---\n{truncated_content}")
-                    elif file_type == "word":
-                        file_contents.append(f"\n\n--- 📘 {uploaded_file.name} (Wordファイル){truncate_notice} ---\n{truncated_content}")
-                    elif file_type == "excel":
-                        file_contents.append(f"\n\n--- 📊 {uploaded_file.name} (Excelファイル){truncate_notice} ---\n{truncated_content}")
-                    elif file_type == "csv":
-                        file_contents.append(f"\n\n--- 📄 {uploaded_file.name} (CSVファイル){truncate_notice} ---\n{truncated_content}")
-                    else:  # text
-                        file_contents.append(f"\n\n--- 📝 {uploaded_file.name} (テキストファイル){truncate_notice} ---\n{truncated_content}")
-                    
-                    file_info_list.append({
-                        "name": uploaded_file.name,
-                        "size": uploaded_file.size,
-                        "type": file_type,
-                        "truncated": was_truncated
-                    })
+                    attachment = make_attachment(
+                        uploaded_file.name, file_type, truncated_content, was_truncated, uploaded_file.size
+                    )
+                    # 既に固定済みの資料は追加しない(同じ内容なら前のターンと同じバイト列のまま)
+                    if pin_attachment(st.session_state.attachments, attachment):
+                        file_info_list.append({
+                            "name": uploaded_file.name,
+                            "size": uploaded_file.size,
+                            "type": file_type,
+                            "truncated": was_truncated
+                        })
                 else:
                     # 読み込みに失敗した場合
                     error_msg = f"⚠️ {uploaded_file.name} の読み込みに失敗しました"
                     if "error:" in file_type:
                         error_msg += f" ({file_type})"
-                    file_contents.append(f"\n\n--- {error_msg} ---")
+                    st.warning(error_msg)
                     file_info_list.append({
                         "name": uploaded_file.name,
                         "size": uploaded_file.size,
@@ -810,24 +859,28 @@ def show_chatbot_mode(generator):
         if total_truncated:
             st.warning("⚠️ 一部のファイルが大きすぎるため、内容の一部が省略されました。より詳細な分析が必要な場合は、ファイルを分割してアップロードしてください。")
         
-        # プロンプトにファイル内容を追加
-        full_prompt = prompt
-        if file_contents:
-            full_prompt += "\n\n" + "".join(file_contents)
-        
-        # 全体のトークン数をチェック
-        total_tokens = estimate_tokens(full_prompt)
+        # 全体のトークン数をチェック（固定した添付資料と、大きな資料から送る抜粋の上限を含む）
+        pinned, indexed = partition_attachments(st.session_state.attachments, RAG_MIN_TOKENS)
+        total_tokens = estimate_tokens(prompt) + sum(estimate_tokens(a["content"]) for a in pinned)
+        if indexed:
+            total_tokens += min(
+                sum(estimate_tokens(a["content"]) for a in indexed), RAG_TOP_K * RAG_CHUNK_TOKENS
+            )
         if total_tokens > 25000:  # 25,000トークン以上の場合は警告
             st.error(f"❌ 入力が大きすぎます（推定 {total_tokens:,} トークン）。ファイルを分割するか、テキストを減らしてください。")
             return
         elif total_tokens > 20000:  # 20,000トークン以上の場合は注意喚起
             st.warning(f"⚠️ 入力が大きいです（推定 {total_tokens:,} トークン）。処理に時間がかかる可能性があります。")
         
-        # ユーザーメッセージを追加
-        user_message = {"role": "user", "content": full_prompt}
+        # ユーザーメッセージを追加（本文のみ。ファイル内容は attachments 側）
+        user_message = {"role": "user", "content": prompt}
         if file_info_list:
             user_message["files"] = file_info_list
         
+        track_chat(
+            st.session_state.selected_prompt,
+            first_turn=not any(m["role"] == "assistant" for m in st.session_state.messages),
+        )
         st.session_state.messages.append(user_message)
         with st.chat_message("user"):
             col1, col2 = st.columns([0.95, 0.05])
@@ -863,35 +916,62 @@ def show_chatbot_mode(generator):
                     message_placeholder = st.empty()
                 
                 full_response = ""
+                usage = None
                 
-                # システムプロンプトを含めてAPI呼び出し
-                messages = []
-                if st.session_state.selected_prompt:
-                    messages.append({
-                        "role": "system",
-                        "content": st.session_state.selected_prompt['system_prompt']
-                    })
+                # 大きな資料は会話ごとの索引から、今回の質問に関係する抜粋だけを送る
+                pinned, context = retrieve_attachments(
+                    get_chunk_indexes(),
+                    st.session_state.conversation_id,
+                    st.session_state.attachments,
+                    prompt,
+                    RAG_TOP_K,
+                    RAG_MIN_TOKENS,
+                )
                 
-                messages.extend([
-                    {"role": m["role"], "content": m["content"]}
-                    for m in st.session_state.messages
-                ])
+                # システムプロンプト → 固定添付資料 → 会話履歴 (+ 抜粋) の順でAPI呼び出し
+                messages = build_messages(
+                    st.session_state.selected_prompt['system_prompt'] if st.session_state.selected_prompt else None,
+                    pinned,
+                    st.session_state.messages,
+                    context=context,
+                )
+                
+                # 入力の大きさ・添付資料・カテゴリでモデルを選び、応答がなければ次の候補へ
+                router = get_model_router()
+                models = router.candidates(
+                    "chat",
+                    sum(estimate_tokens(m["content"]) for m in messages),
+                    bool(st.session_state.attachments),
+                    st.session_state.selected_category,
+                )
                 
                 try:
-                    stream = client.chat.completions.create(
-                        # model="chatgpt-4o-latest",
-                        model="gpt-5",
-                        messages=messages,
-                        stream=True,
-                        # temperature=0.7
+                    stream = router.stream(
+                        lambda model: client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            stream=True,
+                            stream_options={"include_usage": True},
+                            # temperature=0.7
+                        ),
+                        models,
+                        is_token=lambda chunk: bool(chunk.choices and chunk.choices[0].delta.content),
                     )
                     
+                    # チャンクごとではなく一定間隔でまとめて描画する
+                    renderer = ThrottledRenderer(message_placeholder, interval=STREAM_RENDER_INTERVAL)
                     for chunk in stream:
-                        if chunk.choices[0].delta.content is not None:
-                            full_response += chunk.choices[0].delta.content
-                            message_placeholder.markdown(full_response + "▌")
+                        if chunk.choices and chunk.choices[0].delta.content is not None:
+                            renderer.append(chunk.choices[0].delta.content)
+                        if chunk.usage:
+                            usage = usage_summary(chunk.usage)
                     
-                    message_placeholder.markdown(full_response)
+                    full_response = renderer.finish()
+                    if usage:
+                        st.caption(
+                            f"🧮 入力 {usage['prompt_tokens']:,} トークン"
+                            f"（キャッシュ {usage['cached_tokens']:,}） / 出力 {usage['completion_tokens']:,} トークン"
+                        )
                     
                 except Exception as e:
                     full_response = f"❌ エラーが発生しました: {str(e)}"
@@ -905,6 +985,15 @@ def show_chatbot_mode(generator):
                 
                 # アシスタントメッセージを追加
                 st.session_state.messages.append({"role": "assistant", "content": full_response})
+                
+                # 応答が完了するごとに履歴へ追記（今回のやり取りの分だけ書き込む）
+                save_chat_history(
+                    f"会話_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                    st.session_state.messages,
+                    st.session_state.selected_prompt,
+                    st.session_state.attachments,
+                    conversation_id=st.session_state.conversation_id
+                )
     
     # 初期メッセージ
     if len(st.session_state.messages) == 0:
@@ -0,0 +1,9 @@
+"""テスト共通設定 (src・backend をインポートできるようにする)"""
+
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+for path in (ROOT_DIR / "src", ROOT_DIR / "backend"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,57 @@
+"""アドミッション制御のクライアントごとの頻度制限"""
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from admission import AdmissionMiddleware, ConcurrencyPool, RateLimiter, Rule, client_key
+
+
+def make_client(api_keys=()):
+    app = FastAPI()
+
+    @app.post("/api/chat")
+    async def chat():
+        return {"ok": True}
+
+    pool = ConcurrencyPool("chat", 10, max_queue=10)
+    app.add_middleware(
+        AdmissionMiddleware,
+        rules=[Rule(("POST",), r"/api/chat", pool, RateLimiter(60, burst=2))],
+        api_keys=api_keys,
+    )
+    return TestClient(app)
+
+
+def test_rotating_unregistered_api_key_does_not_bypass_limit():
+    client = make_client()
+    statuses = [client.post("/api/chat", headers={"X-API-Key": f"random-{i}"}).status_code for i in range(4)]
+    assert statuses[:2] == [200, 200]
+    assert statuses[2:] == [429, 429]
+
+
+def test_rotating_bearer_token_does_not_bypass_limit():
+    client = make_client()
+    statuses = [
+        client.post("/api/chat", headers={"Authorization": f"Bearer token-{i}"}).status_code for i in range(3)
+    ]
+    assert statuses == [200, 200, 429]
+
+
+def test_registered_api_keys_have_their_own_buckets():
+    client = make_client(api_keys={"team-a", "team-b"})
+    for key in ("team-a", "team-b"):
+        statuses = [client.post("/api/chat", headers={"X-API-Key": key}).status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+
+
+def test_client_key_ignores_unregistered_keys():
+    scope = {"headers": [(b"x-api-key", b"unknown")], "client": ("10.0.0.1", 1234)}
+    assert client_key(scope) == "ip:10.0.0.1"
+    assert client_key(scope, api_keys={"unknown"}).startswith("key:")
+    assert "unknown" not in client_key(scope, api_keys={"unknown"})
+
+
+def test_client_key_uses_first_forwarded_hop_only_when_trusted():
+    scope = {"headers": [(b"x-forwarded-for", b"203.0.113.5, 10.0.0.2")], "client": ("10.0.0.1", 1234)}
+    assert client_key(scope) == "ip:10.0.0.1"
+    assert client_key(scope, trust_forwarded=True) == "ip:203.0.113.5"
@@ -0,0 +1,31 @@
+"""抽出結果のキャッシュ"""
+
+from extraction import ExtractionCache
+
+CSV_BYTES = "名前,点数\n" .encode("utf-8") + b"".join(f"user{i},{i}\n".encode("utf-8") for i in range(2000))
+
+
+def test_same_bytes_under_different_extensions_are_extracted_separately(tmp_path):
+    cache = ExtractionCache(tmp_path)
+
+    as_text, result = cache.extract(CSV_BYTES, "scores.txt")
+    assert (as_text.file_type, result) == ("text", "miss")
+    as_csv, result = cache.extract(CSV_BYTES, "scores.csv")
+    assert (as_csv.file_type, result) == ("csv", "miss")
+    assert as_csv.text.startswith("行数: 2000, 列数: 2")
+
+    again, result = cache.extract(CSV_BYTES, "scores.txt")
+    assert (again.file_type, result) == ("text", "hit")
+    assert again.text == as_text.text
+
+
+def test_partial_entry_is_not_resumed_under_another_extension(tmp_path):
+    cache = ExtractionCache(tmp_path)
+
+    partial, _ = cache.extract(CSV_BYTES, "scores.txt", max_tokens=10)
+    assert not partial.complete
+
+    as_csv, result = cache.extract(CSV_BYTES, "scores.csv")
+    assert (as_csv.file_type, result) == ("csv", "miss")
+    assert as_csv.complete
+    assert as_csv.text.startswith("行数: 2000, 列数: 2")